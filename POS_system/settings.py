@@ -137,3 +137,22 @@ PHONENUMBER_DB_FORMAT='NATIONAL'
 PHONENUMBER_DEFAULT_FORMAT='NATIONAL'
 PHONENUMBER_DEFAULT_REGION = 'DZ'
 
+
+# Generated PDF documents (invoices, receipts, purchase orders)
+PDF_ROOT = BASE_DIR / 'pdf'
+# Number of processes rendering PDFs in the background, 0 renders them in the request
+PDF_WORKERS = 2
+# Seconds after which a rendered PDF job is deleted
+PDF_JOB_MAX_AGE = 60 * 60
+# Size in bytes above which the least recently used cached PDFs are deleted
+PDF_CACHE_MAX_SIZE = 500 * 1024 * 1024
+# Change it when the rendering changes without the HTML changing (stylesheets, WeasyPrint upgrade)
+PDF_TEMPLATE_VERSION = 1
+# Stylesheets applied to every PDF, relative to BASE_DIR, parsed once per rendering process
+PDF_STYLESHEETS = []
+# Maximum number of documents exported in a single PDF, larger exports use a ZIP archive
+PDF_EXPORT_MAX_MERGED = 200
+# Characters per line of the thermal receipts (48 for 80 mm paper)
+RECEIPT_WIDTH = 48
+# Quantity under which the stock of a product is low, unless the stock-room list sets another threshold
+LOW_STOCK_THRESHOLD = 5
@@ -0,0 +1,304 @@
+from collections import defaultdict
+
+import phonenumbers
+from django import forms
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse
+from django.views import View
+
+from .models import Client, Product, PurchaseOrder, PurchaseOrderItem, Repair, Sale, SaleItem, Supplier, Suppliying
+from .pagination import KeysetPaginator
+from .phones import phone_digits
+
+API_VERSION = 1
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+class ApiJSONEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # Phone numbers are written in E.164, whatever PHONENUMBER_DEFAULT_FORMAT is
+        if isinstance(o, phonenumbers.PhoneNumber):
+            return phonenumbers.format_number(o, phonenumbers.PhoneNumberFormat.E164)
+        return super().default(o)
+
+
+class PhoneDigitsField(forms.CharField):
+    """Phone number in any format, cleaned to the digits of manager.phones.phone_digits."""
+
+    def clean(self, value):
+        digits = phone_digits(super().clean(value))
+        if digits is None:
+            raise forms.ValidationError("Numéro de téléphone invalide.")
+        return digits
+
+
+class SupplierProductsField(forms.IntegerField):
+    """Supplier id, cleaned to the ids of its products read from Fournir."""
+
+    def clean(self, value):
+        return Suppliying.objects.filter(supplier=super().clean(value)).values('product')
+
+
+class DeliveredField(forms.NullBooleanField):
+    """?delivered=true, cleaned to the value of a delivery_date__isnull lookup."""
+
+    def clean(self, value):
+        delivered = super().clean(value)
+        return None if delivered is None else not delivered
+
+
+class Lines:
+    """Lines of the documents of a resource (the items of a sale...), read for a whole page with one query."""
+
+    def __init__(self, model, parent_field, fields):
+        self.model = model
+        self.parent_field = parent_field
+        self.fields = fields
+
+    def read(self, parent_ids):
+        rows = self.model.objects.filter(**{f'{self.parent_field}__in': parent_ids}).order_by(
+            self.parent_field, 'pk').values_list(self.parent_field, *self.fields.values())
+        lines = defaultdict(list)
+        for parent_id, *values in rows:
+            lines[parent_id].append(dict(zip(self.fields, values)))
+        return lines
+
+
+class Resource:
+    """A model served by the API.
+
+    fields maps the names of the JSON fields to the ORM paths read with values(), filters
+    maps the query parameters to an ORM lookup and the form field cleaning their value.
+    """
+
+    def __init__(self, model, roles, fields, filters, ordering, lines=None):
+        self.model = model
+        self.roles = roles
+        self.fields = fields
+        self.filters = filters
+        self.ordering = ordering
+        self.lines = lines
+
+
+RESOURCES = {
+    'produits': Resource(
+        Product, ['Admin', 'Employé'],
+        fields={
+            'id': 'id',
+            'name': 'name',
+            'barcode': 'barcode',
+            'description': 'description',
+            'category': 'category',
+            'category_name': 'category__name',
+            'quantity': 'quantity',
+            'initial_selling_price': 'initial_selling_price',
+        },
+        filters={
+            'category': ('category', forms.IntegerField()),
+            'supplier': ('pk__in', SupplierProductsField()),
+            'min_quantity': ('quantity__gte', forms.IntegerField()),
+            'max_quantity': ('quantity__lte', forms.IntegerField()),
+            'min_price': ('initial_selling_price__gte', forms.IntegerField()),
+            'max_price': ('initial_selling_price__lte', forms.IntegerField()),
+        },
+        ordering=['pk'],
+    ),
+    'clients': Resource(
+        Client, None,
+        fields={
+            'id': 'id',
+            'first_name': 'first_name',
+            'last_name': 'last_name',
+            'phone': 'phone',
+            'email': 'email',
+            'address': 'address',
+            'sale_count': 'summary__sale_count',
+            'total_spent': 'summary__total_spent',
+            'last_visit': 'summary__last_visit',
+        },
+        filters={
+            'phone': ('phone_digits', PhoneDigitsField()),
+            'last_name': ('last_name__iexact', forms.CharField()),
+        },
+        ordering=['pk'],
+    ),
+    'fournisseurs': Resource(
+        Supplier, ['Admin', 'Employé'],
+        fields={
+            'id': 'id',
+            'name': 'name',
+            'phone': 'phone',
+            'email': 'email',
+            'address': 'address',
+        },
+        filters={
+            'phone': ('phone_digits', PhoneDigitsField()),
+        },
+        ordering=['pk'],
+    ),
+    'ventes': Resource(
+        Sale, ['Admin', 'Employé'],
+        fields={
+            'id': 'id',
+            'client': 'client',
+            'sale_date': 'sale_date',
+            'total_amount': 'total_amount',
+            'item_count': 'item_count',
+        },
+        filters={
+            'client': ('client', forms.IntegerField()),
+            'start_date': ('sale_date__gte', forms.DateField()),
+            'end_date': ('sale_date__lte', forms.DateField()),
+        },
+        ordering=['-sale_date', '-pk'],
+        lines=Lines(SaleItem, 'sale', {
+            'id': 'id',
+            'product': 'product',
+            'product_name': 'product__name',
+            'quantity': 'quantity',
+            'sale_price': 'sale_price',
+        }),
+    ),
+    'commandes': Resource(
+        PurchaseOrder, ['Admin', 'Employé'],
+        fields={
+            'id': 'id',
+            'supplier': 'supplier',
+            'order_date': 'order_date',
+            'delivery_date': 'delivery_date',
+        },
+        filters={
+            'supplier': ('supplier', forms.IntegerField()),
+            'start_date': ('order_date__gte', forms.DateField()),
+            'end_date': ('order_date__lte', forms.DateField()),
+            'delivered': ('delivery_date__isnull', DeliveredField()),
+        },
+        ordering=['-order_date', '-pk'],
+        lines=Lines(PurchaseOrderItem, 'purchase_order', {
+            'id': 'id',
+            'product': 'product',
+            'product_name': 'product__name',
+            'quantity': 'quantity',
+            'purchase_price': 'purchase_price',
+        }),
+    ),
+    'reparations': Resource(
+        Repair, ['Admin', 'Réparateur'],
+        fields={
+            'id': 'id',
+            'title': 'title',
+            'description': 'description',
+            'state': 'state',
+            'hardware': 'hardware',
+            'hardware_name': 'hardware__name',
+            'client': 'client',
+            'deposit_date': 'deposit_date',
+            'delivery_date': 'delivery_date',
+            'repair_price': 'repair_price',
+            'prepayment': 'prepayment',
+        },
+        filters={
+            'client': ('client', forms.IntegerField()),
+            'state': ('state', forms.CharField()),
+            'start_date': ('deposit_date__gte', forms.DateField()),
+            'end_date': ('deposit_date__lte', forms.DateField()),
+            'delivered': ('delivery_date__isnull', DeliveredField()),
+        },
+        ordering=['-deposit_date', '-pk'],
+    ),
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class ApiListView(View):
+    """Read-only JSON list of a resource, /api/v1/<resource>/.
+
+    Query parameters:
+    - fields: comma separated JSON fields to return, all of them by default ('lines' for the lines of a document)
+    - the filters of the resource, e.g. ?client=3&start_date=2024-01-01
+    - limit: number of objects per page, and cursor: the next or previous cursor of a response
+
+    The rows are read with values() and written as they are, without model instances.
+    """
+    resource_name = None
+
+    def get_fields(self, resource):
+        requested = self.request.GET.get('fields')
+        available = list(resource.fields) + (['lines'] if resource.lines else [])
+        if not requested:
+            return available
+        fields = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = [name for name in fields if name not in available]
+        if unknown:
+            raise ApiError(f"Champs inconnus : {', '.join(unknown)}.")
+        return fields
+
+    def get_filters(self, resource):
+        filters = {}
+        for param, (lookup, field) in resource.filters.items():
+            if param not in self.request.GET:
+                continue
+            try:
+                value = field.clean(self.request.GET[param])
+            except forms.ValidationError:
+                raise ApiError(f"Valeur invalide pour le filtre {param}.")
+            if value is not None:
+                filters[lookup] = value
+        return filters
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.GET.get('limit', DEFAULT_LIMIT))
+        except ValueError:
+            raise ApiError("Valeur invalide pour limit.")
+        return min(max(limit, 1), MAX_LIMIT)
+
+    def page_url(self, cursor):
+        if cursor is None:
+            return None
+        query = self.request.GET.copy()
+        query['cursor'] = cursor
+        return self.request.build_absolute_uri(f'{self.request.path}?{query.urlencode()}')
+
+    def get(self, request, *args, **kwargs):
+        resource = RESOURCES[self.resource_name]
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Authentification requise.'}, status=401)
+        if resource.roles and request.user.employee.role not in resource.roles:
+            return JsonResponse({'error': "Vous n'avez pas la permission de consulter ces données."}, status=403)
+        try:
+            fields = self.get_fields(resource)
+            queryset = resource.model.objects.filter(**self.get_filters(resource))
+            limit = self.get_limit()
+        except ApiError as e:
+            return JsonResponse({'error': e.message}, status=e.status)
+
+        # The ordering columns are read too, they give the position of the cursors
+        columns = [name for name in fields if name != 'lines']
+        ordering_names = [resource.model._meta.pk.name if name.lstrip('-') == 'pk' else name.lstrip('-')
+                          for name in resource.ordering]
+        paths = {name: resource.fields[name] for name in columns}
+        extra = [name for name in ordering_names if name not in paths.values()]
+        queryset = queryset.values(*paths.values(), *extra)
+
+        page = KeysetPaginator(queryset, resource.ordering, limit).page(request.GET.get('cursor'))
+        data = [{name: row[path] for name, path in paths.items()} for row in page.object_list]
+        if 'lines' in fields:
+            ids = [row[resource.model._meta.pk.name] for row in page.object_list]
+            lines = resource.lines.read(ids)
+            for obj, pk in zip(data, ids):
+                obj['lines'] = lines.get(pk, [])
+
+        return JsonResponse({
+            'version': API_VERSION,
+            'data': data,
+            'next': self.page_url(page.next_cursor),
+            'previous': self.page_url(page.previous_cursor),
+        }, encoder=ApiJSONEncoder)
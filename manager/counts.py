@@ -0,0 +1,100 @@
+from collections import defaultdict
+
+from django.core.paginator import Paginator
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils.functional import cached_property
+
+from .models import Account, Client, Employee, HardwareToRepair, Product, PurchaseOrder, Repair, RowCount, Sale, \
+    Supplier
+
+# Models whose number of rows is stored in RowCount, and the foreign keys their lists are
+# filtered by (the sales of a client...), whose number of rows per value is stored too.
+COUNTED_FIELDS = {
+    Client: [],
+    Supplier: [],
+    Product: ['category'],
+    Account: [],
+    Employee: [],
+    HardwareToRepair: [],
+    Sale: ['client'],
+    PurchaseOrder: ['supplier'],
+    Repair: ['client'],
+}
+
+
+def adjust_row_counts(model, objects, delta):
+    """Add delta to the stored counts of the rows of objects, created (1) or deleted (-1), with a single UPDATE.
+
+    Counts that were never read are not stored, and not updated.
+    """
+    deltas = defaultdict(int)
+    for obj in objects:
+        deltas['', 0] += delta
+        for name in COUNTED_FIELDS[model]:
+            value = getattr(obj, model._meta.get_field(name).attname)
+            if value is not None:
+                deltas[name, value] += delta
+    if not deltas:
+        return
+    whens = [When(field=field, value=value, then=Value(count)) for (field, value), count in deltas.items()]
+    condition = Q()
+    for field, value in deltas:
+        condition |= Q(field=field, value=value)
+    RowCount.objects.filter(condition, model=model._meta.label_lower).update(
+        count=F('count') + Case(*whens, default=Value(0), output_field=IntegerField()))
+
+
+def count_rows(model, field='', value=0):
+    """Return the exact number of rows of a model, or of the rows whose field equals value."""
+    queryset = model._default_manager.all()
+    if field:
+        queryset = queryset.filter(**{field: value})
+    return queryset.count()
+
+
+def get_row_count(model, field='', value=0):
+    """Return the stored number of rows of a model, or of the rows whose field equals value.
+
+    The count is computed with COUNT(*) the first time it is read, then kept up to date
+    by the signals of the models, and corrected by the reconcile_row_counts command.
+    """
+    label = model._meta.label_lower
+    count = RowCount.objects.filter(model=label, field=field, value=value).values_list('count', flat=True).first()
+    if count is None:
+        count = count_rows(model, field, value)
+        RowCount.objects.get_or_create(model=label, field=field, value=value, defaults={'count': count})
+    return max(count, 0)
+
+
+def reconcile_row_counts():
+    """Correct every stored count with an exact COUNT(*), return the (RowCount, exact count) that had drifted."""
+    from django.apps import apps
+
+    drifts = []
+    for row_count in RowCount.objects.order_by('pk'):
+        model = apps.get_model(row_count.model)
+        count = count_rows(model, row_count.field, row_count.value)
+        if count != row_count.count:
+            drifts.append((row_count, count))
+            # Concurrent changes since the count went through F() and are kept
+            RowCount.objects.filter(pk=row_count.pk).update(count=F('count') + (count - row_count.count))
+    # Counts of deleted parents (the sales of a deleted client...) are dropped, they are read again on demand
+    RowCount.objects.exclude(field='').filter(count=0).delete()
+    return drifts
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator reading the number of objects from RowCount instead of running COUNT(*).
+
+    count_filter is the (field, value) the listed objects are filtered by, if any. The
+    stored count can be off by a few rows between two reconciliations, the page links
+    then point to a page too many, or too few.
+    """
+
+    def __init__(self, object_list, per_page, count_filter=('', 0), **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_filter = count_filter
+
+    @cached_property
+    def count(self):
+        return get_row_count(self.object_list.model, *self.count_filter)
@@ -1,8 +1,11 @@
+import datetime
+
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm, SetPasswordForm
 from django.core.exceptions import ValidationError
 from django.db.models import Q
 from django.forms import inlineformset_factory, BaseInlineFormSet
+from django.urls import reverse
 
 from .models import Employee, Account, Client, Supplier, Product, Category, Sale, SaleItem, PurchaseOrder, \
     PurchaseOrderItem, Repair, HardwareToRepair
@@ -145,6 +148,43 @@ class FilterForm(forms.Form):
                                widget=forms.TextInput(attrs={'placeholder': 'Rechercher par ID'}))
 
 
+class ProductFilterForm(FilterForm):
+    STOCK_CHOICES = [
+        ('', 'Tout le stock'),
+        ('rupture', 'En rupture'),
+        ('faible', 'Sous le seuil'),
+    ]
+    # Columns the list can be sorted by, a '-' prefix sorts in descending order
+    SORT_FIELDS = {
+        'id': 'Id',
+        'name': 'Nom',
+        'category__name': 'Catégorie',
+        'quantity': 'Quantité',
+        'initial_selling_price': 'Prix de vente',
+    }
+    category = forms.ModelChoiceField(queryset=Category.objects.order_by('name'), required=False, label='',
+                                      empty_label='Toutes les catégories')
+    supplier = forms.ModelChoiceField(queryset=Supplier.objects.order_by('name'), required=False, label='',
+                                      empty_label='Tous les fournisseurs')
+    stock = forms.ChoiceField(choices=STOCK_CHOICES, required=False, label='')
+    threshold = forms.IntegerField(min_value=0, required=False, label='',
+                                   widget=forms.NumberInput(attrs={'placeholder': 'Seuil'}))
+    min_price = forms.IntegerField(min_value=0, required=False, label='',
+                                   widget=forms.NumberInput(attrs={'placeholder': 'Prix min'}))
+    max_price = forms.IntegerField(min_value=0, required=False, label='',
+                                   widget=forms.NumberInput(attrs={'placeholder': 'Prix max'}))
+    sort = forms.ChoiceField(required=False, widget=forms.HiddenInput, choices=[
+        (f'{prefix}{field}', label) for field, label in SORT_FIELDS.items() for prefix in ('', '-')])
+
+    def clean(self):
+        cleaned_data = super().clean()
+        min_price = cleaned_data.get('min_price')
+        max_price = cleaned_data.get('max_price')
+        if min_price is not None and max_price is not None and min_price > max_price:
+            raise ValidationError("Le prix minimum doit être inférieur au prix maximum.")
+        return cleaned_data
+
+
 class SupplierForm(forms.ModelForm):
     class Meta:
         model = Supplier
@@ -185,10 +225,11 @@ class SupplierForm(forms.ModelForm):
 class ProductForm(forms.ModelForm):
     class Meta:
         model = Product
-        fields = ['name', 'category','description', 'initial_selling_price',
+        fields = ['name', 'barcode', 'category','description', 'initial_selling_price',
                   'suppliers']
         widgets = {
             'name': forms.TextInput(attrs={'placeholder': 'Entrer le nom du produit'}),
+            'barcode': forms.TextInput(attrs={'placeholder': 'Scanner ou entrer le code-barres (optionnel)'}),
             'category': forms.Select(attrs={'placeholder': 'Choisir la catégorie du produit'}),
             'description': forms.TextInput(attrs={'placeholder': 'Entrer la description du produit'}),
             # Add 'size': 3 as needed
@@ -204,6 +245,7 @@ class ProductForm(forms.ModelForm):
         }
         labels = {
             'name': "",
+            'barcode': "",
             'category': 'Choisir la catégorie du produit',
             'description': "",
             # 'state': 'Choisir l\'état du produit',
@@ -216,6 +258,10 @@ class ProductForm(forms.ModelForm):
                 'required': "Le nom du produit est requis.",
                 'max_length': "Le nom du produit ne peut pas dépasser %(max)d caractères.",
             },
+            'barcode': {
+                'max_length': "Le code-barres ne peut pas dépasser %(max)d caractères.",
+                'unique': "Un produit avec ce code-barres existe déjà.",
+            },
             'category': {
                 'required': "La catégorie du produit est requise.",
             },
@@ -292,12 +338,68 @@ class SaleForm(forms.ModelForm):
         fields = ['client']
 
 
-class SaleItemForm(forms.ModelForm):
-    submitted_products = []
+class PreloadedModelChoiceField(forms.ModelChoiceField):
+    """Choice field resolving the submitted ids from a {pk: object} map preloaded by the formset."""
+    preloaded = None
+
+    def to_python(self, value):
+        if self.preloaded is None or value in self.empty_values:
+            return super().to_python(value)
+        try:
+            return self.preloaded[int(value)]
+        except (KeyError, ValueError, TypeError):
+            raise ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+
 
+class PreloadedProductChoiceField(PreloadedModelChoiceField):
+    """Product choice field, the products are preloaded by BaseSaleItemFormSet."""
+
+
+class ProductSearchSelect(forms.Select):
+    """Select rendering only the chosen product, the others are searched on demand by product-search.js."""
+
+    def __init__(self, attrs=None, choices=()):
+        super().__init__(attrs, choices)
+        # {product_id: Product} already loaded by the form, used to render the selected option without a query
+        self.known_products = {}
+
+    def __deepcopy__(self, memo):
+        # Every form gets its own map, not the one of the base_fields widget
+        obj = super().__deepcopy__(memo)
+        obj.known_products = {}
+        return obj
+
+    def optgroups(self, name, value, attrs=None):
+        field = self.choices.field
+        selected_ids = [v for v in value if str(v).isdigit()]
+        products = {str(pk): product for pk, product in self.known_products.items() if str(pk) in selected_ids}
+        missing_ids = [pk for pk in selected_ids if pk not in products]
+        if missing_ids:
+            products.update({str(product.pk): product for product in field.queryset.filter(pk__in=missing_ids)})
+
+        choices = [('', field.empty_label)] if field.empty_label is not None else []
+        choices += [(pk, field.label_from_instance(product)) for pk, product in products.items()]
+        return [
+            (None, [self.create_option(name, option_value, option_label, option_value in selected_ids, index,
+                                       attrs=attrs)], index)
+            for index, (option_value, option_label) in enumerate(choices)
+        ]
+
+
+class SaleItemForm(forms.ModelForm):
     class Meta:
         model = SaleItem
         fields = ['product', 'quantity', 'sale_price']
+        field_classes = {
+            'product': PreloadedProductChoiceField,
+        }
+        widgets = {
+            'product': ProductSearchSelect,
+        }
         labels = {
             'product': 'Produit',
             'quantity': 'Quantité',
@@ -305,40 +407,34 @@ class SaleItemForm(forms.ModelForm):
         }
 
     def __init__(self, *args, **kwargs):
-        self.sale = kwargs.pop('sale', None)  # Get the 'sale' argument
+        # Maps preloaded by the formset: {product_id: quantity already in the sale} and {product_id: Product}
+        self.old_quantities = kwargs.pop('old_quantities', {})
+        products = kwargs.pop('products', None)
         super().__init__(*args, **kwargs)
-        self.fields['product'].widget.attrs.update({'class': 'product-select'})
+        self.fields['product'].preloaded = products
+        self.fields['product'].widget.known_products = dict(products or {})
+        if self.instance.product_id:
+            self.fields['product'].widget.known_products[self.instance.product_id] = self.instance.product
+        self.fields['product'].widget.attrs.update({'class': 'product-select',
+                                                    'data-search-url': reverse('product-search')})
         self.fields['product'].label_from_instance = lambda obj: obj.form_field_representation()
         self.fields['sale_price'].widget.attrs.update({'class': 'sale-price-input'})
 
+    def _get_validation_exclusions(self):
+        exclude = super()._get_validation_exclusions()
+        if self.fields['product'].preloaded is not None:
+            # The product was already found in the preloaded map, skip the existence query of the model validation
+            exclude.add('product')
+        return exclude
 
     def clean(self):
         cleaned_data = super().clean()
         product = cleaned_data.get('product')
         quantity = cleaned_data.get('quantity')
 
-        # Check if product is in submitted_products
-        if product in SaleItemForm.submitted_products:
-            raise ValidationError({
-                'product': ValidationError(
-                    # validation error message in french
-                    'Ce produit a déjà été ajouté à la vente. Veuillez choisir un autre produit.',
-                    code='unique_together'
-                )
-            })
-        else:
-            # Add product to submitted_products
-            SaleItemForm.submitted_products.append(product)
-
         if product and quantity:
-            # Get the Sale instance passed as an argument
-            sale = self.sale
-
-            # Get the SaleItem instance that is going to be removed
-            old_sale_item = SaleItem.objects.filter(sale=sale, product=product).first()
-
-            # Get the old quantity from this instance
-            old_quantity = old_sale_item.quantity if old_sale_item else 0
+            # Get the old quantity of this product in the sale
+            old_quantity = self.old_quantities.get(product.pk, 0)
 
             # Check if the difference between the old quantity and the new quantity exceeds the quantity in stock
             if quantity - old_quantity > product.quantity:
@@ -353,7 +449,116 @@ class SaleItemForm(forms.ModelForm):
         return cleaned_data
 
 
-SaleItemFormSet = inlineformset_factory(Sale, SaleItem, form=SaleItemForm, can_delete=True, extra=1)
+class BaseUniqueProductFormSet(BaseInlineFormSet):
+    """Inline formset refusing the same product on two of its lines."""
+    duplicate_product_message = 'Ce produit a déjà été ajouté. Veuillez choisir un autre produit.'
+
+    def clean(self):
+        super().clean()
+        # The set only lives for the validation of this formset, i.e. of this request
+        submitted_products = set()
+        for form in self.forms:
+            if not hasattr(form, 'cleaned_data') or (self.can_delete and self._should_delete_form(form)):
+                continue
+            product = form.cleaned_data.get('product')
+            if not product:
+                continue
+            if product.pk in submitted_products:
+                form.add_error('product', ValidationError(self.duplicate_product_message, code='unique_together'))
+            else:
+                submitted_products.add(product.pk)
+
+
+class BaseSaleItemFormSet(BaseUniqueProductFormSet):
+    """Load the data needed to validate every line of the sale in two queries."""
+    # validation error message in french
+    duplicate_product_message = 'Ce produit a déjà été ajouté à la vente. Veuillez choisir un autre produit.'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The forms of the lines render and validate their product without a query each
+        self.queryset = self.queryset.select_related('product')
+        self._preloaded = None
+        self._sale_items = None
+
+    def get_preloaded(self):
+        if self._preloaded is None:
+            # Quantities of the products already in the sale, read from the lines of the formset
+            old_quantities = {}
+            for sale_item in self.get_queryset():
+                old_quantities.setdefault(sale_item.product_id, sale_item.quantity)
+
+            # Current stock of every submitted product
+            product_ids = set()
+            if self.is_bound:
+                for i in range(self.total_form_count()):
+                    value = self.data.get(self.add_prefix(i) + '-product')
+                    if value and str(value).isdigit():
+                        product_ids.add(int(value))
+            products = self.form.base_fields['product'].queryset.in_bulk(product_ids)
+
+            self._preloaded = (old_quantities, products)
+        return self._preloaded
+
+    def add_fields(self, form, index):
+        super().add_fields(form, index)
+        # The submitted ids of the lines are resolved from the lines already loaded, not with a query each
+        if self._sale_items is None:
+            self._sale_items = {sale_item.pk: sale_item for sale_item in self.get_queryset()}
+        pk_name = self._pk_field.name
+        pk_field = form.fields[pk_name]
+        form.fields[pk_name] = PreloadedModelChoiceField(pk_field.queryset, initial=pk_field.initial,
+                                                         required=pk_field.required, widget=pk_field.widget)
+        form.fields[pk_name].preloaded = self._sale_items
+
+    def get_form_kwargs(self, index):
+        kwargs = super().get_form_kwargs(index)
+        old_quantities, products = self.get_preloaded()
+        kwargs['old_quantities'] = old_quantities
+        if self.is_bound:
+            kwargs['products'] = products
+        return kwargs
+
+
+SaleItemFormSet = inlineformset_factory(Sale, SaleItem, form=SaleItemForm, formset=BaseSaleItemFormSet,
+                                        can_delete=True, extra=1)
+
+
+class SyncSaleForm(forms.Form):
+    """A sale recorded offline by a store terminal, validated before the synchronisation."""
+    idempotency_key = forms.CharField(max_length=64, error_messages={
+        'required': "La clé d'idempotence est requise.",
+        'max_length': "La clé d'idempotence ne peut pas dépasser %(limit_value)d caractères.",
+    })
+    client = forms.IntegerField(required=False, error_messages={
+        'invalid': "Veuillez entrer un identifiant de client valide.",
+    })
+    # Day the sale was rung up on the terminal, today if not given
+    sale_date = forms.DateField(required=False, input_formats=['%Y-%m-%d'], error_messages={
+        'invalid': "Veuillez entrer une date de vente valide (AAAA-MM-JJ).",
+    })
+
+    def clean_sale_date(self):
+        sale_date = self.cleaned_data['sale_date']
+        if sale_date is not None and sale_date > datetime.date.today():
+            raise ValidationError("La date de vente ne peut pas être dans le futur.")
+        return sale_date
+
+
+class SyncSaleItemForm(forms.Form):
+    """A line of a sale recorded offline, the products are checked by the view for the whole batch."""
+    product = forms.IntegerField(error_messages={
+        'required': "Le produit est requis.",
+        'invalid': "Veuillez entrer un identifiant de produit valide.",
+    })
+    quantity = forms.IntegerField(min_value=1, error_messages={
+        'required': "La quantité est requise.",
+        'min_value': "La quantité doit être supérieure à 0",
+    })
+    sale_price = forms.IntegerField(min_value=0, error_messages={
+        'required': "Le prix de vente est requis.",
+        'min_value': "Le prix de vente ne peut pas être négatif.",
+    })
 
 
 class PurchaseOrderForm(forms.ModelForm):
@@ -366,7 +571,6 @@ class PurchaseOrderForm(forms.ModelForm):
 
 
 class PurchaseOrderItemForm(forms.ModelForm):
-    submitted_products=[]
     class Meta:
         model = PurchaseOrderItem
         fields = ['product', 'quantity']
@@ -374,35 +578,32 @@ class PurchaseOrderItemForm(forms.ModelForm):
             'product': 'Produit',
             'quantity': 'Quantité'
         }
+        widgets = {
+            'product': ProductSearchSelect,
+        }
 
     def __init__(self, *args, **kwargs):
         purchase_order = kwargs.pop('purchase_order', None)
         super().__init__(*args, **kwargs)
+        search_url = reverse('product-search')
         if purchase_order:
             self.fields['product'].queryset = Product.objects.filter(suppliers__in=[purchase_order.supplier])
-        self.fields['product'].widget.attrs.update({'class': 'product-select'})
+            search_url += f'?fournisseur={purchase_order.supplier_id or 0}'
+        self.fields['product'].widget.known_products = {}
+        if self.instance.product_id:
+            self.fields['product'].widget.known_products[self.instance.product_id] = self.instance.product
+        self.fields['product'].widget.attrs.update({'class': 'product-select', 'data-search-url': search_url})
         self.fields['product'].label_from_instance = lambda obj: obj.form_field_representation()
         #self.fields['purchase_price'].widget.attrs.update({'class': 'purchase-price-input'})
 
-    def clean(self):
-        cleaned_data = super().clean()
-        product = cleaned_data.get('product')
 
-        if product in PurchaseOrderItemForm.submitted_products:
-            raise ValidationError({
-                'product': ValidationError(
-                    # validation error message in french
-                    'Ce produit a déjà été ajouté à la vente. Veuillez choisir un autre produit.',
-                    code='unique_together'
-                )
-            })
-        else:
-            # Add product to submitted_products
-            SaleItemForm.submitted_products.append(product)
+class BasePurchaseOrderItemFormSet(BaseUniqueProductFormSet):
+    # validation error message in french
+    duplicate_product_message = 'Ce produit a déjà été ajouté à la commande. Veuillez choisir un autre produit.'
 
-        return cleaned_data
 
-PurchaseOrderItemFormSet = inlineformset_factory(PurchaseOrder, PurchaseOrderItem, form=PurchaseOrderItemForm, can_delete=True, extra=1)
+PurchaseOrderItemFormSet = inlineformset_factory(PurchaseOrder, PurchaseOrderItem, form=PurchaseOrderItemForm,
+                                                 formset=BasePurchaseOrderItemFormSet, can_delete=True, extra=1)
 
 class PurchaseOrderItemDeliveredForm(forms.ModelForm):
 
@@ -513,3 +714,32 @@ class CustomSetPasswordForm(SetPasswordForm):
         super().__init__(*args, **kwargs)
         self.fields['new_password1'].widget.attrs.update({'placeholder': 'Nouveau mot de passe'})
         self.fields['new_password2'].widget.attrs.update({'placeholder': 'Confirmation du nouveau mot de passe'})
+
+
+class DocumentExportForm(forms.Form):
+    DOCUMENT_CHOICES = [
+        ('vente', 'Factures de vente'),
+        ('commande', 'Bons de commande'),
+    ]
+    FORMAT_CHOICES = [
+        ('zip', 'Archive ZIP (un PDF par document)'),
+        ('pdf', 'Un seul PDF'),
+    ]
+    document = forms.ChoiceField(choices=DOCUMENT_CHOICES, label='Documents')
+    start_date = forms.DateField(label='Du', widget=forms.DateInput(attrs={'type': 'date'}), error_messages={
+        'required': "La date de début est requise.",
+        'invalid': "Veuillez entrer une date valide.",
+    })
+    end_date = forms.DateField(label='Au', widget=forms.DateInput(attrs={'type': 'date'}), error_messages={
+        'required': "La date de fin est requise.",
+        'invalid': "Veuillez entrer une date valide.",
+    })
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, label='Format')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_date = cleaned_data.get('start_date')
+        end_date = cleaned_data.get('end_date')
+        if start_date and end_date and start_date > end_date:
+            raise ValidationError("La date de début doit précéder la date de fin.")
+        return cleaned_data
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from manager.models import Client, Employee, Supplier
+from manager.phones import backfill_phone_digits
+
+
+class Command(BaseCommand):
+    help = ("Recalcule le numéro de téléphone normalisé (E.164) des clients, fournisseurs et employés, par "
+            "exemple après des modifications en masse qui ne passent pas par save().")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Nombre de lignes traitées par requête.")
+
+    def handle(self, *args, **options):
+        for model in (Client, Supplier, Employee):
+            count = backfill_phone_digits(model, chunk_size=options['chunk_size'])
+            self.stdout.write(f"{model._meta.db_table} : {count} numéro(s) mis à jour.")
+        self.stdout.write(self.style.SUCCESS("Numéros de téléphone normalisés."))
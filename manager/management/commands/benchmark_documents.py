@@ -0,0 +1,208 @@
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the growth of the resident memory is not measured there
+    resource = None
+
+import django
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished
+from django.db import close_old_connections, connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import resolve, reverse
+
+from manager.models import Account, Category, Client, Employee, HardwareToRepair, Product, PurchaseOrder, \
+    PurchaseOrderItem, Repair, Sale, SaleItem, Supplier
+from manager.pdf import invalidate_pdf_cache
+
+
+class Rollback(Exception):
+    """Raised to roll back the synthetic data once the benchmark is done."""
+
+
+class Command(BaseCommand):
+    help = ("Mesure le temps, la mémoire (tas Python et mémoire résidente du processus) et le nombre de requêtes "
+            "des documents PDF et des pages de détail pour des ventes, commandes et réparations de tailles "
+            "croissantes. Les données de test sont créées dans une transaction annulée à la fin, les résultats "
+            "sont écrits en JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000],
+                            help="Nombres de lignes des ventes et des commandes mesurées.")
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="Nombre de mesures du temps de chaque page, la médiane est retenue.")
+        parser.add_argument('--output', help="Fichier JSON des résultats, la sortie standard par défaut.")
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        self.factory = RequestFactory()
+        # The user is never saved, the views only look at its role
+        self.user = Account(username='benchmark', employee=Employee(role='Admin'))
+        results = []
+
+        # The PDFs are rendered in this process, in a cache of their own
+        with tempfile.TemporaryDirectory() as pdf_root, override_settings(PDF_ROOT=pdf_root, PDF_WORKERS=0):
+            # Like the test client, keep the connection, and its transaction, open between the requests
+            request_finished.disconnect(close_old_connections)
+            try:
+                with transaction.atomic():
+                    data = self.create_data(options['sizes'])
+                    for size, sale, purchase_order in data['documents']:
+                        results += self.measure_document('sale', size, sale.pk, 'vente', [
+                            ('sale-detail', 'html'), ('sale-invoice', 'pdf'), ('sale-ticket', 'ticket')])
+                        results += self.measure_document('purchase-order', size, purchase_order.pk, 'commande', [
+                            ('purchase-order-detail', 'html'), ('purchase-order-print', 'pdf')])
+                    # A repair has no lines, its documents are measured once
+                    results += self.measure_document('repair', None, data['repair'].pk, 'reparation', [
+                        ('repair-detail', 'html'), ('repair-invoice', 'pdf'), ('repair-receipt', 'pdf'),
+                        ('repair-ticket', 'ticket')])
+                    raise Rollback
+            except Rollback:
+                pass
+            finally:
+                request_finished.connect(close_old_connections)
+
+        report = json.dumps({
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'weasyprint': getattr(sys.modules.get('weasyprint'), '__version__', None),
+                'database': connection.vendor,
+                'repeat': self.repeat,
+            },
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+            for result in results:
+                self.stdout.write(
+                    f"{result['page']:<22} {result['variant']:<7} {result['lines'] or '-':>5} lignes  "
+                    f"{result['wall_time_ms']['median']:>9.1f} ms  "
+                    f"{result['peak_python_memory_kb']:>9.0f} Ko Python  "
+                    f"{self.format_kb(result['max_rss_growth_kb']):>9} Ko RSS  "
+                    f"{result['queries']:>4} requêtes")
+            self.stdout.write(self.style.SUCCESS(f"Résultats écrits dans {options['output']}."))
+        else:
+            self.stdout.write(report)
+
+    def create_data(self, sizes):
+        suffix = uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=f'Benchmark {suffix}')
+        client = Client.objects.create(first_name='Benchmark', last_name=suffix, phone=self.unused_phone(Client),
+                                       email=f'benchmark-{suffix}@example.com', address='Benchmark')
+        supplier = Supplier.objects.create(name=f'Benchmark {suffix}', phone=self.unused_phone(Supplier),
+                                           email=f'benchmark-{suffix}@example.com', address='Benchmark')
+        products = Product.objects.bulk_create([
+            Product(name=f'Produit {suffix} {i}', category=category, quantity=1000, initial_selling_price=100 + i)
+            for i in range(max(sizes))
+        ])
+
+        documents = []
+        for size in sizes:
+            lines = products[:size]
+            sale = Sale.objects.create(client=client, total_amount=sum(product.initial_selling_price for product in lines),
+                                       item_count=size)
+            SaleItem.objects.bulk_create([SaleItem(sale=sale, product=product, quantity=1,
+                                                   sale_price=product.initial_selling_price) for product in lines])
+            purchase_order = PurchaseOrder.objects.create(supplier=supplier)
+            PurchaseOrderItem.objects.bulk_create([PurchaseOrderItem(purchase_order=purchase_order, product=product,
+                                                                     quantity=1) for product in lines])
+            documents.append((size, sale, purchase_order))
+
+        hardware = HardwareToRepair.objects.create(name='Benchmark', category=category, description='Benchmark')
+        repair = Repair.objects.create(title='Benchmark', description='Benchmark', hardware=hardware, client=client,
+                                       state=Repair.STATE_CHOICES[-1][0], repair_price=5000, prepayment=1000)
+        return {'documents': documents, 'repair': repair}
+
+    @staticmethod
+    def unused_phone(model):
+        for i in range(10000):
+            phone = f'0799{i:06d}'
+            if not model.objects.filter(phone=phone).exists():
+                return phone
+
+    def get(self, path):
+        request = self.factory.get(path)
+        request.user = self.user
+        match = resolve(path)
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        if response.streaming:
+            b''.join(response.streaming_content)
+        response.close()
+        return response
+
+    def load(self, path):
+        """Load a page like a browser, following the redirection to a PDF rendered in the background."""
+        response = self.get(path)
+        if response.status_code == 302:
+            response = self.get(response.url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} : statut {response.status_code}")
+
+    @staticmethod
+    def format_kb(value):
+        return '-' if value is None else f'{value:.0f}'
+
+    @staticmethod
+    def max_rss_kb():
+        """Peak resident memory of the process so far, in KiB, or None where it cannot be read."""
+        if resource is None:
+            return None
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, KiB on Linux
+        return max_rss / 1024 if sys.platform == 'darwin' else max_rss
+
+    def measure(self, path, before=None):
+        # tracemalloc only sees the Python heap, most of the memory of WeasyPrint (pango, cairo,
+        # harfbuzz) is native: the growth of the peak resident memory of the process is reported
+        # too. It stays at 0 when an earlier, larger page already reached a higher peak.
+        # Python memory and queries are measured on a separate run, tracemalloc slows everything down
+        if before:
+            before()
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            self.load(path)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        times = []
+        max_rss = self.max_rss_kb()
+        for i in range(self.repeat):
+            if before:
+                before()
+            start = time.perf_counter()
+            self.load(path)
+            times.append((time.perf_counter() - start) * 1000)
+        return {
+            'wall_time_ms': {'median': statistics.median(times), 'min': min(times), 'max': max(times)},
+            'peak_python_memory_kb': peak_memory / 1024,
+            'max_rss_growth_kb': None if max_rss is None else self.max_rss_kb() - max_rss,
+            'queries': len(queries),
+        }
+
+    def measure_document(self, kind, size, pk, document, pages):
+        results = []
+        for url_name, page_type in pages:
+            path = reverse(url_name, kwargs={'pk': pk})
+            if page_type == 'pdf':
+                # Rendered by WeasyPrint, then served from the PDF cache
+                variants = [('cold', lambda: invalidate_pdf_cache(document, pk)), ('cached', None)]
+            else:
+                variants = [(page_type, None)]
+            for variant, before in variants:
+                results.append({'document': kind, 'page': url_name, 'variant': variant, 'lines': size,
+                                **self.measure(path, before)})
+        return results
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from manager.summaries import rebuild_client_summaries
+
+
+class Command(BaseCommand):
+    help = ("Recalcule le résumé de chaque client (ventes, total dépensé, réparations, reste à payer, dernière "
+            "visite) à partir des ventes et des réparations, par exemple après des modifications en masse.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_client_summaries()
+        self.stdout.write(self.style.SUCCESS(f"{count} résumé(s) de client recalculé(s)."))
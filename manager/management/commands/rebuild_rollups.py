@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from manager.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = ("Recalcule les cumuls journaliers des ventes, des produits vendus et des réparations livrées du "
+            "tableau de bord, par exemple après des modifications en masse qui ne passent pas par les signaux.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            days, products = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f"{days} jour(s) et {products} cumul(s) de produit recalculé(s)."))
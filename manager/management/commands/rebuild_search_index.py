@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from manager.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = ("Reconstruit l'index de recherche à partir des clients, fournisseurs, produits, réparations et "
+            "matériels, par exemple après des modifications en masse qui ne passent pas par les signaux.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Nombre d'objets indexés par requête.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_search_index(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"{count} objet(s) indexé(s)."))
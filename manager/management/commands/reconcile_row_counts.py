@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from manager.counts import reconcile_row_counts
+
+
+class Command(BaseCommand):
+    help = ("Recompte les lignes des listes paginées et corrige les compteurs enregistrés. À lancer "
+            "régulièrement, les compteurs dérivent après des modifications qui ne passent pas par les signaux.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drifts = reconcile_row_counts()
+        for row_count, count in drifts[:20]:
+            field = f" {row_count.field}={row_count.value}" if row_count.field else ""
+            self.stdout.write(f"{row_count.model}{field} : {row_count.count} enregistré(s), {count} réel(s).")
+        self.stdout.write(self.style.SUCCESS(f"{len(drifts)} compteur(s) corrigé(s)."))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from manager.models import Product, StockMovement
+from manager.stock import ledger_quantities
+
+
+class Command(BaseCommand):
+    help = "Compare la quantité des produits avec le registre des mouvements de stock."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help="Enregistre un mouvement d'ajustement pour chaque écart trouvé.")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Nombre de produits traités par requête.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        checked = 0
+        drifts = []
+
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                products = list(Product.objects.filter(pk__gt=last_pk).order_by('pk').values_list(
+                    'pk', 'quantity')[:chunk_size])
+                if not products:
+                    break
+                last_pk = products[-1][0]
+                ledger = ledger_quantities([pk for pk, quantity in products])
+                chunk_drifts = [(pk, (quantity or 0) - ledger[pk]) for pk, quantity in products
+                                if (quantity or 0) != ledger[pk]]
+                if chunk_drifts and options['fix']:
+                    # The product quantity is the reference, the ledger is aligned on it
+                    StockMovement.objects.bulk_create([
+                        StockMovement(product_id=pk, quantity=drift, source_type='Ajustement')
+                        for pk, drift in chunk_drifts
+                    ])
+            checked += len(products)
+            drifts += chunk_drifts
+
+        for pk, drift in drifts[:20]:
+            self.stdout.write(f"Produit {pk} : écart de {drift:+d} entre le stock et le registre.")
+        if drifts and not options['fix']:
+            raise CommandError(f"{len(drifts)} produit(s) sur {checked} ont un stock différent du registre.")
+        self.stdout.write(self.style.SUCCESS(
+            f"{checked} produit(s) vérifié(s), {len(drifts)} écart(s)" + (" corrigé(s)." if options['fix'] else ".")))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from manager.models import Sale, SaleItem
+
+
+class Command(BaseCommand):
+    help = "Recalcule le montant total et le nombre d'articles stockés sur les ventes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="Vérifie seulement les valeurs stockées, sans les corriger.")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Nombre de ventes traitées par requête.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        checked = 0
+        wrong_sales = []
+
+        last_pk = 0
+        while True:
+            # Walk the sales by primary key so that memory stays bounded
+            sales = list(Sale.objects.filter(pk__gt=last_pk).order_by('pk').values_list(
+                'pk', 'total_amount', 'item_count')[:chunk_size])
+            if not sales:
+                break
+            last_pk = sales[-1][0]
+
+            totals = {
+                row['sale']: (row['total_amount'] or 0, row['item_count'])
+                for row in SaleItem.objects.filter(sale__in=[pk for pk, _, _ in sales]).values('sale').annotate(
+                    total_amount=Sum(F('sale_price') * F('quantity')), item_count=Count('id'))
+            }
+            wrong = [
+                Sale(pk=pk, total_amount=totals.get(pk, (0, 0))[0], item_count=totals.get(pk, (0, 0))[1])
+                for pk, total_amount, item_count in sales
+                if (total_amount, item_count) != totals.get(pk, (0, 0))
+            ]
+            if wrong and not options['check']:
+                with transaction.atomic():
+                    Sale.objects.bulk_update(wrong, ['total_amount', 'item_count'])
+            checked += len(sales)
+            wrong_sales += [sale.pk for sale in wrong]
+
+        if options['check'] and wrong_sales:
+            raise CommandError(f"{len(wrong_sales)} vente(s) sur {checked} ont des totaux incorrects : "
+                               + ', '.join(map(str, wrong_sales[:20])) + ('...' if len(wrong_sales) > 20 else ''))
+        if options['check']:
+            self.stdout.write(self.style.SUCCESS(f"{checked} vente(s) vérifiée(s), aucun écart."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{checked} vente(s) vérifiée(s), {len(wrong_sales)} corrigée(s)."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from manager.stock import take_stock_snapshots
+
+
+class Command(BaseCommand):
+    help = ("Enregistre un instantané du stock de chaque produit calculé à partir du registre des mouvements. "
+            "À lancer périodiquement (cron) pour borner le calcul du stock à une date donnée.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Nombre de produits traités par requête.")
+
+    def handle(self, *args, **options):
+        count = take_stock_snapshots(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"{count} instantané(s) de stock enregistré(s)."))
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.10 on 2026-10-18 17:53
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0017_remove_product_supplier_suppliying_product_suppliers'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='categorie_nom_upper_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='produit_nom_upper_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.10 on 2026-10-18 17:54
+
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+
+
+def backfill_sale_totals(apps, schema_editor):
+    Sale = apps.get_model('manager', 'Sale')
+    SaleItem = apps.get_model('manager', 'SaleItem')
+    totals = SaleItem.objects.values('sale').annotate(total_amount=Sum(F('sale_price') * F('quantity')),
+                                                      item_count=Count('id'))
+    sales = []
+    for row in totals:
+        sales.append(Sale(pk=row['sale'], total_amount=row['total_amount'] or 0, item_count=row['item_count']))
+    Sale.objects.bulk_update(sales, ['total_amount', 'item_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0018_product_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='item_count',
+            field=models.PositiveIntegerField(db_column="Nombre d'articles", default=0),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='total_amount',
+            field=models.PositiveIntegerField(db_column='Montant total', default=0),
+        ),
+        migrations.RunPython(backfill_sale_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 17:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0019_sale_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='barcode',
+            field=models.CharField(blank=True, db_column='Code-barres', max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-18 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0020_product_barcode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='idempotency_key',
+            field=models.CharField(blank=True, db_column="Clé d'idempotence", max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.10 on 2026-10-18 17:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def record_initial_stock(apps, schema_editor):
+    # Open the ledger with the current quantity of every product
+    Product = apps.get_model('manager', 'Product')
+    StockMovement = apps.get_model('manager', 'StockMovement')
+    movements = [
+        StockMovement(product_id=product_id, quantity=quantity, source_type='Ajustement')
+        for product_id, quantity in Product.objects.exclude(quantity=0).exclude(quantity=None).values_list(
+            'pk', 'quantity').iterator()
+    ]
+    StockMovement.objects.bulk_create(movements, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0021_sale_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(db_column='Quantité')),
+                ('last_movement_id', models.BigIntegerField(db_column='Dernier mouvement', default=0)),
+                ('taken_at', models.DateTimeField(db_column='Date')),
+                ('product', models.ForeignKey(db_column='Produit', on_delete=django.db.models.deletion.CASCADE, to='manager.product')),
+            ],
+            options={
+                'db_table': 'InstantanéStock',
+                'indexes': [models.Index(fields=['product', 'taken_at'], name='instantanestock_produit_date')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(db_column='Quantité')),
+                ('source_type', models.CharField(choices=[('Vente', 'Vente'), ('Commande', 'Commande'), ('Ajustement', 'Ajustement')], db_column='Type de source', max_length=20)),
+                ('source_id', models.PositiveBigIntegerField(blank=True, db_column='Source', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_column='Date')),
+                ('product', models.ForeignKey(db_column='Produit', on_delete=django.db.models.deletion.CASCADE, to='manager.product')),
+            ],
+            options={
+                'db_table': 'MouvementStock',
+                'indexes': [models.Index(fields=['product', 'created_at'], name='mouvementstock_produit_date'), models.Index(fields=['source_type', 'source_id'], name='mouvementstock_source')],
+            },
+        ),
+        migrations.RunPython(record_initial_stock, migrations.RunPython.noop),
+    ]
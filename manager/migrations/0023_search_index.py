@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from manager.search import SEARCH_TABLE, rebuild_search_index
+
+    # Accents are ignored and the 2 and 3 character prefixes are indexed for the search as you type
+    schema_editor.execute(
+        f'CREATE VIRTUAL TABLE "{SEARCH_TABLE}" USING fts5('
+        f'title, body, tokenize = "unicode61 remove_diacritics 2", prefix = \'2 3\')')
+    rebuild_search_index(apps=apps)
+
+
+def drop_search_index(apps, schema_editor):
+    from manager.search import SEARCH_TABLE
+
+    schema_editor.execute(f'DROP TABLE "{SEARCH_TABLE}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0022_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.10 on 2026-10-18 18:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0023_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='purchaseorder',
+            index=models.Index(fields=['order_date', 'id'], name='commande_date_id'),
+        ),
+        migrations.AddIndex(
+            model_name='repair',
+            index=models.Index(fields=['deposit_date', 'id'], name='reparation_date_id'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['sale_date', 'id'], name='vente_date_id'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.10 on 2026-10-18 18:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0024_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RowCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(db_column='Modèle', max_length=100)),
+                ('field', models.CharField(blank=True, db_column='Champ', default='', max_length=100)),
+                ('value', models.BigIntegerField(db_column='Valeur', default=0)),
+                ('count', models.BigIntegerField(db_column='Nombre', default=0)),
+            ],
+            options={
+                'db_table': 'CompteurLignes',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='rowcount',
+            constraint=models.UniqueConstraint(fields=('model', 'field', 'value'), name='compteurlignes_unique'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.10 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0025_row_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'quantity'], name='produit_categorie_quantite'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'initial_selling_price'], name='produit_categorie_prix'),
+        ),
+    ]
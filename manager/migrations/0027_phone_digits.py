@@ -0,0 +1,36 @@
+# Generated by Django 4.2.10 on 2026-10-18 18:22
+
+from django.db import migrations, models
+
+
+def backfill_phone_digits(apps, schema_editor):
+    from manager.phones import backfill_phone_digits
+
+    for model_name in ('Client', 'Supplier', 'Employee'):
+        backfill_phone_digits(apps.get_model('manager', model_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0026_product_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_column='Téléphone E164', db_index=True, editable=False, max_length=15, null=True),
+        ),
+        migrations.AddField(
+            model_name='employee',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_column='Téléphone E164', db_index=True, editable=False, max_length=15, null=True),
+        ),
+        migrations.AddField(
+            model_name='supplier',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_column='Téléphone E164', db_index=True, editable=False, max_length=15, null=True),
+        ),
+        migrations.RunPython(backfill_phone_digits, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.10 on 2026-10-18 18:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_client_summaries(apps, schema_editor):
+    from manager.summaries import rebuild_client_summaries
+
+    rebuild_client_summaries(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0027_phone_digits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientSummary',
+            fields=[
+                ('client', models.OneToOneField(db_column='Client', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='manager.client')),
+                ('sale_count', models.IntegerField(db_column='Nombre de ventes', default=0)),
+                ('total_spent', models.BigIntegerField(db_column='Total dépensé', default=0)),
+                ('repair_count', models.IntegerField(db_column='Nombre de réparations', default=0)),
+                ('outstanding_balance', models.BigIntegerField(db_column='Reste à payer', default=0)),
+                ('last_visit', models.DateField(blank=True, db_column='Dernière visite', null=True)),
+            ],
+            options={
+                'db_table': 'RésuméClient',
+                'indexes': [models.Index(fields=['-total_spent', 'client'], name='resumeclient_total_depense')],
+            },
+        ),
+        migrations.RunPython(build_client_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.10 on 2026-10-18 18:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+
+def build_rollups(apps, schema_editor):
+    from manager.rollups import rebuild_rollups
+
+    rebuild_rollups(apps=apps)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0028_client_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyProductRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_column='Date')),
+                ('quantity', models.IntegerField(db_column='Quantité', default=0)),
+                ('revenue', models.BigIntegerField(db_column="Chiffre d'affaires", default=0)),
+            ],
+            options={
+                'db_table': 'CumulJournalierProduits',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_column='Date', unique=True)),
+                ('sale_count', models.IntegerField(db_column='Nombre de ventes', default=0)),
+                ('revenue', models.BigIntegerField(db_column="Chiffre d'affaires", default=0)),
+                ('repair_count', models.IntegerField(db_column='Réparations livrées', default=0)),
+                ('repair_revenue', models.BigIntegerField(db_column="Chiffre d'affaires réparations", default=0)),
+            ],
+            options={
+                'db_table': 'CumulJournalierVentes',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['quantity'], name='produit_quantite'),
+        ),
+        migrations.AddIndex(
+            model_name='repair',
+            index=models.Index(fields=['delivery_date'], name='reparation_date_remise'),
+        ),
+        migrations.AddField(
+            model_name='dailyproductrollup',
+            name='product',
+            field=models.ForeignKey(db_column='Produit', on_delete=django.db.models.deletion.CASCADE, to='manager.product'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyproductrollup',
+            constraint=models.UniqueConstraint(fields=('date', 'product'), name='cumuljournalierproduits_unique'),
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.10 on 2026-10-18 18:55
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0029_daily_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sale',
+            name='sale_date',
+            field=models.DateField(db_column='Date de vente', default=datetime.date.today, editable=False),
+        ),
+    ]
@@ -1,9 +1,12 @@
+import datetime
+
 from django.core.validators import MinValueValidator
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from phonenumber_field.modelfields import PhoneNumberField
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Upper
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import Group, Permission
 
@@ -59,6 +62,9 @@ def update_account_groups(sender, instance, created, **kwargs):
 class Supplier(models.Model):
     name = models.CharField(max_length=100, db_column='Nom')
     phone = PhoneNumberField(unique=True, region='DZ', db_column='Téléphone')
+    # Digits of the E.164 form of phone, kept up to date on save, to look the number up whatever its format
+    phone_digits = models.CharField(max_length=15, null=True, blank=True, editable=False, db_index=True,
+                                    db_column='Téléphone E164')
     email = models.EmailField(unique=True, db_column='Email')
     address = models.TextField(db_column='Adresse')
 
@@ -73,6 +79,9 @@ class Client(models.Model):
     first_name = models.CharField(max_length=100, db_column='Prénom')
     last_name = models.CharField(max_length=100, db_column='Nom')
     phone = PhoneNumberField(unique=True, region='DZ', db_column='Téléphone')
+    # Digits of the E.164 form of phone, kept up to date on save, to look the number up whatever its format
+    phone_digits = models.CharField(max_length=15, null=True, blank=True, editable=False, db_index=True,
+                                    db_column='Téléphone E164')
     email = models.EmailField(unique=True, db_column='Email')
     address = models.TextField(db_column='Adresse')
 
@@ -92,6 +101,10 @@ class Category(models.Model):
 
     class Meta:
         db_table = 'Catégorie'
+        indexes = [
+            # Case insensitive prefix search of the product typeahead
+            models.Index(Upper('name'), name='categorie_nom_upper_idx'),
+        ]
 
 
 class Product(models.Model):
@@ -102,6 +115,8 @@ class Product(models.Model):
     # ]
 
     name = models.CharField(max_length=100, db_column='Nom', unique=True)
+    # Barcode / SKU read by the scanner at checkout, unique hence indexed
+    barcode = models.CharField(max_length=64, unique=True, null=True, blank=True, db_column='Code-barres')
     category = models.ForeignKey(Category, on_delete=models.SET_DEFAULT, default=1, db_column='Catégorie')
     description = models.TextField(db_column='Description', default='Pas de description')
     # state = models.CharField(max_length=20, choices=STATE_CHOICES, default='En vente', db_column='État')
@@ -122,6 +137,15 @@ class Product(models.Model):
     class Meta:
         db_table = 'Produit'
         verbose_name = _('Produit')
+        indexes = [
+            # Case insensitive prefix search of the product typeahead
+            models.Index(Upper('name'), name='produit_nom_upper_idx'),
+            # Filters of the stock-room list within a category, by stock level and by price
+            models.Index(fields=['category', 'quantity'], name='produit_categorie_quantite'),
+            models.Index(fields=['category', 'initial_selling_price'], name='produit_categorie_prix'),
+            # Low stock alerts of the dashboard
+            models.Index(fields=['quantity'], name='produit_quantite'),
+        ]
 
 class Suppliying(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, db_column='Produit')
@@ -148,6 +172,10 @@ class PurchaseOrder(models.Model):
 
     class Meta:
         db_table = 'Commande'
+        # Order of the keyset pagination of the list
+        indexes = [
+            models.Index(fields=['order_date', 'id'], name='commande_date_id'),
+        ]
 
 
 class PurchaseOrderItem(models.Model):
@@ -168,7 +196,14 @@ class PurchaseOrderItem(models.Model):
 
 class Sale(models.Model):
     client = models.ForeignKey(Client, on_delete=models.SET_NULL, null=True, blank=True, db_column='Client')
-    sale_date = models.DateField(auto_now_add=True, db_column='Date de vente')
+    # Today by default, the day the sale was rung up for the sales synchronised later by a terminal
+    sale_date = models.DateField(default=datetime.date.today, editable=False, db_column='Date de vente')
+    # Kept up to date by manager.stock whenever the lines of the sale change
+    total_amount = models.PositiveIntegerField(default=0, db_column='Montant total')
+    item_count = models.PositiveIntegerField(default=0, db_column='Nombre d\'articles')
+    # Key generated by the store terminal that recorded the sale offline, makes the synchronisation idempotent
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True,
+                                       db_column='Clé d\'idempotence')
 
     # Other fields...
 
@@ -182,15 +217,19 @@ class Sale(models.Model):
 
     class Meta:
         db_table = 'Vente'
+        # Order of the keyset pagination of the list
+        indexes = [
+            models.Index(fields=['sale_date', 'id'], name='vente_date_id'),
+        ]
 
     def delete_sale(self, update_product_quantity=False):
-        # Get the related SaleItem instances
-        sale_items = self.saleitem_set.all()
+        from .stock import delete_sale_items
 
-        # Iterate over the SaleItem instances
-        for sale_item in sale_items:
-            # Delete the SaleItem with updating the product quantity
-            sale_item.delete(update_product_quantity=update_product_quantity)
+        # Delete the SaleItem instances, updating the product quantities in a single query
+        delete_sale_items(self, update_product_quantity=update_product_quantity)
+        # The stored totals were brought to 0 with the lines
+        self.total_amount = 0
+        self.item_count = 0
 
         # Delete the Sale instance
         super().delete()
@@ -212,32 +251,124 @@ class SaleItem(models.Model):
         #unique_together = ('sale', 'product')
 
     def save(self, *args, **kwargs):
-        # If the SaleItem already exists in the database
-        if self.pk:
-            # Get the old SaleItem from the database
-            old_sale_item = SaleItem.objects.get(pk=self.pk)
-
-            # If the quantity has been updated
-            if old_sale_item.quantity != self.quantity:
-                # Update the product's quantity
-                self.product.quantity += old_sale_item.quantity - self.quantity
-                self.product.save()
+        from .stock import SaleItemChanges, read_sale_items
 
-        else:  # If the SaleItem is new
-            self.product.refresh_from_db()
-            # Decrease the product's quantity
-            self.product.quantity -= self.quantity
-            self.product.save()
+        with transaction.atomic():
+            changes = SaleItemChanges()
+            # If the SaleItem already exists in the database, put back the stored quantity and amount
+            if self.pk:
+                old_sale_item = read_sale_items([self.pk]).get(self.pk)
+                if old_sale_item:
+                    changes.remove(*old_sale_item)
+            # Decrease the product's quantity and add the line to the sale totals
+            changes.add(self.sale_id, self.product_id, self.quantity, self.sale_price)
+            changes.apply()
 
-        super().save(*args, **kwargs)
+            super().save(*args, **kwargs)
 
     def delete(self, update_product_quantity=True, *args, **kwargs):
-        if update_product_quantity:
-            # Increase the product's quantity
-            self.product.quantity += self.quantity
-            self.product.save()
+        from .stock import SaleItemChanges
+
+        with transaction.atomic():
+            changes = SaleItemChanges()
+            changes.remove(self.sale_id, self.product_id, self.quantity, self.sale_price)
+            if not update_product_quantity:
+                changes.stock_deltas.clear()
+            # Increase the product's quantity and remove the line from the sale totals
+            changes.apply()
+
+            return super().delete(*args, **kwargs)
+
+
+class StockMovement(models.Model):
+    """Append-only ledger of every change of Product.quantity, with the document that caused it."""
+    SOURCE_CHOICES = [
+        ('Vente', 'Vente'),
+        ('Commande', 'Commande'),
+        ('Ajustement', 'Ajustement'),
+    ]
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_column='Produit')
+    quantity = models.IntegerField(db_column='Quantité')  # Signed, negative when the stock decreases
+    source_type = models.CharField(max_length=20, choices=SOURCE_CHOICES, db_column='Type de source')
+    source_id = models.PositiveBigIntegerField(null=True, blank=True, db_column='Source')
+    created_at = models.DateTimeField(auto_now_add=True, db_column='Date')
+
+    def __str__(self):
+        return f"Stock Movement #{self.pk} - Product: {self.product_id}, Quantity: {self.quantity}"
+
+    class Meta:
+        db_table = 'MouvementStock'
+        indexes = [
+            models.Index(fields=['product', 'created_at'], name='mouvementstock_produit_date'),
+            models.Index(fields=['source_type', 'source_id'], name='mouvementstock_source'),
+        ]
+
+
+class StockSnapshot(models.Model):
+    """Quantity of a product computed from the ledger, up to and including last_movement_id."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_column='Produit')
+    quantity = models.IntegerField(db_column='Quantité')
+    last_movement_id = models.BigIntegerField(default=0, db_column='Dernier mouvement')
+    taken_at = models.DateTimeField(db_column='Date')
+
+    def __str__(self):
+        return f"Stock Snapshot #{self.pk} - Product: {self.product_id}, Quantity: {self.quantity}"
 
-        super().delete(*args, **kwargs)
+    class Meta:
+        db_table = 'InstantanéStock'
+        indexes = [
+            models.Index(fields=['product', 'taken_at'], name='instantanestock_produit_date'),
+        ]
+
+
+class RowCount(models.Model):
+    """Number of rows of a model, or of the rows whose field equals value, kept up to date by manager.counts."""
+    model = models.CharField(max_length=100, db_column='Modèle')
+    # Empty for the total of the model
+    field = models.CharField(max_length=100, blank=True, default='', db_column='Champ')
+    value = models.BigIntegerField(default=0, db_column='Valeur')
+    count = models.BigIntegerField(default=0, db_column='Nombre')
+
+    def __str__(self):
+        return f"Row Count - {self.model} {self.field}={self.value}: {self.count}"
+
+    class Meta:
+        db_table = 'CompteurLignes'
+        constraints = [
+            models.UniqueConstraint(fields=['model', 'field', 'value'], name='compteurlignes_unique'),
+        ]
+
+
+class DailySalesRollup(models.Model):
+    """Sales and delivered repairs of a day, kept up to date by manager.rollups for the dashboard."""
+    date = models.DateField(unique=True, db_column='Date')
+    sale_count = models.IntegerField(default=0, db_column='Nombre de ventes')
+    revenue = models.BigIntegerField(default=0, db_column='Chiffre d\'affaires')
+    repair_count = models.IntegerField(default=0, db_column='Réparations livrées')
+    repair_revenue = models.BigIntegerField(default=0, db_column='Chiffre d\'affaires réparations')
+
+    def __str__(self):
+        return f"Daily Sales Rollup - {self.date}: {self.sale_count} sales, {self.revenue}"
+
+    class Meta:
+        db_table = 'CumulJournalierVentes'
+
+
+class DailyProductRollup(models.Model):
+    """Quantity and revenue of the sales of a product on a day, kept up to date by manager.rollups."""
+    date = models.DateField(db_column='Date')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_column='Produit')
+    quantity = models.IntegerField(default=0, db_column='Quantité')
+    revenue = models.BigIntegerField(default=0, db_column='Chiffre d\'affaires')
+
+    def __str__(self):
+        return f"Daily Product Rollup - {self.date}, Product: {self.product_id}: {self.quantity}"
+
+    class Meta:
+        db_table = 'CumulJournalierProduits'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'product'], name='cumuljournalierproduits_unique'),
+        ]
 
 
 class Repair(models.Model):
@@ -262,12 +393,43 @@ class Repair(models.Model):
 
     class Meta:
         db_table = 'Réparation'
+        indexes = [
+            # Order of the keyset pagination of the list
+            models.Index(fields=['deposit_date', 'id'], name='reparation_date_id'),
+            # Open repairs of the dashboard, and repairs delivered on a day
+            models.Index(fields=['delivery_date'], name='reparation_date_remise'),
+        ]
+
+
+class ClientSummary(models.Model):
+    """Lifetime figures of a client, kept up to date by manager.summaries when its sales and repairs change."""
+    client = models.OneToOneField(Client, on_delete=models.CASCADE, primary_key=True, related_name='summary',
+                                  db_column='Client')
+    sale_count = models.IntegerField(default=0, db_column='Nombre de ventes')
+    total_spent = models.BigIntegerField(default=0, db_column='Total dépensé')
+    repair_count = models.IntegerField(default=0, db_column='Nombre de réparations')
+    # Price left to pay of the repairs not delivered yet
+    outstanding_balance = models.BigIntegerField(default=0, db_column='Reste à payer')
+    last_visit = models.DateField(null=True, blank=True, db_column='Dernière visite')
+
+    def __str__(self):
+        return f"Client Summary - Client: {self.client_id}, Sales: {self.sale_count}, Spent: {self.total_spent}"
+
+    class Meta:
+        db_table = 'RésuméClient'
+        indexes = [
+            # Order of the top clients list
+            models.Index(fields=['-total_spent', 'client'], name='resumeclient_total_depense'),
+        ]
 
 
 class Employee(models.Model):
     first_name = models.CharField(max_length=100, db_column='Prénom')
     last_name = models.CharField(max_length=100, db_column='Nom')
     phone = PhoneNumberField(unique=True, region='DZ', db_column='Téléphone')
+    # Digits of the E.164 form of phone, kept up to date on save, to look the number up whatever its format
+    phone_digits = models.CharField(max_length=15, null=True, blank=True, editable=False, db_index=True,
+                                    db_column='Téléphone E164')
     email = models.EmailField(unique=True, db_column='Email')
     address = models.TextField(db_column='Adresse')
     ROLES_CHOICES = [
@@ -311,3 +473,132 @@ class HardwareToRepair(models.Model):
 
     class Meta:
         db_table = 'MatérielARéparer'
+
+
+# Signals to drop the cached PDFs of a document when it changes. The cache is addressed by
+# the content of the documents, so stale files are never served, this only frees the disk.
+def _invalidate_pdf_cache(document, pk):
+    from .pdf import invalidate_pdf_cache
+    transaction.on_commit(lambda: invalidate_pdf_cache(document, pk))
+
+
+@receiver([post_save, post_delete], sender=Sale)
+@receiver([post_save, post_delete], sender=SaleItem)
+def invalidate_sale_pdf(sender, instance, **kwargs):
+    _invalidate_pdf_cache('vente', instance.pk if sender is Sale else instance.sale_id)
+
+
+@receiver([post_save, post_delete], sender=PurchaseOrder)
+@receiver([post_save, post_delete], sender=PurchaseOrderItem)
+def invalidate_purchase_order_pdf(sender, instance, **kwargs):
+    _invalidate_pdf_cache('commande', instance.pk if sender is PurchaseOrder else instance.purchase_order_id)
+
+
+@receiver([post_save, post_delete], sender=Repair)
+def invalidate_repair_pdf(sender, instance, **kwargs):
+    _invalidate_pdf_cache('reparation', instance.pk)
+
+
+# Signals to keep the full-text search index (manager.search) in the transaction of the changes
+def _search():
+    from . import search
+    return search
+
+
+@receiver(post_save, sender=Client)
+@receiver(post_save, sender=Supplier)
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Repair)
+@receiver(post_save, sender=HardwareToRepair)
+def index_searchable_object(sender, instance, **kwargs):
+    search = _search()
+    search.index_objects(search.KINDS_BY_MODEL[sender], [instance])
+    # The name of the client and of the category are indexed with the repairs and the products
+    if sender is Client and not kwargs['created']:
+        search.index_objects(search.KINDS_BY_MODEL[Repair], instance.repair_set.select_related('client'))
+
+
+@receiver(post_save, sender=Category)
+def index_category_products(sender, instance, created, **kwargs):
+    if not created:
+        search = _search()
+        search.index_objects(search.KINDS_BY_MODEL[Product], instance.product_set.select_related('category'))
+
+
+@receiver(post_delete, sender=Client)
+@receiver(post_delete, sender=Supplier)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Repair)
+@receiver(post_delete, sender=HardwareToRepair)
+def unindex_searchable_object(sender, instance, **kwargs):
+    _search().unindex_object(sender, instance.pk)
+
+
+# Signals to keep the row counts of the paginated lists (manager.counts) up to date
+@receiver(post_save)
+def count_created_row(sender, instance, created, raw=False, **kwargs):
+    from .counts import COUNTED_FIELDS, adjust_row_counts
+    if created and not raw and sender in COUNTED_FIELDS:
+        adjust_row_counts(sender, [instance], 1)
+
+
+@receiver(post_delete)
+def count_deleted_row(sender, instance, **kwargs):
+    from .counts import COUNTED_FIELDS, adjust_row_counts
+    if sender in COUNTED_FIELDS:
+        adjust_row_counts(sender, [instance], -1)
+
+
+@receiver(pre_save, sender=Client)
+@receiver(pre_save, sender=Supplier)
+@receiver(pre_save, sender=Employee)
+def normalize_phone(sender, instance, **kwargs):
+    from .phones import phone_digits
+    instance.phone_digits = phone_digits(instance.phone)
+
+
+# Signals to keep the client summaries (manager.summaries) up to date
+@receiver(post_save, sender=Sale)
+def summarize_created_sale(sender, instance, created, raw=False, **kwargs):
+    from .rollups import adjust_daily_sales
+    from .summaries import adjust_client_sales
+    if created and not raw:
+        if instance.client_id:
+            adjust_client_sales({instance.client_id: (1, instance.total_amount, instance.sale_date)})
+        adjust_daily_sales({instance.sale_date: (1, instance.total_amount)})
+
+
+@receiver(post_delete, sender=Sale)
+def summarize_deleted_sale(sender, instance, **kwargs):
+    from .rollups import adjust_daily_sales
+    from .summaries import adjust_client_sales
+    if instance.client_id:
+        adjust_client_sales({instance.client_id: (-1, -instance.total_amount, None)})
+    adjust_daily_sales({instance.sale_date: (-1, -instance.total_amount)})
+
+
+@receiver(pre_delete, sender=Product)
+def remove_deleted_product_from_sales(sender, instance, **kwargs):
+    # The sale lines of the product are deleted by the cascade, without going through SaleItem.delete()
+    from .stock import remove_product_from_sales
+    remove_product_from_sales(instance)
+
+
+@receiver(pre_save, sender=Repair)
+def remember_repair_state(sender, instance, **kwargs):
+    # The previous client and delivery day of a repair have their figures refreshed too
+    instance._previous_state = (None, None)
+    if instance.pk:
+        instance._previous_state = Repair.objects.filter(pk=instance.pk).values_list(
+            'client_id', 'delivery_date').first() or (None, None)
+
+
+@receiver(post_save, sender=Repair)
+@receiver(post_delete, sender=Repair)
+def summarize_repair(sender, instance, raw=False, **kwargs):
+    from .rollups import refresh_daily_repairs
+    from .summaries import refresh_client_repairs
+    if not raw:
+        previous_client_id, previous_delivery_date = getattr(instance, '_previous_state', (None, None))
+        refresh_client_repairs({instance.client_id, previous_client_id})
+        refresh_daily_repairs({instance.delivery_date, previous_delivery_date})
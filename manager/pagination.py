@@ -0,0 +1,140 @@
+import base64
+import json
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+# Directions of a cursor: the rows after its position, or the rows before it
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+def encode_cursor(direction, values):
+    data = json.dumps([direction, values], cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (direction, values) of a cursor, or None if it is malformed."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(data)
+    except (ValueError, TypeError):
+        return None
+    if direction not in (NEXT, PREVIOUS) or not (values is None or isinstance(values, list)):
+        return None
+    return direction, values
+
+
+class KeysetPage:
+    """A page of a KeysetPaginator, with the cursors of the pages around it."""
+
+    def __init__(self, object_list, has_next, has_previous, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+
+class KeysetPaginator:
+    """Paginate a queryset by the values of its ordering columns instead of an offset.
+
+    ordering is a list of field names, prefixed by '-' for a descending order, ending by
+    a unique field (usually the pk) so that every row has a distinct position. A page is
+    read with a single query, WHERE (ordering) after the cursor ... LIMIT per_page + 1,
+    which the database answers from an index on the ordering columns: the last pages cost
+    the same as the first one, and the rows are never counted.
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.fields = []
+        opts = queryset.model._meta
+        for name in ordering:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+            self.fields.append((name, field, descending))
+
+    def _order_by(self, reverse):
+        return [f'-{name}' if descending != reverse else name for name, field, descending in self.fields]
+
+    def _position(self, obj):
+        # obj is a model instance, or a dict of a values() queryset
+        if isinstance(obj, dict):
+            return [obj[field.name] for name, field, descending in self.fields]
+        return [getattr(obj, field.attname) for name, field, descending in self.fields]
+
+    def _after(self, values, reverse):
+        # (a, b, c) > (x, y, z) written as a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        conditions = []
+        for i, (name, field, descending) in enumerate(self.fields):
+            lookup = 'lt' if descending != reverse else 'gt'
+            equal = {self.fields[j][0]: values[j] for j in range(i)}
+            conditions.append(Q(**equal, **{f'{name}__{lookup}': values[i]}))
+        return reduce(lambda a, b: a | b, conditions)
+
+    def _parse(self, cursor):
+        decoded = decode_cursor(cursor) if cursor else None
+        if decoded is None:
+            return NEXT, None
+        direction, values = decoded
+        if values is None:
+            return direction, None
+        if len(values) != len(self.fields):
+            return NEXT, None
+        try:
+            return direction, [field.to_python(value) for (name, field, descending), value in zip(self.fields, values)]
+        except ValidationError:
+            return NEXT, None
+
+    def page(self, cursor=None):
+        """Return the page at a cursor, the first page when there is no cursor or it is invalid.
+
+        A PREVIOUS cursor without position is the last page.
+        """
+        direction, values = self._parse(cursor)
+        reverse = direction == PREVIOUS
+        queryset = self.queryset.order_by(*self._order_by(reverse))
+        if values is not None:
+            queryset = queryset.filter(self._after(values, reverse))
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = values is not None, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+        return KeysetPage(
+            rows, has_next, has_previous,
+            encode_cursor(NEXT, self._position(rows[-1])) if has_next and rows else None,
+            encode_cursor(PREVIOUS, self._position(rows[0])) if has_previous and rows else None,
+        )
+
+    @staticmethod
+    def first_cursor():
+        return encode_cursor(NEXT, None)
+
+    @staticmethod
+    def last_cursor():
+        return encode_cursor(PREVIOUS, None)
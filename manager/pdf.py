@@ -0,0 +1,384 @@
+import glob
+import hashlib
+import json
+import mimetypes
+import multiprocessing
+import os
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import unquote, urlsplit
+
+from django.apps import apps
+from django.conf import settings
+from django.template.loader import render_to_string
+from weasyprint import CSS, HTML, default_url_fetcher
+from weasyprint.text.fonts import FontConfiguration
+
+# Both directories live under PDF_ROOT.
+# jobs: one set of files per background job, <id>.json (metadata), then <id>.done once the PDF is written
+# or <id>.error if the rendering failed
+# cache: rendered documents, <document>-<pk>-<hash of the html>.pdf
+JOBS_DIR = 'jobs'
+CACHE_DIR = 'cache'
+
+# Relative URLs of the documents, like the {% static %} ones, are resolved against this URL
+BASE_URL = 'file:///'
+
+_executor = None
+# Rendering state kept warm for the life of the process (a worker or the web server process)
+_renderer = None
+
+
+class Renderer:
+    """WeasyPrint settings shared by every document rendered in a process.
+
+    The stylesheets are parsed and the fonts configured once, and the static files
+    are read from the disk instead of being fetched from the web server.
+    """
+
+    def __init__(self, static_url, static_dirs, stylesheets):
+        self.static_prefix = '/' + static_url.strip('/') + '/'
+        self.static_dirs = [os.path.realpath(path) for path in static_dirs]
+        self.font_config = FontConfiguration()
+        self.stylesheets = [CSS(filename=path, url_fetcher=self.url_fetcher, font_config=self.font_config)
+                            for path in stylesheets]
+
+    def find_static(self, name):
+        for static_dir in self.static_dirs:
+            path = os.path.realpath(os.path.join(static_dir, name))
+            if path.startswith(static_dir + os.sep) and os.path.isfile(path):
+                return path
+        return None
+
+    def url_fetcher(self, url):
+        url_path = unquote(urlsplit(url).path)
+        if url_path.startswith(self.static_prefix):
+            path = self.find_static(url_path[len(self.static_prefix):])
+            if path is not None:
+                with open(path, 'rb') as f:
+                    return {'string': f.read(), 'mime_type': mimetypes.guess_type(path)[0], 'filename': path}
+        return default_url_fetcher(url)
+
+    def write_pdf(self, html_string, target):
+        HTML(string=html_string, base_url=BASE_URL, url_fetcher=self.url_fetcher).write_pdf(
+            target=target, stylesheets=self.stylesheets, font_config=self.font_config)
+
+    def write_merged_pdf(self, html_strings, target):
+        """Render several documents, one after the other, in a single PDF."""
+        documents = [HTML(string=html_string, base_url=BASE_URL, url_fetcher=self.url_fetcher).render(
+            stylesheets=self.stylesheets, font_config=self.font_config) for html_string in html_strings]
+        pages = [page for document in documents for page in document.pages]
+        documents[0].copy(pages).write_pdf(target=target)
+
+
+def get_renderer_config():
+    """Arguments of the Renderer, read from the Django settings so that workers do not need them."""
+    static_dirs = [path[1] if isinstance(path, (list, tuple)) else path for path in settings.STATICFILES_DIRS]
+    static_dirs += [os.path.join(app_config.path, 'static') for app_config in apps.get_app_configs()]
+    static_dirs = list(dict.fromkeys(str(path) for path in static_dirs if os.path.isdir(path)))
+    stylesheets = [os.path.join(settings.BASE_DIR, path) for path in settings.PDF_STYLESHEETS]
+    return settings.STATIC_URL, static_dirs, stylesheets
+
+
+def init_renderer(static_url, static_dirs, stylesheets):
+    global _renderer
+    _renderer = Renderer(static_url, static_dirs, stylesheets)
+
+
+def get_renderer():
+    if _renderer is None:
+        init_renderer(*get_renderer_config())
+    return _renderer
+
+
+def get_pdf_dir(name):
+    path = os.path.join(settings.PDF_ROOT, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _write_atomically(write, path, error_path, done_path):
+    # The file only appears once complete, under its final name
+    partial_path = f'{path}.{uuid.uuid4().hex}.part'
+    try:
+        write(partial_path)
+        os.replace(partial_path, path)
+        if done_path is not None:
+            # The PDF may be evicted from the cache later, the job stays finished
+            open(done_path, 'w').close()
+    except Exception as e:
+        if error_path is not None:
+            with open(error_path, 'w') as f:
+                f.write(repr(e))
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+
+def write_pdf(html_string, path, error_path=None, done_path=None):
+    """Render an HTML string to a PDF file."""
+    _write_atomically(lambda target: get_renderer().write_pdf(html_string, target), path, error_path, done_path)
+
+
+def write_merged_pdf(html_strings, path, error_path=None, done_path=None):
+    """Render several HTML strings to a single PDF file."""
+    _write_atomically(lambda target: get_renderer().write_merged_pdf(html_strings, target), path, error_path,
+                      done_path)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # Spawned workers only need WeasyPrint, and forking a threaded server is unsafe.
+        # Each worker prepares its Renderer once, when it starts.
+        _executor = ProcessPoolExecutor(max_workers=settings.PDF_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=init_renderer, initargs=get_renderer_config())
+    return _executor
+
+
+def submit_rendering(function, *args):
+    """Submit a rendering to the worker pool and return its future.
+
+    A worker that dies (a crash, or killed for its memory) breaks the whole pool, which
+    then refuses every submission: the broken pool is replaced and the rendering submitted
+    once more.
+    """
+    global _executor
+    try:
+        return get_executor().submit(function, *args)
+    except BrokenProcessPool:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+        return get_executor().submit(function, *args)
+
+
+def _job_done(future, error_path):
+    # A worker killed in the middle of a render never writes its error file
+    if future.exception() is not None and not os.path.exists(error_path):
+        with open(error_path, 'w') as f:
+            f.write(repr(future.exception()))
+
+
+def purge_jobs(max_age=None):
+    """Delete the files of the jobs older than max_age seconds."""
+    max_age = settings.PDF_JOB_MAX_AGE if max_age is None else max_age
+    limit = time.time() - max_age
+    with os.scandir(get_pdf_dir(JOBS_DIR)) as entries:
+        for entry in entries:
+            if entry.stat().st_mtime < limit:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class CachedPdf:
+    """A rendered document of the cache, addressed by the hash of its HTML."""
+
+    def __init__(self, document, pk, html_string):
+        self.key = hashlib.sha256(
+            f'{settings.PDF_TEMPLATE_VERSION}\0'.encode() + html_string.encode()).hexdigest()
+        self.path = os.path.join(get_pdf_dir(CACHE_DIR), f'{document}-{pk}-{self.key}.pdf')
+
+    def touch(self):
+        """Mark the document as used for the LRU eviction, return False if it is not cached."""
+        try:
+            stat = os.stat(self.path)
+            # The access time orders the eviction, the modification time stays the Last-Modified date
+            os.utime(self.path, (time.time(), stat.st_mtime))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def evict_pdf_cache(max_size=None):
+    """Delete the least recently used documents until the cache fits in max_size bytes."""
+    max_size = settings.PDF_CACHE_MAX_SIZE if max_size is None else max_size
+    with os.scandir(get_pdf_dir(CACHE_DIR)) as entries:
+        files = [(entry.stat().st_atime, entry.stat().st_size, entry.path) for entry in entries
+                 if entry.name.endswith('.pdf')]
+    size = sum(file_size for atime, file_size, path in files)
+    for atime, file_size, path in sorted(files):
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        size -= file_size
+
+
+def invalidate_pdf_cache(document, pk):
+    """Delete the cached renderings of a document, stale entries are never served but take disk space."""
+    for path in glob.glob(os.path.join(get_pdf_dir(CACHE_DIR), f'{document}-{pk}-*.pdf')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def render_pdf(template_name, context, document, pk, filename):
+    """Return the cached rendering of a document, or queue its rendering.
+
+    The template is rendered to HTML in the calling process, where the database is
+    available, and the HTML is hashed to find the document in the cache. On a miss only
+    the HTML string is sent to the worker pool, which writes the PDF in the cache. With
+    PDF_WORKERS set to 0 the PDF is rendered immediately, in the calling process.
+
+    Return a (CachedPdf, job_id) tuple, job_id is None when the document was cached.
+    """
+    html_string = render_to_string(template_name, context)
+    cached_pdf = CachedPdf(document, pk, html_string)
+    if cached_pdf.touch():
+        return cached_pdf, None
+
+    return cached_pdf, _submit_job(write_pdf, html_string, cached_pdf.path, cached_pdf.key, filename)
+
+
+def render_merged_pdf(html_strings, filename):
+    """Queue the rendering of several documents in a single PDF and return the job id."""
+    job_id = uuid.uuid4().hex
+    path = os.path.join(get_pdf_dir(JOBS_DIR), f'{job_id}.pdf')
+    return _submit_job(write_merged_pdf, html_strings, path, job_id, filename, job_id)
+
+
+def _submit_job(function, html, path, key, filename, job_id=None):
+    job_id = job_id or uuid.uuid4().hex
+    jobs_dir = get_pdf_dir(JOBS_DIR)
+    purge_jobs()
+    evict_pdf_cache()
+    with open(os.path.join(jobs_dir, f'{job_id}.json'), 'w') as f:
+        json.dump({'filename': filename, 'path': path, 'key': key}, f)
+
+    error_path = os.path.join(jobs_dir, f'{job_id}.error')
+    done_path = os.path.join(jobs_dir, f'{job_id}.done')
+    if settings.PDF_WORKERS:
+        future = submit_rendering(function, html, path, error_path, done_path)
+        future.add_done_callback(lambda future: _job_done(future, error_path))
+    else:
+        try:
+            function(html, path, error_path, done_path)
+        except Exception:
+            pass  # Reported by the job status
+    return job_id
+
+
+def _open_rendered(html_string, path, future):
+    # The cache may be evicted or invalidated by another request once the rendering is done,
+    # the PDF is rendered again in this process if it was deleted before being opened
+    if future is not None:
+        try:
+            future.result()
+        except BrokenProcessPool:
+            # A worker died while this document was pending, it is rendered by the new pool
+            submit_rendering(write_pdf, html_string, path).result()
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        write_pdf(html_string, path)
+        return open(path, 'rb')
+
+
+def iter_pdf_files(documents):
+    """Render documents in parallel and yield their (filename, open file), in order.
+
+    documents is an iterable of (template_name, context, document, pk, filename), it
+    is consumed lazily and only a few renderings are pending at any time, so the
+    memory used does not depend on the number of documents. The PDFs are written in
+    the cache, the ones already there are not rendered again, and the cache is evicted
+    once the export is over. The files are opened before being yielded so that they
+    can still be read if they are deleted from the cache, the caller closes them.
+    """
+    pending = deque()
+    window = max(settings.PDF_WORKERS, 1) * 2
+    try:
+        for template_name, context, document, pk, filename in documents:
+            html_string = render_to_string(template_name, context)
+            cached_pdf = CachedPdf(document, pk, html_string)
+            future = None
+            if not cached_pdf.touch():
+                if settings.PDF_WORKERS:
+                    future = submit_rendering(write_pdf, html_string, cached_pdf.path)
+                else:
+                    write_pdf(html_string, cached_pdf.path)
+            pending.append((filename, html_string, cached_pdf.path, future))
+            while len(pending) >= window or (pending and (pending[0][3] is None or pending[0][3].done())):
+                filename, html_string, path, future = pending.popleft()
+                yield filename, _open_rendered(html_string, path, future)
+        while pending:
+            filename, html_string, path, future = pending.popleft()
+            yield filename, _open_rendered(html_string, path, future)
+    finally:
+        evict_pdf_cache()
+
+
+class _ZipStream:
+    # Write-only file object, the bytes written by ZipFile are collected until read
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read_written(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zip_pdf_files(files, chunk_size=64 * 1024):
+    """Yield, chunk by chunk, a ZIP archive of the (filename, open file) files, closing them."""
+    stream = _ZipStream()
+    # The PDFs are already compressed
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for filename, source in files:
+            with source, archive.open(filename, 'w') as target:
+                while chunk := source.read(chunk_size):
+                    target.write(chunk)
+                    yield stream.read_written()
+            yield stream.read_written()
+    yield stream.read_written()
+
+
+class PdfJob:
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    # Finished, but the PDF was evicted from the cache or invalidated since
+    EXPIRED = 'expired'
+
+    def __init__(self, job_id):
+        jobs_dir = get_pdf_dir(JOBS_DIR)
+        self.id = job_id
+        with open(os.path.join(jobs_dir, f'{job_id}.json')) as f:
+            metadata = json.load(f)
+        self.filename = metadata['filename']
+        self.path = metadata['path']
+        self.key = metadata['key']
+        if os.path.exists(self.path):
+            self.status = self.DONE
+        elif os.path.exists(os.path.join(jobs_dir, f'{job_id}.done')):
+            self.status = self.EXPIRED
+        elif os.path.exists(os.path.join(jobs_dir, f'{job_id}.error')):
+            self.status = self.FAILED
+        else:
+            self.status = self.PENDING
+
+
+def get_job(job_id):
+    """Return the PdfJob with this id, or None if it does not exist (or was purged)."""
+    try:
+        uuid.UUID(hex=job_id)
+        return PdfJob(job_id)
+    except (ValueError, FileNotFoundError):
+        return None
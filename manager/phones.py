@@ -0,0 +1,40 @@
+import phonenumbers
+from django.conf import settings
+
+
+def phone_digits(value, region=None):
+    """Digits of the E.164 form of a phone number written in any format, or None if it is not a number.
+
+    Numbers without country code are read as numbers of region, PHONENUMBER_DEFAULT_REGION by default.
+    """
+    if not value:
+        return None
+    try:
+        number = value if isinstance(value, phonenumbers.PhoneNumber) else phonenumbers.parse(
+            str(value), region or settings.PHONENUMBER_DEFAULT_REGION)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_possible_number(number):
+        return None
+    return phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164).lstrip('+')
+
+
+def backfill_phone_digits(model, chunk_size=1000):
+    """Fill the phone_digits column of every row of model, chunk by chunk, and return the number of changed rows.
+
+    model can be the historical model of a migration.
+    """
+    count = 0
+    last_pk = 0
+    queryset = model._default_manager.order_by('pk').only('pk', 'phone', 'phone_digits')
+    while chunk := list(queryset.filter(pk__gt=last_pk)[:chunk_size]):
+        last_pk = chunk[-1].pk
+        changed = []
+        for obj in chunk:
+            digits = phone_digits(obj.phone)
+            if digits != obj.phone_digits:
+                obj.phone_digits = digits
+                changed.append(obj)
+        model._default_manager.bulk_update(changed, ['phone_digits'])
+        count += len(changed)
+    return count
@@ -0,0 +1,149 @@
+import textwrap
+
+from django.conf import settings
+from django.utils.formats import date_format
+
+# Same header as the A4 documents
+SHOP_HEADER = [
+    'ProTech',
+    'CITE 08 MAI 45 BT N° 20, BAB-EZZOUAR, ALGER',
+    'Code postal : 16024',
+    'Tel : 023 95 01 00',
+]
+
+# ESC/POS commands
+ESC_INIT = b'\x1b@'
+ESC_CODE_PAGE_1252 = b'\x1bt\x10'
+ESC_BOLD_ON = b'\x1bE\x01'
+ESC_BOLD_OFF = b'\x1bE\x00'
+ESC_FEED_AND_CUT = b'\x1dVB\x03'
+
+# 80 mm paper, in PDF points
+PDF_PAGE_WIDTH = 80 * 72 / 25.4
+PDF_MARGIN = 8
+# Width of a Courier character, relative to the font size
+COURIER_CHAR_WIDTH = 0.6
+
+
+class Receipt:
+    """A fixed-width receipt for thermal printers, laid out straight from the model data.
+
+    The lines are padded to the width of the paper once, then written as plain text,
+    as ESC/POS commands for the printer, or as a single-page PDF, without going through
+    an HTML layout engine.
+    """
+
+    def __init__(self, width=None):
+        self.width = width or settings.RECEIPT_WIDTH
+        # (text, bold) of each line, text is exactly self.width characters long
+        self.lines = []
+
+    def add(self, text='', bold=False, center=False):
+        for line in textwrap.wrap(str(text), self.width) or ['']:
+            self.lines.append((line.center(self.width) if center else line.ljust(self.width), bold))
+
+    def add_columns(self, left, right, bold=False):
+        """Add a line with a text on the left and a value aligned on the right."""
+        right = str(right)
+        left_lines = textwrap.wrap(str(left), self.width - len(right) - 1) or ['']
+        for line in left_lines[:-1]:
+            self.add(line, bold=bold)
+        self.lines.append((left_lines[-1].ljust(self.width - len(right)) + right, bold))
+
+    def add_rule(self):
+        self.lines.append(('-' * self.width, False))
+
+    def to_text(self):
+        return '\n'.join(text.rstrip() for text, bold in self.lines) + '\n'
+
+    def to_escpos(self):
+        output = [ESC_INIT, ESC_CODE_PAGE_1252]
+        for text, bold in self.lines:
+            line = text.rstrip().encode('cp1252', errors='replace') + b'\n'
+            output.append(ESC_BOLD_ON + line + ESC_BOLD_OFF if bold else line)
+        output.append(ESC_FEED_AND_CUT)
+        return b''.join(output)
+
+    def to_pdf(self):
+        # The font size makes the lines fill the width of the paper, the page is as long as the receipt
+        font_size = (PDF_PAGE_WIDTH - 2 * PDF_MARGIN) / (self.width * COURIER_CHAR_WIDTH)
+        leading = font_size * 1.25
+        height = 2 * PDF_MARGIN + leading * len(self.lines)
+
+        content = [f'BT {leading:.2f} TL {PDF_MARGIN} {height - PDF_MARGIN - font_size:.2f} Td'.encode()]
+        for text, bold in self.lines:
+            text = text.rstrip().encode('cp1252', errors='replace')
+            text = text.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+            content.append(b'/F%d %.2f Tf (%s) Tj T*' % (2 if bold else 1, font_size, text))
+        content.append(b'ET')
+        content = b'\n'.join(content)
+
+        objects = [
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+            b'/Resources << /Font << /F1 4 0 R /F2 5 0 R >> >> /Contents 6 0 R >>' % (PDF_PAGE_WIDTH, height),
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>',
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier-Bold /Encoding /WinAnsiEncoding >>',
+            b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content),
+        ]
+        output = [b'%PDF-1.4\n']
+        offsets = []
+        position = len(output[0])
+        for number, obj in enumerate(objects, start=1):
+            offsets.append(position)
+            chunk = b'%d 0 obj\n%s\nendobj\n' % (number, obj)
+            output.append(chunk)
+            position += len(chunk)
+        output.append(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+        output.extend(b'%010d 00000 n \n' % offset for offset in offsets)
+        output.append(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%EOF\n' % (len(objects) + 1, position))
+        return b''.join(output)
+
+
+def _add_header(receipt, title):
+    receipt.add(SHOP_HEADER[0], bold=True, center=True)
+    for line in SHOP_HEADER[1:]:
+        receipt.add(line, center=True)
+    receipt.add_rule()
+    receipt.add(title, bold=True, center=True)
+    receipt.add_rule()
+
+
+def sale_receipt(sale, sale_items):
+    receipt = Receipt()
+    _add_header(receipt, 'Ticket de vente')
+    receipt.add(f'Id Vente : {sale.id}', bold=True)
+    receipt.add(f'Client : {sale.client if sale.client else "Client inconnu"}')
+    receipt.add(f'Date de vente : {date_format(sale.sale_date)}')
+    receipt.add_rule()
+    for item in sale_items:
+        receipt.add(item.product.name)
+        receipt.add_columns(f'  {item.quantity} x {item.sale_price} DA', f'{item.quantity * item.sale_price} DA')
+    receipt.add_rule()
+    receipt.add_columns('TOTAL', f'{sale.total_amount} DA', bold=True)
+    receipt.add_rule()
+    receipt.add("En cas de besoin d'échange ou remboursement veuillez présenter ce ticket à notre équipe.",
+                center=True)
+    receipt.add('Merci pour votre fidélité !', center=True)
+    return receipt
+
+
+def repair_receipt(repair):
+    receipt = Receipt()
+    _add_header(receipt, 'Bon de réparation')
+    receipt.add(f'IdRéparation : {repair.id}', bold=True)
+    receipt.add(f'Description : {repair.description}')
+    receipt.add(f'Matériel : {repair.hardware.id} - {repair.hardware}')
+    receipt.add(f'Description du matériel : {repair.hardware.description}')
+    receipt.add(f'Date de dépôt : {date_format(repair.deposit_date)}')
+    if repair.client:
+        receipt.add(f'Client : {repair.client.id} - {repair.client}')
+    receipt.add_rule()
+    receipt.add_columns('Prix de réparation', f'{repair.repair_price} DA')
+    receipt.add_columns('Versement', f'{repair.prepayment} DA')
+    receipt.add_columns('Reste à payer', f'{repair.repair_price - repair.prepayment} DA', bold=True)
+    receipt.add_rule()
+    receipt.add('Pour récupérer votre matériel veuillez présenter ce bon à notre équipe.', center=True)
+    receipt.add('Merci pour votre fidélité !', center=True)
+    return receipt
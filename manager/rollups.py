@@ -0,0 +1,153 @@
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Case, Count, F, IntegerField, Q, Sum, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import DailyProductRollup, DailySalesRollup, Product, Repair, Sale, SaleItem
+
+
+def adjust_daily_sales(deltas):
+    """Apply a {date: (sale_count_delta, revenue_delta)} mapping to the daily sales rollups with one UPDATE."""
+    deltas = {date: delta for date, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+    DailySalesRollup.objects.bulk_create([DailySalesRollup(date=date) for date in deltas], ignore_conflicts=True)
+    count_whens = [When(date=date, then=F('sale_count') + count) for date, (count, revenue) in deltas.items()]
+    revenue_whens = [When(date=date, then=F('revenue') + revenue) for date, (count, revenue) in deltas.items()]
+    DailySalesRollup.objects.filter(date__in=deltas.keys()).update(
+        sale_count=Case(*count_whens, default=F('sale_count'), output_field=IntegerField()),
+        revenue=Case(*revenue_whens, default=F('revenue'), output_field=IntegerField()),
+    )
+
+
+def adjust_daily_products(deltas):
+    """Apply a {(date, product_id): (quantity_delta, revenue_delta)} mapping to the daily product rollups with one UPDATE."""
+    deltas = {key: delta for key, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+    DailyProductRollup.objects.bulk_create([DailyProductRollup(date=date, product_id=product_id)
+                                            for date, product_id in deltas], ignore_conflicts=True)
+    condition = Q()
+    quantity_whens = []
+    revenue_whens = []
+    for (date, product_id), (quantity, revenue) in deltas.items():
+        condition |= Q(date=date, product_id=product_id)
+        quantity_whens.append(When(date=date, product_id=product_id, then=F('quantity') + quantity))
+        revenue_whens.append(When(date=date, product_id=product_id, then=F('revenue') + revenue))
+    DailyProductRollup.objects.filter(condition).update(
+        quantity=Case(*quantity_whens, default=F('quantity'), output_field=IntegerField()),
+        revenue=Case(*revenue_whens, default=F('revenue'), output_field=IntegerField()),
+    )
+
+
+def record_sale_lines(product_sales, sale_dates=None):
+    """Add the {(sale_id, product_id): (quantity_delta, amount_delta)} changes of sale lines to the rollups.
+
+    The changes count on the date of their sale, sale_dates maps the sale ids to their
+    date, the dates missing are read with one query.
+    """
+    product_sales = {key: delta for key, delta in product_sales.items() if any(delta)}
+    if not product_sales:
+        return
+    sale_dates = dict(sale_dates or {})
+    missing = {sale_id for sale_id, product_id in product_sales} - sale_dates.keys()
+    if missing:
+        sale_dates.update(Sale.objects.filter(pk__in=missing).values_list('pk', 'sale_date'))
+
+    daily_sales = defaultdict(int)
+    daily_products = defaultdict(lambda: [0, 0])
+    for (sale_id, product_id), (quantity, amount) in product_sales.items():
+        date = sale_dates[sale_id]
+        daily_sales[date] += amount
+        daily_products[date, product_id][0] += quantity
+        daily_products[date, product_id][1] += amount
+    adjust_daily_sales({date: (0, revenue) for date, revenue in daily_sales.items()})
+    adjust_daily_products(daily_products)
+
+
+def _delivered_repairs(repairs):
+    # {date: (repair_count, repair_revenue)} of the repairs of a queryset, by delivery date
+    rows = repairs.order_by().values('delivery_date').annotate(
+        count=Count('pk'), revenue=Coalesce(Sum('repair_price'), 0),
+    ).values_list('delivery_date', 'count', 'revenue')
+    return {date: (count, revenue) for date, count, revenue in rows}
+
+
+def refresh_daily_repairs(dates):
+    """Compute the delivered repairs of some days again, from the repairs delivered on these days."""
+    field = Repair._meta.get_field('delivery_date')
+    dates = {field.to_python(date) for date in dates if date is not None}
+    if not dates:
+        return
+    figures = _delivered_repairs(Repair.objects.filter(delivery_date__in=dates))
+    DailySalesRollup.objects.bulk_create([DailySalesRollup(date=date) for date in dates], ignore_conflicts=True)
+    for date in dates:
+        count, revenue = figures.get(date, (0, 0))
+        DailySalesRollup.objects.filter(date=date).update(repair_count=count, repair_revenue=revenue)
+
+
+def rebuild_rollups(apps=None):
+    """Compute every daily rollup again from the sales and repairs, return the number of (days, day-products).
+
+    apps is the registry of the models to read, the historical one in a migration.
+    """
+    models = {model.__name__: model for model in (DailySalesRollup, DailyProductRollup, Repair, Sale, SaleItem)}
+
+    def get_model(name):
+        return apps.get_model('manager', name) if apps else models[name]
+
+    sales_model = get_model('DailySalesRollup')
+    products_model = get_model('DailyProductRollup')
+
+    days = defaultdict(lambda: {'sale_count': 0, 'revenue': 0, 'repair_count': 0, 'repair_revenue': 0})
+    for date, count, revenue in get_model('Sale').objects.order_by().values('sale_date').annotate(
+            count=Count('pk'), revenue=Coalesce(Sum('total_amount'), 0)).values_list('sale_date', 'count', 'revenue'):
+        days[date].update(sale_count=count, revenue=revenue)
+    for date, (count, revenue) in _delivered_repairs(
+            get_model('Repair').objects.filter(delivery_date__isnull=False)).items():
+        days[date].update(repair_count=count, repair_revenue=revenue)
+
+    products = get_model('SaleItem').objects.order_by().values('sale__sale_date', 'product').annotate(
+        total_quantity=Sum('quantity'), total_revenue=Sum(F('quantity') * F('sale_price')),
+    ).values_list('sale__sale_date', 'product', 'total_quantity', 'total_revenue')
+
+    sales_model.objects.all().delete()
+    products_model.objects.all().delete()
+    sales_model.objects.bulk_create([sales_model(date=date, **figures) for date, figures in days.items()],
+                                    batch_size=1000)
+    product_rollups = [products_model(date=date, product_id=product_id, quantity=quantity, revenue=revenue)
+                       for date, product_id, quantity, revenue in products]
+    products_model.objects.bulk_create(product_rollups, batch_size=1000)
+    return len(days), len(product_rollups)
+
+
+def _period(rollups, start, end):
+    figures = rollups.filter(date__gte=start, date__lte=end).aggregate(
+        revenue=Coalesce(Sum('revenue'), 0), sale_count=Coalesce(Sum('sale_count'), 0),
+        repair_revenue=Coalesce(Sum('repair_revenue'), 0))
+    figures['average_basket'] = figures['revenue'] // figures['sale_count'] if figures['sale_count'] else 0
+    return figures
+
+
+def dashboard_figures(today=None, top_count=5, alert_count=10):
+    """Figures of the dashboard, read from the rollups: their cost depends on the length of the periods, not on the history."""
+    today = today or timezone.localdate()
+    week_start = today - datetime.timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    rollups = DailySalesRollup.objects.all()
+    top_products = DailyProductRollup.objects.filter(date__gte=month_start, date__lte=today).values(
+        'product', 'product__name').annotate(quantity_sold=Sum('quantity'), product_revenue=Sum('revenue')).filter(
+        quantity_sold__gt=0).order_by('-product_revenue', 'product')[:top_count]
+    return {
+        'today': _period(rollups, today, today),
+        'week': _period(rollups, week_start, today),
+        'month': _period(rollups, month_start, today),
+        'top_products': list(top_products),
+        'open_repairs': Repair.objects.filter(delivery_date__isnull=True).count(),
+        'low_stock_threshold': settings.LOW_STOCK_THRESHOLD,
+        'low_stock': list(Product.objects.filter(quantity__lt=settings.LOW_STOCK_THRESHOLD).order_by(
+            'quantity', 'pk').values('id', 'name', 'quantity')[:alert_count]),
+    }
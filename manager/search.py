@@ -0,0 +1,145 @@
+import re
+
+from django.db import connection
+
+from .models import Client, HardwareToRepair, Product, Repair, Supplier
+
+# SQLite FTS5 table indexing the text of the searchable models, created by migration 0023.
+# The rowid of a row encodes the model and the primary key of the object it indexes.
+SEARCH_TABLE = 'RechercheGlobale'
+KIND_BITS = 3
+KIND_MASK = (1 << KIND_BITS) - 1
+
+
+def phone_variants(phone):
+    """Phone number written the ways it can be searched: as stored, digits only, international."""
+    if not phone:
+        return ''
+    text = str(phone)
+    variants = [text, re.sub(r'\D', '', text)]
+    number = getattr(phone, 'national_number', None)
+    if number:
+        variants += [f'0{number}', f'{phone.country_code}{number}']
+    return ' '.join(dict.fromkeys(variants))
+
+
+def _person_text(obj):
+    return ' '.join(filter(None, [phone_variants(obj.phone), obj.email, obj.address]))
+
+
+def _full_name(person):
+    return f'{person.first_name} {person.last_name}' if person else ''
+
+
+class SearchKind:
+    """A model of the search index, and the (title, body) text indexed for its objects."""
+
+    def __init__(self, code, model, label, url_name, roles, document, related=()):
+        self.code = code
+        self.model = model
+        self.label = label
+        self.url_name = url_name
+        # Roles allowed to see the objects, None for every role
+        self.roles = roles
+        self.document = document
+        self.related = related
+
+
+# The documents only read fields, so that the migration can index its historical models
+SEARCH_KINDS = [
+    SearchKind(1, Client, 'Client', 'client-detail', None,
+               lambda obj: (_full_name(obj), _person_text(obj))),
+    SearchKind(2, Supplier, 'Fournisseur', 'supplier-detail', ['Admin', 'Employé'],
+               lambda obj: (obj.name, _person_text(obj))),
+    SearchKind(3, Product, 'Produit', 'product-detail', ['Admin', 'Employé'],
+               lambda obj: (obj.name, ' '.join(filter(None, [obj.barcode, obj.category.name]))),
+               related=('category',)),
+    SearchKind(4, Repair, 'Réparation', 'repair-detail', ['Admin', 'Réparateur'],
+               lambda obj: (obj.title, ' '.join(filter(None, [obj.description, _full_name(obj.client)]))),
+               related=('client',)),
+    SearchKind(5, HardwareToRepair, 'Matériel à réparer', 'hardware-detail', ['Admin', 'Réparateur'],
+               lambda obj: (obj.name, obj.description)),
+]
+KINDS_BY_MODEL = {kind.model: kind for kind in SEARCH_KINDS}
+KINDS_BY_CODE = {kind.code: kind for kind in SEARCH_KINDS}
+
+
+def _rowid(kind, pk):
+    return (pk << KIND_BITS) | kind.code
+
+
+def index_objects(kind, objects):
+    """Add or replace objects of a SearchKind in the search index."""
+    rows = [(_rowid(kind, obj.pk), *kind.document(obj)) for obj in objects]
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM "{SEARCH_TABLE}" WHERE rowid = %s', [(row[0],) for row in rows])
+        cursor.executemany(f'INSERT INTO "{SEARCH_TABLE}" (rowid, title, body) VALUES (%s, %s, %s)', rows)
+
+
+def unindex_object(model, pk):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM "{SEARCH_TABLE}" WHERE rowid = %s', [_rowid(KINDS_BY_MODEL[model], pk)])
+
+
+def rebuild_search_index(chunk_size=1000, apps=None):
+    """Index every searchable object again, return the number of indexed objects.
+
+    apps is the registry of the models to read, the historical one in a migration.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM "{SEARCH_TABLE}"')
+    count = 0
+    for kind in SEARCH_KINDS:
+        model = apps.get_model(kind.model._meta.label) if apps else kind.model
+        objects = model.objects.select_related(*kind.related).order_by('pk')
+        last_pk = 0
+        while chunk := list(objects.filter(pk__gt=last_pk)[:chunk_size]):
+            index_objects(kind, chunk)
+            last_pk = chunk[-1].pk
+            count += len(chunk)
+    return count
+
+
+def match_expression(query):
+    """FTS5 query matching every word of the user's query, as a prefix, or None if there is no word."""
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class SearchResult:
+    """An object found by search(), read from the index only."""
+
+    def __init__(self, kind, pk, title, snippet):
+        self.kind = kind
+        self.pk = pk
+        self.title = title
+        self.snippet = snippet
+
+
+def search(query, role=None, offset=0, limit=20):
+    """Return the objects matching a query, best matches first, and whether there are more.
+
+    The ranking, paging and the titles come from the index only, no model is queried.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return [], False
+    kinds = [kind for kind in SEARCH_KINDS if kind.roles is None or role in kind.roles]
+    if not kinds:
+        return [], False
+    kind_codes = ', '.join(str(kind.code) for kind in kinds)
+    with connection.cursor() as cursor:
+        # The title weighs more than the other text in the ranking
+        cursor.execute(
+            f'SELECT rowid, title, snippet("{SEARCH_TABLE}", 1, \'\', \'\', \'…\', 12) '
+            f'FROM "{SEARCH_TABLE}" WHERE "{SEARCH_TABLE}" MATCH %s AND (rowid & {KIND_MASK}) IN ({kind_codes}) '
+            f'ORDER BY bm25("{SEARCH_TABLE}", 10.0, 1.0) LIMIT %s OFFSET %s',
+            [expression, limit + 1, offset])
+        rows = cursor.fetchall()
+    results = [SearchResult(KINDS_BY_CODE[rowid & KIND_MASK], rowid >> KIND_BITS, title, snippet)
+               for rowid, title, snippet in rows[:limit]]
+    return results, len(rows) > limit
@@ -0,0 +1,51 @@
+$(document).ready(function() {
+    // The scanner types the code followed by Enter, each scan adds the product to the sale in one request
+    $('#scan').on('keydown', function(event) {
+        if (event.key !== 'Enter') {
+            return;
+        }
+        event.preventDefault();
+        var input = $(this);
+        var code = input.val().trim();
+        input.val('');
+        if (!code) {
+            return;
+        }
+
+        $.ajax({
+            url: input.data('url'),
+            method: 'POST',
+            data: {
+                code: code,
+                csrfmiddlewaretoken: $('input[name="csrfmiddlewaretoken"]').val()
+            },
+            success: function(data) {
+                var item = data.item;
+                var row = $('tr[data-product-id="' + item.product_id + '"]');
+                if (row.length) {
+                    row.children().eq(3).text(item.quantity);
+                    row.children().eq(5).text(item.total + ' DA');
+                } else if ($('#partieImprimer tbody').length) {
+                    var tbody = $('#partieImprimer tbody');
+                    $('<tr>').attr('data-product-id', item.product_id).append(
+                        $('<td>').text(tbody.children().length + 1),
+                        $('<td>').text(item.product_id),
+                        $('<td>').text(item.product_name),
+                        $('<td>').text(item.quantity),
+                        $('<td>').text(item.sale_price + ' DA'),
+                        $('<td>').text(item.total + ' DA')
+                    ).appendTo(tbody);
+                } else {
+                    // First article of the sale, the table is not rendered yet
+                    location.reload();
+                    return;
+                }
+                $('#sale-total').text(data.sale_total);
+                $('.imprimer').prop('disabled', false);
+            },
+            error: function(xhr) {
+                alert(xhr.responseJSON ? xhr.responseJSON.error : 'Erreur lors du scan.');
+            }
+        });
+    });
+});
@@ -1,22 +1,76 @@
 $(document).ready(function() {
+    // Price list loaded once for the whole page, {product pk: initial selling price}.
+    // It is kept with its ETag in the sessionStorage, so that the next pages only revalidate it.
+    var storageKey = 'sellingPrices';
+    var sellingPrices = {};
+    var sellingPricesEtag = null;
+
+    try {
+        var stored = JSON.parse(sessionStorage.getItem(storageKey));
+        if (stored && stored.etag && stored.prices) {
+            sellingPrices = stored.prices;
+            sellingPricesEtag = stored.etag;
+        }
+    } catch (e) {
+        // No sessionStorage, or an unreadable entry: the whole list is loaded
+    }
+
+    function storeSellingPrices() {
+        try {
+            sessionStorage.setItem(storageKey, JSON.stringify({etag: sellingPricesEtag, prices: sellingPrices}));
+        } catch (e) {
+            // Storage full or disabled, the list is loaded again on the next page
+        }
+    }
+
+    function loadSellingPrices(ids) {
+        var headers = {};
+        if (sellingPricesEtag && !ids) {
+            headers['If-None-Match'] = sellingPricesEtag;
+        }
+        return $.ajax({
+            url: '/produits/prix_vente/',
+            data: ids ? {ids: ids.join(',')} : {},
+            headers: headers,
+            success: function(data, status, xhr) {
+                // 304: the stored list is still up to date
+                if (xhr.status === 200) {
+                    if (ids) {
+                        $.extend(sellingPrices, data.prices);
+                    } else {
+                        sellingPrices = data.prices;
+                        sellingPricesEtag = xhr.getResponseHeader('ETag');
+                        storeSellingPrices();
+                    }
+                }
+            }
+        });
+    }
+
+    loadSellingPrices();
+
     // Attach event listener to the document, targeting dynamically added .product-select elements
     $(document).on('change', '.product-select', function() {
         var selectedProductPk = $(this).val();
         var initialSellingPriceInput = $(this).closest('.sale-item').find('.sale-price-input');
 
-        if (selectedProductPk) {
-            $.ajax({
-                url: '/produit/' + selectedProductPk + '/prix_vente_initial/',
-                success: function(data) {
-                    initialSellingPriceInput.val(data.initial_selling_price);
-                },
-                error: function() {
+        if (!selectedProductPk) {
+            initialSellingPriceInput.val('');
+        } else if (selectedProductPk in sellingPrices) {
+            initialSellingPriceInput.val(sellingPrices[selectedProductPk]);
+        } else {
+            // Product missing from the price list loaded with the page, fetch it alone
+            loadSellingPrices([selectedProductPk]).done(function() {
+                if (selectedProductPk in sellingPrices) {
+                    initialSellingPriceInput.val(sellingPrices[selectedProductPk]);
+                } else {
                     alert('Produit non trouvé');
                     initialSellingPriceInput.val('0');
                 }
+            }).fail(function() {
+                alert('Produit non trouvé');
+                initialSellingPriceInput.val('0');
             });
-        } else {
-            initialSellingPriceInput.val('');
         }
     });
-});
\ No newline at end of file
+});
@@ -0,0 +1,66 @@
+// Typeahead search of the products: each .product-select only contains the selected product,
+// the other options are fetched page by page from the search endpoint given in data-search-url.
+function initProductSearch(scope) {
+    $(scope).find('.product-select').each(function() {
+        var select = $(this);
+        if (select.prev('.product-search-input').length) {
+            return;
+        }
+        $('<input type="search" class="product-search-input" placeholder="Rechercher un produit">')
+            .insertBefore(select);
+    });
+}
+
+$(document).ready(function() {
+    var searchTimeout = null;
+
+    function searchProducts(input, page) {
+        var select = input.next('.product-select');
+        $.ajax({
+            url: select.data('search-url'),
+            data: {q: input.val(), page: page},
+            success: function(data) {
+                var selectedValue = select.val();
+                if (page === 1) {
+                    // Keep the empty choice and the selected product, replace the other options
+                    select.find('option').filter(function() {
+                        return this.value && this.value !== selectedValue;
+                    }).remove();
+                }
+                select.find('option.product-search-more').remove();
+                $.each(data.results, function(index, product) {
+                    if (!select.find('option[value="' + product.id + '"]').length) {
+                        select.append($('<option>').val(product.id).text(product.text));
+                    }
+                });
+                if (data.has_more) {
+                    select.append($('<option class="product-search-more">')
+                        .val('').text('Plus de résultats…').data('next-page', page + 1));
+                }
+                if (typeof updateProductSelection === 'function') {
+                    updateProductSelection();
+                }
+            }
+        });
+    }
+
+    $(document).on('input', '.product-search-input', function() {
+        var input = $(this);
+        clearTimeout(searchTimeout);
+        searchTimeout = setTimeout(function() {
+            searchProducts(input, 1);
+        }, 250);
+    });
+
+    // Load the next page when the "more results" option is picked
+    $(document).on('change', '.product-select', function(event) {
+        var moreOption = $(this).find('option.product-search-more:selected');
+        if (moreOption.length) {
+            event.stopImmediatePropagation();
+            $(this).val('');
+            searchProducts($(this).prev('.product-search-input'), moreOption.data('next-page'));
+        }
+    });
+
+    initProductSearch(document);
+});
@@ -0,0 +1,291 @@
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, ExpressionWrapper, F, IntegerField, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .counts import adjust_row_counts
+from .models import Product, Sale, SaleItem, StockMovement, StockSnapshot, _invalidate_pdf_cache
+from .rollups import adjust_daily_sales, record_sale_lines
+from .summaries import adjust_client_sales, adjust_client_spending
+
+
+class InsufficientStockError(Exception):
+    """Raised when a stock movement would bring a product quantity below zero."""
+
+
+def apply_stock_movements(movements):
+    """Record StockMovement rows in the ledger and apply them to Product.quantity.
+
+    All the products are updated with a single UPDATE, whose new quantities are computed
+    by the database from F('quantity') so that concurrent movements on the same product
+    never overwrite each other, and the movements are inserted with a single INSERT.
+    """
+    movements = [movement for movement in movements if movement.quantity]
+    deltas = defaultdict(int)
+    for movement in movements:
+        deltas[movement.product_id] += movement.quantity
+    deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+    if deltas:
+        whens = [When(pk=product_id, then=ExpressionWrapper(F('quantity') + delta, output_field=IntegerField()))
+                 for product_id, delta in deltas.items()]
+        try:
+            # Savepoint so that the caller's transaction stays usable after a failed update
+            with transaction.atomic():
+                Product.objects.filter(pk__in=deltas.keys()).update(
+                    quantity=Case(*whens, default=F('quantity'), output_field=IntegerField()))
+        except IntegrityError as e:
+            # The quantity column is unsigned, the database refuses negative stock
+            raise InsufficientStockError(str(e)) from e
+    if movements:
+        StockMovement.objects.bulk_create(movements)
+
+
+def adjust_product_quantities(deltas, source_type, source_id=None):
+    """Apply a {product_id: delta} mapping caused by a single document to the stock."""
+    apply_stock_movements([
+        StockMovement(product_id=product_id, quantity=delta, source_type=source_type, source_id=source_id)
+        for product_id, delta in deltas.items()
+    ])
+
+
+def adjust_sale_totals(totals):
+    """Apply a {sale_id: (amount_delta, item_count_delta)} mapping to the stored sale totals with a single UPDATE."""
+    totals = {sale_id: delta for sale_id, delta in totals.items() if any(delta)}
+    if not totals:
+        return
+    amount_whens = [When(pk=sale_id, then=ExpressionWrapper(F('total_amount') + amount, output_field=IntegerField()))
+                    for sale_id, (amount, count) in totals.items()]
+    count_whens = [When(pk=sale_id, then=ExpressionWrapper(F('item_count') + count, output_field=IntegerField()))
+                   for sale_id, (amount, count) in totals.items()]
+    Sale.objects.filter(pk__in=totals.keys()).update(
+        total_amount=Case(*amount_whens, default=F('total_amount'), output_field=IntegerField()),
+        item_count=Case(*count_whens, default=F('item_count'), output_field=IntegerField()),
+    )
+    adjust_client_spending(totals)
+
+
+def invalidate_sale_pdfs(sale_ids):
+    """Drop the cached PDFs of the given sales once the transaction is committed."""
+    for sale_id in set(sale_ids):
+        _invalidate_pdf_cache('vente', sale_id)
+
+
+class SaleItemChanges:
+    """Stock and sale total deltas of a set of sale line changes."""
+
+    def __init__(self):
+        # {(sale_id, product_id): delta}, one ledger movement per sale and product
+        self.stock_deltas = defaultdict(int)
+        self.sale_totals = defaultdict(lambda: [0, 0])
+        # {(sale_id, product_id): [quantity, amount]} sold, for the daily rollups
+        self.product_sales = defaultdict(lambda: [0, 0])
+
+    def remove(self, sale_id, product_id, quantity, sale_price):
+        self.stock_deltas[sale_id, product_id] += quantity
+        self.sale_totals[sale_id][0] -= quantity * sale_price
+        self.sale_totals[sale_id][1] -= 1
+        self.product_sales[sale_id, product_id][0] -= quantity
+        self.product_sales[sale_id, product_id][1] -= quantity * sale_price
+
+    def add(self, sale_id, product_id, quantity, sale_price):
+        self.stock_deltas[sale_id, product_id] -= quantity
+        self.sale_totals[sale_id][0] += quantity * sale_price
+        self.sale_totals[sale_id][1] += 1
+        self.product_sales[sale_id, product_id][0] += quantity
+        self.product_sales[sale_id, product_id][1] += quantity * sale_price
+
+    def apply(self):
+        apply_stock_movements([
+            StockMovement(product_id=product_id, quantity=delta, source_type='Vente', source_id=sale_id)
+            for (sale_id, product_id), delta in self.stock_deltas.items()
+        ])
+        adjust_sale_totals(self.sale_totals)
+        record_sale_lines(self.product_sales)
+        # The lines are written without post_save signals, their cached invoices are dropped here
+        invalidate_sale_pdfs(self.sale_totals)
+
+
+def read_sale_items(pks):
+    """Stored state of the given sale lines, {pk: (sale_id, product_id, quantity, sale_price)}, locked for update."""
+    if not pks:
+        return {}
+    rows = SaleItem.objects.select_for_update().filter(pk__in=pks).values_list(
+        'pk', 'sale_id', 'product_id', 'quantity', 'sale_price')
+    return {row[0]: row[1:] for row in rows}
+
+
+def save_sale_items(new_items=(), changed_items=(), deleted_items=()):
+    """Save all the line changes of a sale and the matching stock movements at once.
+
+    The number of queries does not depend on the number of lines: one to read the
+    previous state of the touched lines, one for the stock update, one for the sale
+    totals, and one each for the inserted, updated and deleted lines.
+    """
+    new_items = list(new_items)
+    changed_items = list(changed_items)
+    deleted_pks = [item.pk for item in deleted_items if item.pk]
+
+    with transaction.atomic():
+        # Read the stored state of the lines, the form instances already hold the new values
+        old_items = read_sale_items([item.pk for item in changed_items] + deleted_pks)
+
+        changes = SaleItemChanges()
+        for pk in deleted_pks:
+            if pk in old_items:
+                changes.remove(*old_items[pk])
+        for item in changed_items:
+            if item.pk in old_items:
+                changes.remove(*old_items[item.pk])
+            changes.add(item.sale_id, item.product_id, item.quantity, item.sale_price)
+        for item in new_items:
+            changes.add(item.sale_id, item.product_id, item.quantity, item.sale_price)
+
+        changes.apply()
+
+        if deleted_pks:
+            SaleItem.objects.filter(pk__in=deleted_pks).delete()
+        if changed_items:
+            SaleItem.objects.bulk_update(changed_items, ['product', 'quantity', 'sale_price'])
+        if new_items:
+            SaleItem.objects.bulk_create(new_items)
+
+
+def create_sales(sales):
+    """Create complete sales, a list of (Sale, [SaleItem]), and their stock movements in one transaction.
+
+    The totals of the sales are computed before their insertion, and the lines of every
+    sale are inserted together, so the number of queries does not depend on the batch size.
+    """
+    for sale, sale_items in sales:
+        sale.total_amount = sum(item.quantity * item.sale_price for item in sale_items)
+        sale.item_count = len(sale_items)
+
+    with transaction.atomic():
+        Sale.objects.bulk_create([sale for sale, sale_items in sales])
+        # bulk_create sends no post_save signal
+        adjust_row_counts(Sale, [sale for sale, sale_items in sales], 1)
+        client_sales = {}
+        for sale, sale_items in sales:
+            if sale.client_id:
+                count, spent, date = client_sales.get(sale.client_id, (0, 0, sale.sale_date))
+                client_sales[sale.client_id] = (count + 1, spent + sale.total_amount, max(date, sale.sale_date))
+        adjust_client_sales(client_sales)
+        all_items = []
+        changes = SaleItemChanges()
+        for sale, sale_items in sales:
+            for item in sale_items:
+                item.sale = sale
+                all_items.append(item)
+                changes.stock_deltas[sale.pk, item.product_id] -= item.quantity
+                changes.product_sales[sale.pk, item.product_id][0] += item.quantity
+                changes.product_sales[sale.pk, item.product_id][1] += item.quantity * item.sale_price
+        # The totals are already stored with the sales, only the stock is left to update
+        apply_stock_movements([
+            StockMovement(product_id=product_id, quantity=delta, source_type='Vente', source_id=sale_id)
+            for (sale_id, product_id), delta in changes.stock_deltas.items()
+        ])
+        SaleItem.objects.bulk_create(all_items)
+        # The revenue is added with the lines, the sales are only counted here
+        daily_sales = defaultdict(int)
+        for sale, sale_items in sales:
+            daily_sales[sale.sale_date] += 1
+        adjust_daily_sales({date: (count, 0) for date, count in daily_sales.items()})
+        record_sale_lines(changes.product_sales, {sale.pk: sale.sale_date for sale, sale_items in sales})
+        invalidate_sale_pdfs(sale.pk for sale, sale_items in sales)
+    return [sale for sale, sale_items in sales]
+
+
+def delete_sale_items(sale, update_product_quantity=True):
+    """Delete every line of a sale, putting the sold quantities back in stock if asked."""
+    with transaction.atomic():
+        sale_items = SaleItem.objects.filter(sale=sale)
+        changes = SaleItemChanges()
+        for row in sale_items.select_for_update().values_list('sale_id', 'product_id', 'quantity', 'sale_price'):
+            changes.remove(*row)
+        if not update_product_quantity:
+            changes.stock_deltas.clear()
+        changes.apply()
+        sale_items.delete()
+
+
+def remove_product_from_sales(product):
+    """Take the lines of a product out of the totals of their sales, before the deletion of the product.
+
+    The lines themselves are deleted by the cascade, the stock of the product is deleted with it.
+    """
+    with transaction.atomic():
+        changes = SaleItemChanges()
+        for row in SaleItem.objects.select_for_update().filter(product=product).values_list(
+                'sale_id', 'product_id', 'quantity', 'sale_price'):
+            changes.remove(*row)
+        changes.stock_deltas.clear()
+        changes.apply()
+
+
+def receive_purchase_order_items(purchase_order, purchase_order_items):
+    """Add the delivered quantities of a purchase order to the stock."""
+    deltas = defaultdict(int)
+    for item in purchase_order_items:
+        deltas[item.product_id] += item.quantity
+    adjust_product_quantities(deltas, 'Commande', purchase_order.pk)
+
+
+def _quantities_from_ledger(product_ids, snapshots, movements):
+    # Latest of the given snapshots of each product, plus the given movements recorded after it
+    snapshots = snapshots.filter(product=OuterRef('pk'))
+    movements = movements.filter(product=OuterRef('pk'), pk__gt=OuterRef('snapshot_movement')).order_by().values(
+        'product').annotate(total=Sum('quantity')).values('total')
+    rows = Product.objects.filter(pk__in=product_ids).annotate(
+        snapshot_quantity=Coalesce(Subquery(snapshots.values('quantity')[:1]), 0),
+        snapshot_movement=Coalesce(Subquery(snapshots.values('last_movement_id')[:1]), 0),
+    ).annotate(
+        movements_quantity=Coalesce(Subquery(movements), 0),
+    ).values_list('pk', 'snapshot_quantity', 'movements_quantity')
+    return {pk: snapshot_quantity + movements_quantity for pk, snapshot_quantity, movements_quantity in rows}
+
+
+def stock_as_of(product_ids, when):
+    """Quantity of the given products at a date, {product_id: quantity}, in a single query.
+
+    Starts from the latest snapshot taken before the date and only adds the movements
+    recorded after it, so the cost is bounded by the snapshot period, not the history.
+    """
+    return _quantities_from_ledger(
+        product_ids,
+        StockSnapshot.objects.filter(taken_at__lte=when).order_by('-taken_at', '-pk'),
+        StockMovement.objects.filter(created_at__lte=when),
+    )
+
+
+def ledger_quantities(product_ids, last_movement=None):
+    """Quantity of the given products according to the ledger, up to last_movement if given, in a single query."""
+    snapshots = StockSnapshot.objects.order_by('-last_movement_id', '-pk')
+    movements = StockMovement.objects.all()
+    if last_movement is not None:
+        snapshots = snapshots.filter(last_movement_id__lte=last_movement)
+        movements = movements.filter(pk__lte=last_movement)
+    return _quantities_from_ledger(product_ids, snapshots, movements)
+
+
+def take_stock_snapshots(chunk_size=1000):
+    """Snapshot the ledger quantity of every product, chunk by chunk, and return the number of snapshots."""
+    last_movement = StockMovement.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    taken_at = timezone.now()
+    count = 0
+    last_pk = 0
+    while True:
+        product_ids = list(Product.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[
+                           :chunk_size])
+        if not product_ids:
+            return count
+        last_pk = product_ids[-1]
+        # Movements recorded after the start of the run belong to the next snapshot
+        quantities = ledger_quantities(product_ids, last_movement)
+        StockSnapshot.objects.bulk_create([
+            StockSnapshot(product_id=product_id, quantity=quantities[product_id], last_movement_id=last_movement,
+                          taken_at=taken_at)
+            for product_id in product_ids
+        ])
+        count += len(product_ids)
@@ -0,0 +1,104 @@
+from collections import defaultdict
+
+from django.db.models import Case, Count, DateField, F, IntegerField, Max, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import ClientSummary, Repair, Sale
+
+
+def _later_visit(visit):
+    # last_visit, or visit if it is later or there was no visit
+    visit = Value(visit, output_field=DateField())
+    return Coalesce(Greatest(F('last_visit'), visit), visit)
+
+
+def _ensure_summaries(client_ids):
+    ClientSummary.objects.bulk_create([ClientSummary(client_id=client_id) for client_id in client_ids],
+                                      ignore_conflicts=True)
+
+
+def adjust_client_sales(deltas):
+    """Apply a {client_id: (sale_count_delta, spent_delta, sale_date or None)} mapping to the summaries.
+
+    The summaries missing are created with one INSERT, and all are updated with one UPDATE
+    computed from F() expressions, like the product quantities in manager.stock.
+    """
+    deltas = {client_id: delta for client_id, delta in deltas.items() if client_id is not None and any(delta)}
+    if not deltas:
+        return
+    _ensure_summaries(deltas)
+    count_whens = [When(pk=client_id, then=F('sale_count') + count) for client_id, (count, spent, date) in deltas.items()]
+    spent_whens = [When(pk=client_id, then=F('total_spent') + spent)
+                   for client_id, (count, spent, date) in deltas.items()]
+    visit_whens = [When(pk=client_id, then=_later_visit(date))
+                   for client_id, (count, spent, date) in deltas.items() if date is not None]
+    ClientSummary.objects.filter(pk__in=deltas.keys()).update(
+        sale_count=Case(*count_whens, default=F('sale_count'), output_field=IntegerField()),
+        total_spent=Case(*spent_whens, default=F('total_spent'), output_field=IntegerField()),
+        last_visit=Case(*visit_whens, default=F('last_visit'), output_field=DateField()),
+    )
+
+
+def adjust_client_spending(totals):
+    """Apply the {sale_id: (amount_delta, item_count_delta)} changes of the sale totals to the spending of their clients."""
+    amounts = {sale_id: amount for sale_id, (amount, count) in totals.items() if amount}
+    if not amounts:
+        return
+    deltas = defaultdict(int)
+    for sale_id, client_id in Sale.objects.filter(pk__in=amounts.keys(), client__isnull=False).values_list(
+            'pk', 'client_id'):
+        deltas[client_id] += amounts[sale_id]
+    adjust_client_sales({client_id: (0, spent, None) for client_id, spent in deltas.items()})
+
+
+def _repair_figures(repairs):
+    # {client_id: (repair_count, outstanding_balance, last visit)} of the repairs of a queryset
+    rows = repairs.order_by().values('client').annotate(
+        count=Count('pk'),
+        outstanding=Coalesce(Sum(F('repair_price') - F('prepayment'), filter=Q(delivery_date=None)), 0),
+        last_deposit=Max('deposit_date'),
+        last_delivery=Max('delivery_date'),
+    ).values_list('client', 'count', 'outstanding', 'last_deposit', 'last_delivery')
+    return {client_id: (count, outstanding, max(filter(None, [last_deposit, last_delivery]), default=None))
+            for client_id, count, outstanding, last_deposit, last_delivery in rows}
+
+
+def refresh_client_repairs(client_ids):
+    """Compute the repair figures of the summaries of some clients again, from their repairs."""
+    client_ids = {client_id for client_id in client_ids if client_id is not None}
+    if not client_ids:
+        return
+    figures = _repair_figures(Repair.objects.filter(client__in=client_ids))
+    _ensure_summaries(client_ids)
+    for client_id in client_ids:
+        count, outstanding, visit = figures.get(client_id, (0, 0, None))
+        ClientSummary.objects.filter(pk=client_id).update(
+            repair_count=count, outstanding_balance=outstanding,
+            last_visit=_later_visit(visit) if visit else F('last_visit'))
+
+
+def rebuild_client_summaries(apps=None):
+    """Compute every summary again from the sales and repairs, return the number of summaries.
+
+    apps is the registry of the models to read, the historical one in a migration.
+    """
+    summary_model = apps.get_model('manager', 'ClientSummary') if apps else ClientSummary
+    sale_model = apps.get_model('manager', 'Sale') if apps else Sale
+    repair_model = apps.get_model('manager', 'Repair') if apps else Repair
+
+    sales = sale_model.objects.filter(client__isnull=False).order_by().values('client').annotate(
+        count=Count('pk'), spent=Coalesce(Sum('total_amount'), 0), last_sale=Max('sale_date'),
+    ).values_list('client', 'count', 'spent', 'last_sale')
+    sales = {client_id: (count, spent, last_sale) for client_id, count, spent, last_sale in sales}
+    repairs = _repair_figures(repair_model.objects.filter(client__isnull=False))
+
+    summaries = []
+    for client_id in sales.keys() | repairs.keys():
+        sale_count, spent, last_sale = sales.get(client_id, (0, 0, None))
+        repair_count, outstanding, last_repair = repairs.get(client_id, (0, 0, None))
+        summaries.append(summary_model(
+            client_id=client_id, sale_count=sale_count, total_spent=spent, repair_count=repair_count,
+            outstanding_balance=outstanding, last_visit=max(filter(None, [last_sale, last_repair]), default=None)))
+    summary_model.objects.all().delete()
+    summary_model.objects.bulk_create(summaries, batch_size=1000)
+    return len(summaries)
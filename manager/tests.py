@@ -1,3 +1,610 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import re
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import pdf, views
+from .forms import BaseSaleItemFormSet, PurchaseOrderItemForm, SaleItemFormSet
+from .models import (Account, Category, Client, DailySalesRollup, Employee, Product, PurchaseOrder,
+                     PurchaseOrderItem, Sale, SaleItem, StockMovement, StockSnapshot, Supplier, Suppliying)
+from .pagination import KeysetPaginator, encode_cursor
+from .stock import (InsufficientStockError, adjust_product_quantities, create_sales, delete_sale_items,
+                    ledger_quantities, receive_purchase_order_items, save_sale_items, stock_as_of,
+                    take_stock_snapshots)
+
+
+class StockTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Accessoires')
+        cls.products = [Product.objects.create(name=f'Produit {i}', category=cls.category, initial_selling_price=100)
+                        for i in range(5)]
+        # Initial stock recorded in the ledger, like a delivery
+        adjust_product_quantities({product.pk: 10 for product in cls.products}, 'Ajustement')
+
+    def quantities(self):
+        return list(Product.objects.filter(pk__in=[product.pk for product in self.products]).order_by('pk')
+                    .values_list('quantity', flat=True))
+
+
+class AdjustProductQuantitiesTests(StockTestCase):
+    def test_single_update(self):
+        deltas = {product.pk: delta for product, delta in zip(self.products, [-1, 2, -3, 4, 0])}
+        # Savepoint, UPDATE, release of the savepoint and INSERT of the movements
+        with self.assertNumQueries(4), CaptureQueriesContext(connection) as queries:
+            adjust_product_quantities(deltas, 'Ajustement')
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(self.quantities(), [9, 12, 7, 14, 10])
+        self.assertEqual(StockMovement.objects.filter(source_type='Ajustement', quantity__lt=10).count(), 4)
+
+    def test_update_is_relative(self):
+        # The new quantity is computed from the stored one, not from the loaded instance
+        product = self.products[0]
+        Product.objects.filter(pk=product.pk).update(quantity=20)
+        adjust_product_quantities({product.pk: -5}, 'Ajustement')
+        product.refresh_from_db()
+        self.assertEqual(product.quantity, 15)
+
+    def test_insufficient_stock_rolls_back(self):
+        movements = StockMovement.objects.count()
+        with self.assertRaises(InsufficientStockError):
+            adjust_product_quantities({self.products[0].pk: -1, self.products[1].pk: -11}, 'Ajustement')
+        # Nothing was applied, and the transaction can still be used
+        self.assertEqual(self.quantities(), [10] * 5)
+        self.assertEqual(StockMovement.objects.count(), movements)
+
+
+class SaleItemsTests(StockTestCase):
+    def test_save_sale_items(self):
+        sale = Sale.objects.create()
+        items = [SaleItem(sale=sale, product=product, quantity=2, sale_price=100) for product in self.products[:3]]
+        save_sale_items(new_items=items)
+        self.assertEqual(self.quantities(), [8, 8, 8, 10, 10])
+        sale.refresh_from_db()
+        self.assertEqual((sale.total_amount, sale.item_count), (600, 3))
+
+        items = list(SaleItem.objects.filter(sale=sale).order_by('pk'))
+        items[0].quantity = 5
+        items[1].product = self.products[3]
+        save_sale_items(changed_items=items[:2], deleted_items=items[2:])
+        self.assertEqual(self.quantities(), [5, 10, 10, 8, 10])
+        sale.refresh_from_db()
+        self.assertEqual((sale.total_amount, sale.item_count), (700, 2))
+
+    def test_save_sale_items_query_count(self):
+        # The number of queries does not depend on the number of lines
+        for count in (1, 5):
+            sale = Sale.objects.create()
+            items = [SaleItem(sale=sale, product=product, quantity=1, sale_price=100)
+                     for product in self.products[:count]]
+            with CaptureQueriesContext(connection) as queries:
+                save_sale_items(new_items=items)
+            if count == 1:
+                expected = len(queries)
+            self.assertEqual(len(queries), expected)
+
+    def test_insufficient_stock_saves_nothing(self):
+        sale = Sale.objects.create()
+        items = [SaleItem(sale=sale, product=self.products[0], quantity=1, sale_price=100),
+                 SaleItem(sale=sale, product=self.products[1], quantity=11, sale_price=100)]
+        with self.assertRaises(InsufficientStockError):
+            save_sale_items(new_items=items)
+        self.assertEqual(self.quantities(), [10] * 5)
+        self.assertFalse(SaleItem.objects.filter(sale=sale).exists())
+        sale.refresh_from_db()
+        self.assertEqual((sale.total_amount, sale.item_count), (0, 0))
+
+    def test_delete_sale_items_restores_stock(self):
+        sale = Sale.objects.create()
+        save_sale_items(new_items=[SaleItem(sale=sale, product=product, quantity=3, sale_price=100)
+                                   for product in self.products])
+        self.assertEqual(self.quantities(), [7] * 5)
+        delete_sale_items(sale)
+        self.assertEqual(self.quantities(), [10] * 5)
+        self.assertFalse(SaleItem.objects.filter(sale=sale).exists())
+        sale.refresh_from_db()
+        self.assertEqual((sale.total_amount, sale.item_count), (0, 0))
+
+    def test_delete_sale_items_without_restoring_stock(self):
+        sale = Sale.objects.create()
+        save_sale_items(new_items=[SaleItem(sale=sale, product=self.products[0], quantity=3, sale_price=100)])
+        delete_sale_items(sale, update_product_quantity=False)
+        self.assertEqual(self.quantities()[0], 7)
+
+    def test_product_deletion_updates_sale_totals(self):
+        client = Client.objects.create(first_name='Jean', last_name='Dupont', phone='0550000003',
+                                       email='jean@example.com', address='Oran')
+        sale = Sale.objects.create(client=client)
+        save_sale_items(new_items=[SaleItem(sale=sale, product=product, quantity=2, sale_price=100)
+                                   for product in self.products[:2]])
+        self.products[0].delete()
+        sale.refresh_from_db()
+        self.assertEqual((sale.total_amount, sale.item_count), (200, 1))
+        self.assertEqual(client.summary.total_spent, 200)
+        self.assertEqual(DailySalesRollup.objects.get(date=sale.sale_date).revenue, 200)
+
+
+def sale_formset_data(sale, lines, extra=()):
+    """POST data of the formset of a sale, its lines are (SaleItem, quantity) and the extra ones (product, quantity)."""
+    data = {
+        'saleitem_set-TOTAL_FORMS': str(len(lines) + len(extra)),
+        'saleitem_set-INITIAL_FORMS': str(len(lines)),
+        'saleitem_set-MIN_NUM_FORMS': '0',
+        'saleitem_set-MAX_NUM_FORMS': '1000',
+    }
+    for i, (item, quantity) in enumerate(lines):
+        data.update({f'saleitem_set-{i}-id': str(item.pk), f'saleitem_set-{i}-sale': str(sale.pk),
+                     f'saleitem_set-{i}-product': str(item.product_id),
+                     f'saleitem_set-{i}-quantity': str(quantity), f'saleitem_set-{i}-sale_price': '100'})
+    for i, (product, quantity) in enumerate(extra, len(lines)):
+        data.update({f'saleitem_set-{i}-sale': str(sale.pk), f'saleitem_set-{i}-product': str(product.pk),
+                     f'saleitem_set-{i}-quantity': str(quantity), f'saleitem_set-{i}-sale_price': '100'})
+    return data
+
+
+class SaleItemFormSetTests(StockTestCase):
+    def test_validation_query_count(self):
+        # The lines and the stock of their products are loaded once for the whole formset
+        for count in (1, 4):
+            sale = Sale.objects.create()
+            save_sale_items(new_items=[SaleItem(sale=sale, product=product, quantity=1, sale_price=100)
+                                       for product in self.products[:count]])
+            lines = [(item, 2) for item in SaleItem.objects.filter(sale=sale).order_by('pk')]
+            formset = SaleItemFormSet(sale_formset_data(sale, lines), instance=sale)
+            # The lines with their product, and the stock of the submitted products
+            with self.assertNumQueries(2):
+                self.assertTrue(formset.is_valid(), formset.errors)
+
+    def test_stock_of_the_lines(self):
+        sale = Sale.objects.create()
+        save_sale_items(new_items=[SaleItem(sale=sale, product=self.products[0], quantity=4, sale_price=100)])
+        item = SaleItem.objects.get(sale=sale)
+        # 6 left in stock, the 4 already sold can be sold again
+        self.assertTrue(SaleItemFormSet(sale_formset_data(sale, [(item, 10)]), instance=sale).is_valid())
+        formset = SaleItemFormSet(sale_formset_data(sale, [(item, 11)]), instance=sale)
+        self.assertFalse(formset.is_valid())
+        self.assertIn('quantity', formset.forms[0].errors)
+
+    def test_duplicate_product(self):
+        sale = Sale.objects.create()
+        save_sale_items(new_items=[SaleItem(sale=sale, product=self.products[0], quantity=1, sale_price=100)])
+        item = SaleItem.objects.get(sale=sale)
+        formset = SaleItemFormSet(sale_formset_data(sale, [(item, 1)], extra=[(self.products[1], 1),
+                                                                             (self.products[0], 1)]), instance=sale)
+        self.assertFalse(formset.is_valid())
+        self.assertEqual([bool(form.errors) for form in formset.forms], [False, False, True])
+        self.assertEqual(formset.forms[2].errors['product'], [BaseSaleItemFormSet.duplicate_product_message])
+
+    def test_duplicate_of_a_deleted_line(self):
+        sale = Sale.objects.create()
+        save_sale_items(new_items=[SaleItem(sale=sale, product=self.products[0], quantity=1, sale_price=100)])
+        item = SaleItem.objects.get(sale=sale)
+        data = sale_formset_data(sale, [(item, 1)], extra=[(self.products[0], 2)])
+        data['saleitem_set-0-DELETE'] = 'on'
+        self.assertTrue(SaleItemFormSet(data, instance=sale).is_valid())
+
+    def test_duplicates_are_not_remembered(self):
+        # The products of a formset are not seen by the next one
+        sale = Sale.objects.create()
+        data = sale_formset_data(sale, [], extra=[(self.products[0], 1)])
+        for attempt in range(2):
+            self.assertTrue(SaleItemFormSet(data, instance=sale).is_valid())
+
+
+class ProductSearchSelectTests(StockTestCase):
+    def options(self, form):
+        return re.findall(r'<option value="(\d*)"( selected)?', str(form['product']))
+
+    def test_rendering_of_the_lines(self):
+        sale = Sale.objects.create()
+        save_sale_items(new_items=[SaleItem(sale=sale, product=self.products[1], quantity=1, sale_price=100)])
+        formset = SaleItemFormSet(instance=sale)
+        # The lines are read with their product, the catalogue is never read
+        with self.assertNumQueries(1):
+            line, extra = [self.options(form) for form in formset.forms]
+        self.assertEqual(line, [('', ''), (str(self.products[1].pk), ' selected')])
+        self.assertEqual(extra, [('', '')])
+
+    def test_bound_form(self):
+        sale = Sale.objects.create()
+        data = sale_formset_data(sale, [], extra=[(self.products[2], 1)])
+        formset = SaleItemFormSet(data, instance=sale)
+        self.assertTrue(formset.is_valid(), formset.errors)
+        self.assertEqual(formset.forms[0].cleaned_data['product'], self.products[2])
+        self.assertEqual(self.options(formset.forms[0]), [('', ''), (str(self.products[2].pk), ' selected')])
+
+    def test_unknown_product(self):
+        sale = Sale.objects.create()
+        data = sale_formset_data(sale, [], extra=[(Product(pk=999), 1)])
+        formset = SaleItemFormSet(data, instance=sale)
+        self.assertFalse(formset.is_valid())
+        self.assertIn('product', formset.forms[0].errors)
+
+    def test_purchase_order_forms(self):
+        supplier = Supplier.objects.create(name='Fournisseur', phone='0550000002', email='fournisseur@example.com',
+                                           address='Blida')
+        Suppliying.objects.create(product=self.products[0], supplier=supplier)
+        purchase_order = PurchaseOrder.objects.create(supplier=supplier)
+        item = PurchaseOrderItem.objects.create(purchase_order=purchase_order, product=self.products[0], quantity=2)
+
+        form = PurchaseOrderItemForm(instance=item, purchase_order=purchase_order)
+        self.assertEqual(self.options(form), [('', ''), (str(self.products[0].pk), ' selected')])
+        # The products of a form are not shown by the next one
+        self.assertEqual(self.options(PurchaseOrderItemForm(purchase_order=purchase_order)), [('', '')])
+
+        form = PurchaseOrderItemForm({'product': self.products[0].pk, 'quantity': 1}, purchase_order=purchase_order)
+        self.assertTrue(form.is_valid(), form.errors)
+        # Only the products of the supplier can be ordered
+        form = PurchaseOrderItemForm({'product': self.products[1].pk, 'quantity': 1}, purchase_order=purchase_order)
+        self.assertFalse(form.is_valid())
+
+
+class SaleScanTests(StockTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        employee = Employee.objects.create(first_name='Amine', last_name='Caisse', phone='0550000001',
+                                           email='caisse@example.com', address='Alger', role='Employé')
+        cls.account = Account.objects.create_user('caisse', 'motdepasse', employee=employee)
+        Product.objects.filter(pk=cls.products[0].pk).update(barcode='6130000000001')
+
+    def setUp(self):
+        self.client.force_login(self.account)
+        self.sale = Sale.objects.create()
+
+    def scan(self, code, quantity=1):
+        return self.client.post(reverse('scan-sale-item', args=[self.sale.pk]), {'code': code, 'quantity': quantity})
+
+    def test_unknown_barcode(self):
+        response = self.scan('0000000000000')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(SaleItem.objects.exists())
+
+    def test_new_line(self):
+        response = self.scan('6130000000001', 2)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['item']['quantity'], data['sale_total'], data['item_count']), (2, 200, 1))
+        self.assertEqual(self.quantities()[0], 8)
+
+    def test_existing_line_is_incremented(self):
+        self.scan('6130000000001')
+        response = self.scan('6130000000001', 3)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['item']['quantity'], 4)
+        self.assertEqual(list(SaleItem.objects.filter(sale=self.sale).values_list('quantity', flat=True)), [4])
+        self.sale.refresh_from_db()
+        self.assertEqual((self.sale.total_amount, self.sale.item_count), (400, 1))
+        self.assertEqual(self.quantities()[0], 6)
+
+    def test_insufficient_stock(self):
+        self.scan('6130000000001', 8)
+        response = self.scan('6130000000001', 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(SaleItem.objects.get(sale=self.sale).quantity, 8)
+        self.assertEqual(self.quantities()[0], 2)
+
+    def test_product_without_quantity(self):
+        Product.objects.filter(pk=self.products[0].pk).update(quantity=None)
+        response = self.scan('6130000000001')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(SaleItem.objects.exists())
+
+
+class SalePdfInvalidationTests(StockTestCase):
+    def setUp(self):
+        pdf_root = tempfile.TemporaryDirectory()
+        self.addCleanup(pdf_root.cleanup)
+        settings_override = override_settings(PDF_ROOT=pdf_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def cache_invoice(self, sale):
+        path = os.path.join(pdf.get_pdf_dir(pdf.CACHE_DIR), f'vente-{sale.pk}-0123.pdf')
+        open(path, 'wb').close()
+        return path
+
+    def test_editing_a_sale_drops_its_invoice(self):
+        sale = Sale.objects.create()
+        other_sale = Sale.objects.create()
+        save_sale_items(new_items=[SaleItem(sale=sale, product=self.products[0], quantity=1, sale_price=100)])
+        path = self.cache_invoice(sale)
+        other_path = self.cache_invoice(other_sale)
+
+        item = SaleItem.objects.get(sale=sale)
+        item.quantity = 3
+        with self.captureOnCommitCallbacks(execute=True):
+            save_sale_items(changed_items=[item])
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(other_path))
+
+    def test_synchronised_sales_drop_their_invoices(self):
+        sale = Sale(idempotency_key='t1-1')
+        with self.captureOnCommitCallbacks() as callbacks:
+            create_sales([(sale, [SaleItem(product=self.products[0], quantity=1, sale_price=100)])])
+        path = self.cache_invoice(sale)
+        for callback in callbacks:
+            callback()
+        self.assertFalse(os.path.exists(path))
+
+
+class StockLedgerTests(StockTestCase):
+    def assertLedgerMatches(self):
+        ids = [product.pk for product in self.products]
+        self.assertEqual(ledger_quantities(ids), dict(zip(ids, self.quantities())))
+
+    def test_ledger_follows_the_documents(self):
+        sale = Sale.objects.create()
+        save_sale_items(new_items=[SaleItem(sale=sale, product=product, quantity=2, sale_price=100)
+                                   for product in self.products[:3]])
+        self.assertLedgerMatches()
+
+        item = SaleItem.objects.filter(sale=sale).order_by('pk').first()
+        item.quantity = 4
+        item.save()
+        self.assertLedgerMatches()
+
+        delete_sale_items(sale)
+        self.assertLedgerMatches()
+
+        purchase_order = PurchaseOrder.objects.create()
+        items = [PurchaseOrderItem.objects.create(purchase_order=purchase_order, product=product, quantity=5)
+                 for product in self.products[3:]]
+        receive_purchase_order_items(purchase_order, items)
+        self.assertEqual(self.quantities(), [10, 10, 10, 15, 15])
+        self.assertLedgerMatches()
+
+        output = StringIO()
+        call_command('reconcile_stock', stdout=output)
+        self.assertIn('5 produit(s) vérifié(s), 0 écart(s).', output.getvalue())
+
+    def test_snapshots(self):
+        ids = [product.pk for product in self.products]
+        adjust_product_quantities({ids[0]: -3}, 'Ajustement')
+        self.assertEqual(take_stock_snapshots(chunk_size=2), 5)
+        before = timezone.now()
+        adjust_product_quantities({ids[0]: -2, ids[1]: 4}, 'Ajustement')
+
+        # The movements recorded after the snapshot are added to it
+        self.assertEqual(StockSnapshot.objects.count(), 5)
+        self.assertLedgerMatches()
+        self.assertEqual(stock_as_of(ids[:2], before), {ids[0]: 7, ids[1]: 10})
+        self.assertEqual(stock_as_of(ids[:2], timezone.now()), {ids[0]: 5, ids[1]: 14})
+
+    def test_reconcile_stock_reports_drift(self):
+        Product.objects.filter(pk=self.products[0].pk).update(quantity=12)
+        with self.assertRaises(CommandError):
+            call_command('reconcile_stock', stdout=StringIO())
+        call_command('reconcile_stock', '--fix', stdout=StringIO())
+        self.assertLedgerMatches()
+
+
+class SaleSyncTests(StockTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        employee = Employee.objects.create(first_name='Amine', last_name='Caisse', phone='0550000001',
+                                           email='caisse@example.com', address='Alger', role='Employé')
+        cls.account = Account.objects.create_user('caisse', 'motdepasse', employee=employee)
+
+    def setUp(self):
+        self.client.force_login(self.account)
+
+    def sync(self, sales):
+        return self.client.post(reverse('sync-sales'), json.dumps({'sales': sales}), content_type='application/json')
+
+    def sale_data(self, key, product, quantity=1):
+        return {'idempotency_key': key, 'client': None,
+                'lines': [{'product': product.pk, 'quantity': quantity, 'sale_price': 100}]}
+
+    def test_replayed_batch(self):
+        batch = [self.sale_data('t1-1', self.products[0]), self.sale_data('t1-2', self.products[1])]
+        response = self.sync(batch)
+        self.assertEqual(response.status_code, 201)
+        created = response.json()['created']
+
+        response = self.sync(batch)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'created': {}, 'existing': created})
+        self.assertEqual(self.quantities(), [9, 9, 10, 10, 10])
+
+    def test_replay_of_deleted_client(self):
+        # The synchronised sales are not validated again, a terminal can always clear its queue
+        client = Client.objects.create(first_name='Jean', last_name='Dupont', phone='0550000003',
+                                       email='jean@example.com', address='Oran')
+        batch = [dict(self.sale_data('t1-1', self.products[0]), client=client.pk)]
+        created = self.sync(batch).json()['created']
+        client.delete()
+
+        response = self.sync(batch)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['existing'], created)
+
+    def test_sale_rung_up_yesterday(self):
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        client = Client.objects.create(first_name='Jean', last_name='Dupont', phone='0550000003',
+                                       email='jean@example.com', address='Oran')
+        sale_data = dict(self.sale_data('t1-1', self.products[0], 2), client=client.pk, sale_date=str(yesterday))
+        response = self.sync([sale_data])
+        self.assertEqual(response.status_code, 201)
+
+        sale = Sale.objects.get(pk=response.json()['created']['t1-1'])
+        self.assertEqual(sale.sale_date, yesterday)
+        rollup = DailySalesRollup.objects.get(date=yesterday)
+        self.assertEqual((rollup.sale_count, rollup.revenue), (1, 200))
+        self.assertFalse(DailySalesRollup.objects.filter(date=datetime.date.today()).exists())
+        self.assertEqual(client.summary.last_visit, yesterday)
+
+    def test_sale_in_the_future(self):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        response = self.sync([dict(self.sale_data('t1-1', self.products[0]), sale_date=str(tomorrow))])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('sale_date', response.json()['errors']['0'])
+        self.assertFalse(Sale.objects.exists())
+
+    def test_partial_replay(self):
+        first = self.sync([self.sale_data('t1-1', self.products[0])]).json()['created']
+        response = self.sync([self.sale_data('t1-1', self.products[0]), self.sale_data('t1-2', self.products[1])])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['existing'], first)
+        self.assertEqual(list(response.json()['created']), ['t1-2'])
+        self.assertEqual(self.quantities(), [9, 9, 10, 10, 10])
+
+    def test_stock_conflict(self):
+        response = self.sync([self.sale_data('t1-1', self.products[0], 6), self.sale_data('t1-2', self.products[0], 6)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']), {'0', '1'})
+        self.assertFalse(Sale.objects.exists())
+        self.assertEqual(self.quantities(), [10] * 5)
+
+    def test_stock_changed_during_sync(self):
+        def sell_first(sales):
+            # The stock is sold by another checkout between the check and the creation
+            adjust_product_quantities({self.products[0].pk: -10}, 'Ajustement')
+            return create_sales(sales)
+
+        with mock.patch.object(views, 'create_sales', sell_first):
+            response = self.sync([self.sale_data('t1-1', self.products[0])])
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Sale.objects.exists())
+
+    def test_concurrent_attempt(self):
+        def commit_first(sales):
+            # Another attempt with the first key is committed between the check and the creation
+            if not Sale.objects.exists():
+                create_sales([(Sale(idempotency_key='t1-1'), [SaleItem(product=self.products[0], quantity=1,
+                                                                       sale_price=100)])])
+            return create_sales(sales)
+
+        with mock.patch.object(views, 'create_sales', commit_first):
+            response = self.sync([self.sale_data('t1-1', self.products[0]), self.sale_data('t1-2', self.products[1])])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(response.json()['existing']), ['t1-1'])
+        self.assertEqual(list(response.json()['created']), ['t1-2'])
+        self.assertEqual(self.quantities(), [9, 9, 10, 10, 10])
+
+
+class KeysetPaginatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Several sales on the same days, the pk breaks the ties
+        start = datetime.date(2024, 1, 1)
+        for days in [0, 0, 0, 1, 1, 2, 2]:
+            sale = Sale.objects.create()
+            Sale.objects.filter(pk=sale.pk).update(sale_date=start + datetime.timedelta(days=days))
+        cls.ordered = list(Sale.objects.order_by('-sale_date', '-pk').values_list('pk', flat=True))
+
+    def paginator(self):
+        return KeysetPaginator(Sale.objects.all(), ['-sale_date', '-pk'], 3)
+
+    def pks(self, page):
+        return [sale.pk for sale in page]
+
+    def test_next_pages(self):
+        paginator = self.paginator()
+        page = paginator.page()
+        self.assertEqual(self.pks(page), self.ordered[:3])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+        page = paginator.page(page.next_cursor)
+        self.assertEqual(self.pks(page), self.ordered[3:6])
+        self.assertTrue(page.has_previous())
+
+        page = paginator.page(page.next_cursor)
+        self.assertEqual(self.pks(page), self.ordered[6:])
+        self.assertFalse(page.has_next())
+        self.assertIsNone(page.next_cursor)
+
+    def test_previous_pages(self):
+        paginator = self.paginator()
+        last = paginator.page(paginator.page(paginator.page().next_cursor).next_cursor)
+        page = paginator.page(last.previous_cursor)
+        self.assertEqual(self.pks(page), self.ordered[3:6])
+        page = paginator.page(page.previous_cursor)
+        self.assertEqual(self.pks(page), self.ordered[:3])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_last_page(self):
+        page = self.paginator().page(KeysetPaginator.last_cursor())
+        # The last page is full, the first one holds the remainder when going backwards
+        self.assertEqual(self.pks(page), self.ordered[4:])
+        self.assertFalse(page.has_next())
+        self.assertTrue(page.has_previous())
+        self.assertEqual(self.pks(self.paginator().page(page.previous_cursor)), self.ordered[1:4])
+
+    def test_first_page(self):
+        self.assertEqual(self.pks(self.paginator().page(KeysetPaginator.first_cursor())), self.ordered[:3])
+
+    def test_invalid_cursors(self):
+        for cursor in ['n', 'not-base64!', encode_cursor('x', [1]), encode_cursor('n', ['2024-01-01']),
+                       encode_cursor('n', ['date', 1]), encode_cursor('n', 'abc')]:
+            page = self.paginator().page(cursor)
+            self.assertEqual(self.pks(page), self.ordered[:3], cursor)
+
+
+@override_settings(PDF_WORKERS=2)
+class PdfExecutorTests(TestCase):
+    def setUp(self):
+        executor = pdf._executor
+        self.addCleanup(setattr, pdf, '_executor', executor)
+
+    def test_broken_pool_is_replaced(self):
+        # A worker died: the pool refuses every submission
+        broken = mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool()
+        pdf._executor = broken
+        with mock.patch.object(pdf, 'ProcessPoolExecutor') as executor_class:
+            future = pdf.submit_rendering(pdf.write_pdf, '<p>Facture</p>', 'facture.pdf')
+        broken.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+        executor_class.return_value.submit.assert_called_once_with(pdf.write_pdf, '<p>Facture</p>', 'facture.pdf')
+        self.assertIs(future, executor_class.return_value.submit.return_value)
+        self.assertIs(pdf._executor, executor_class.return_value)
+
+    def test_working_pool_is_kept(self):
+        working = mock.Mock()
+        pdf._executor = working
+        with mock.patch.object(pdf, 'ProcessPoolExecutor') as executor_class:
+            pdf.submit_rendering(pdf.write_pdf, '<p>Facture</p>', 'facture.pdf')
+        executor_class.assert_not_called()
+        self.assertIs(pdf._executor, working)
+
+
+class PdfResponseTests(TestCase):
+    def setUp(self):
+        pdf_root = tempfile.TemporaryDirectory()
+        self.addCleanup(pdf_root.cleanup)
+        settings_override = override_settings(PDF_ROOT=pdf_root.name, PDF_WORKERS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.request = RequestFactory().get('/vente/1/facture/')
+
+    def test_cached_file_deleted_before_opening(self):
+        cached_pdf = mock.Mock(path='vente-1.pdf', key='0123')
+        with mock.patch.object(views, 'render_pdf', side_effect=[(cached_pdf, None), (cached_pdf, 'job')]), \
+                mock.patch.object(views, 'pdf_file_response', side_effect=FileNotFoundError):
+            response = views.pdf_response(self.request, 'facturevente.html', {}, 'vente', 1, 'facture.pdf')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, reverse('pdf-job', kwargs={'job_id': 'job'}))
+
+    def test_job_file_deleted_before_opening(self):
+        employee = Employee.objects.create(first_name='Amine', last_name='Caisse', phone='0550000001',
+                                           email='caisse@example.com', address='Alger', role='Employé')
+        self.client.force_login(Account.objects.create_user('caisse', 'motdepasse', employee=employee))
+        job_id = pdf.render_merged_pdf(['<p>Facture</p>'], 'factures.pdf')
+        self.assertEqual(pdf.get_job(job_id).status, pdf.PdfJob.DONE)
+        with mock.patch.object(views, 'pdf_file_response', side_effect=FileNotFoundError):
+            response = self.client.get(reverse('pdf-job', kwargs={'job_id': job_id}))
+        self.assertEqual(response.status_code, 410)
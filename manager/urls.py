@@ -1,11 +1,14 @@
 from django.urls import path
 from . import views
+from .api import RESOURCES, ApiListView
 from django.contrib.auth import views as auth_views
 
 urlpatterns = [
     path('login/',views.UserLoginView.as_view(),name='login'),
     path('ajouter-client/', views.AddClientView.as_view(), name='add-client'),
     path('clients/', views.ClientListView.as_view(), name='client-list'),
+    path('clients/meilleurs/', views.TopClientsView.as_view(), name='top-clients'),
+    path('clients/appelant/', views.CallerLookupView.as_view(), name='caller-lookup'),
     path('client/<int:pk>/', views.ClientDetailView.as_view(), name='client-detail'),
     path('client/<int:pk>/ventes/', views.ClientSalesListView.as_view(), name='client-sales'),
     path('client/<int:pk>/reparations/', views.ClientRepairsListView.as_view(), name='client-repairs'),
@@ -42,11 +45,16 @@ urlpatterns = [
     path('commande/<int:pk>/livrer/', views.PurchaseOrderDeliverView.as_view(), name='deliver-purchase-order'),
     path('ventes/', views.SaleListView.as_view(), name='sale-list'),
     path('ajouter-vente/', views.AddSaleView.as_view(), name='add-sale'),
+    path('ventes/synchroniser/', views.SaleSyncView.as_view(), name='sync-sales'),
     path('vente/<int:pk>/', views.SaleDetailView.as_view(), name='sale-detail'),
     path('vente/<int:pk>/modifier/', views.SaleUpdateView.as_view(), name='update-sale'),
     path('vente/<int:pk>/annuler/', views.SaleCancelView.as_view(), name='cancel-sale'),
     path('vente/<int:pk>/facture/', views.SaleInvoiceView.as_view(), name='sale-invoice'),
+    path('vente/<int:pk>/ticket/', views.SaleTicketView.as_view(), name='sale-ticket'),
+    path('vente/<int:pk>/scanner/', views.SaleScanView.as_view(), name='scan-sale-item'),
     path('produit/<int:pk>/prix_vente_initial/', views.ProductInitialSellingPriceView.as_view(), name='initial-sale-price'),
+    path('produits/prix_vente/', views.ProductSellingPricesView.as_view(), name='selling-prices'),
+    path('produits/recherche/', views.ProductSearchView.as_view(), name='product-search'),
     #path('produit/<int:pk>/prix_achat_initial/', views.ProductInitialPurchasePriceView.as_view(), name='initial-purchase-price'),
     path('stock/', views.ProductListView.as_view(), name='products-list'),
     path('reparations/', views.RepairListView.as_view(), name='repair-list'),
@@ -58,13 +66,23 @@ urlpatterns = [
     path('reparation/<int:pk>/payer/', views.RepairPayView.as_view(), name='pay-repair'),
     path('reparation/<int:pk>/facture/', views.RepairInvoiceView.as_view(), name='repair-invoice'),
     path('reparation/<int:pk>/bon/', views.RepairReceiptView.as_view(), name='repair-receipt'),
+    path('reparation/<int:pk>/ticket/', views.RepairTicketView.as_view(), name='repair-ticket'),
     path('materiels-a-reparer/', views.HardwareToRepairListView.as_view(), name='hardware-list'),
     path('ajouter-materiel-a-reparer/', views.AddHardwareToRepairView.as_view(), name='add-hardware'),
     path('materiel-a-reparer/<int:pk>/', views.HardwareToRepairDetailView.as_view(), name='hardware-detail'),
     path('materiel-a-reparer/<int:pk>/modifier/', views.HardwareToRepairUpdateView.as_view(), name='update-hardware'),
     path('materiel-a-reparer/<int:pk>/supprimer/', views.HardwareToRepairDeleteView.as_view(), name='delete-hardware'),
+    path('documents/exporter/', views.DocumentExportView.as_view(), name='export-documents'),
+    path('document/<str:job_id>/', views.PdfJobView.as_view(), name='pdf-job'),
     path('', views.HomeView.as_view(), name='home'),
+    path('recherche/', views.SearchView.as_view(), name='search'),
     path('dashboard/', views.DashboardView.as_view(), name='dashboard'),
     path('logout/', views.CustomLogoutView.as_view(), name='logout'),
     # path('test/', views.TestView.as_view(), name='test'),
+]
+
+# Read-only JSON API, one list per resource
+urlpatterns += [
+    path(f'api/v1/{name}/', ApiListView.as_view(resource_name=name), name=f'api-{name}')
+    for name in RESOURCES
 ]
\ No newline at end of file
@@ -1,25 +1,44 @@
-from io import BytesIO
-
-from django.db.models import Sum, F
+import datetime
+import hashlib
+import json
+import os
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef, Prefetch, Q, Value
+from django.db.models.functions import Concat, Upper
 from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 
 from django.contrib.auth.views import LoginView, PasswordChangeView, LogoutView
 from django.contrib import messages
-from django.http import JsonResponse, Http404, FileResponse, HttpResponseRedirect
+from django.http import JsonResponse, Http404, FileResponse, HttpResponse, HttpResponseRedirect, \
+    StreamingHttpResponse
 from django.shortcuts import redirect, get_object_or_404, render
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin, AccessMixin
 from django.views import View
 from django.views.generic.edit import CreateView, UpdateView, DeleteView, FormView
 from django.views.generic import ListView, TemplateView, DetailView
 from django.urls import reverse_lazy, reverse
-from weasyprint import HTML
 
 from .models import Client, Supplier, Product, Account, Employee, PurchaseOrder, Sale, Repair, Category, SaleItem, \
-    PurchaseOrderItem, HardwareToRepair
+    PurchaseOrderItem, HardwareToRepair, Suppliying, ClientSummary
 from .forms import ClientForm, UserLoginForm, FilterForm, SupplierForm, ProductForm, AccountRegistrationForm, \
-    EmployeeForm, CategoryForm, SaleForm, SaleItemFormSet, SaleItemForm, PurchaseOrderForm, PurchaseOrderItemFormSet, \
-    PurchaseOrderItemForm, RepairForm, CustomSetPasswordForm, HardwareToRepairForm, PurchaseOrderItemDeliveredFormSet
+    EmployeeForm, CategoryForm, SaleForm, SaleItemFormSet, PurchaseOrderForm, PurchaseOrderItemFormSet, \
+    RepairForm, CustomSetPasswordForm, HardwareToRepairForm, PurchaseOrderItemDeliveredFormSet, SyncSaleForm, \
+    SyncSaleItemForm, DocumentExportForm, ProductFilterForm
+from .counts import COUNTED_FIELDS, CachedCountPaginator
+from .pagination import KeysetPaginator
+from .pdf import PdfJob, get_job, iter_pdf_files, render_merged_pdf, render_pdf, zip_pdf_files
+from .phones import phone_digits
+from .receipts import repair_receipt, sale_receipt
+from .rollups import dashboard_figures
+from .search import search
+from .stock import InsufficientStockError, create_sales, receive_purchase_order_items, save_sale_items
 
 
 class RoleRequiredMixin(AccessMixin):
@@ -37,6 +56,212 @@ class RoleRequiredMixin(AccessMixin):
         return super().dispatch(request, *args, **kwargs)
 
 
+class FileRange:
+    """Read-only view of a slice of an open file, streamed by FileResponse."""
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_byte_range(header, size):
+    """Return the (start, end) positions, end included, of a single byte range request.
+
+    Return None when the whole file must be sent (no range, several ranges or an invalid
+    header) and raise ValueError when the range is outside of the file.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        # Suffix range, the last bytes of the file
+        if not int(end):
+            raise ValueError(header)
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        raise ValueError(header)
+    if start > end:
+        return None
+    return start, end
+
+
+def pdf_file_response(request, path, key, filename):
+    """Serve a rendered PDF, or a 304 when the client already has this version.
+
+    The file is streamed from the disk, and a single byte range can be requested so
+    that PDF viewers can load large documents page by page. Raise FileNotFoundError
+    when the file was deleted from the cache in the meantime.
+    """
+    pdf_file = open(path, 'rb')
+    stat = os.fstat(pdf_file.fileno())
+    size, last_modified = stat.st_size, int(stat.st_mtime)
+    etag = quote_etag(key)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        pdf_file.close()
+    else:
+        byte_range = None
+        # A range only applies to the version of the document the client already has part of
+        if_range = request.headers.get('If-Range')
+        if request.headers.get('Range') and (not if_range or if_range in (etag, http_date(last_modified))):
+            try:
+                byte_range = parse_byte_range(request.headers['Range'], size)
+            except ValueError:
+                pdf_file.close()
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+        if byte_range is None:
+            response = FileResponse(pdf_file, content_type='application/pdf', filename=filename)
+        else:
+            start, end = byte_range
+            response = FileResponse(FileRange(pdf_file, start, end - start + 1), status=206,
+                                    content_type='application/pdf', filename=filename)
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # The URL of a document stays the same when it changes, the client must revalidate
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def pdf_response(request, template_name, data, document, pk, filename):
+    """Serve a document from the PDF cache, or redirect to the page waiting for its rendering."""
+    for attempt in range(2):
+        cached_pdf, job_id = render_pdf(template_name, data, document, pk, filename)
+        if job_id is not None:
+            return redirect('pdf-job', job_id=job_id)
+        try:
+            return pdf_file_response(request, cached_pdf.path, cached_pdf.key, filename)
+        except FileNotFoundError:
+            # Evicted or invalidated since render_pdf found it in the cache, it is rendered again
+            continue
+    return redirect(request.get_full_path())
+
+
+def sale_invoice_data(sale, sale_items):
+    # Calculate the total for each item
+    item_totals = [item.sale_price * item.quantity for item in sale_items]
+    return {
+        'sale': sale,
+        # Check if there are any sale items
+        'sale_items_exist': True,
+        'sale_items': zip(sale_items, item_totals),
+        # The total for the sale is stored on the sale
+        'sale_total': sale.total_amount,
+    }
+
+
+def purchase_order_data(purchase_order, purchase_order_items):
+    return {
+        'purchase_order': purchase_order,
+        'purchase_order_items': purchase_order_items,
+        # Check if there are any purchase order items
+        'purchase_order_items_exist': bool(purchase_order_items),
+    }
+
+
+class FilteredListView(ListView):
+    """List view filtered by the id given in FilterForm.
+
+    The related objects shown by the template are declared in related_fields and loaded
+    with the list, and only the columns in only_fields are read, so that a page costs a
+    fixed number of queries. Lists nested in a parent object (the sales of a client...)
+    set parent_model and parent_field, the parent is then read once per request.
+
+    Lists of growing tables set keyset_ordering, the fields of their order ending by a
+    unique one, to be paginated by KeysetPaginator: pages are addressed by a cursor
+    parameter instead of a page number, and the rows are never counted. The other lists
+    read their number of rows from the counts stored by manager.counts, unless they are
+    filtered by the form.
+    """
+    paginate_by = 7
+    form_class = FilterForm
+    ordering = ['pk']
+    keyset_ordering = None
+    related_fields = ()
+    only_fields = ()
+    parent_model = None
+    parent_field = None
+    parent_context_object_name = None
+
+    def get_parent(self):
+        if not hasattr(self, 'parent'):
+            self.parent = get_object_or_404(self.parent_model, pk=self.kwargs['pk'])
+        return self.parent
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.parent_model:
+            queryset = queryset.filter(**{self.parent_field: self.get_parent()})
+        if self.related_fields:
+            queryset = queryset.select_related(*self.related_fields)
+        if self.only_fields:
+            queryset = queryset.only(*self.only_fields)
+        form = self.get_filter_form()
+        if form.is_valid() and form.cleaned_data['query'] is not None:
+            queryset = queryset.filter(id=form.cleaned_data['query'])
+        return queryset
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_ordering:
+            return super().paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, self.keyset_ordering, page_size)
+        page = paginator.page(self.request.GET.get('cursor'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_count_filter(self):
+        """(field, value) of the stored count of the listed rows, or None if they have to be counted."""
+        counted_fields = COUNTED_FIELDS.get(self.model)
+        form = self.get_filter_form()
+        if counted_fields is None or (form.is_valid() and form.cleaned_data['query'] is not None):
+            return None
+        if not self.parent_model:
+            return '', 0
+        if self.parent_field in counted_fields:
+            return self.parent_field, self.get_parent().pk
+        return None
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        count_filter = self.get_count_filter()
+        if count_filter is None:
+            return super().get_paginator(queryset, per_page, **kwargs)
+        return CachedCountPaginator(queryset, per_page, count_filter=count_filter, **kwargs)
+
+    def get_filter_form(self):
+        if not hasattr(self, 'filter_form'):
+            self.filter_form = self.form_class(self.request.GET)
+        return self.filter_form
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['form'] = self.get_filter_form()
+        # Filters of the list, kept by the page links
+        querystring = self.request.GET.copy()
+        querystring.pop('page', None)
+        querystring.pop('cursor', None)
+        context['querystring'] = querystring.urlencode()
+        if self.parent_model:
+            context[self.parent_context_object_name] = self.get_parent()
+        return context
+
+
 class UserLoginView(LoginView):
     template_name = 'login.html'  # Specify the template for the login page
     form_class = UserLoginForm
@@ -56,37 +281,60 @@ class AddClientView(LoginRequiredMixin, CreateView):
     template_name = 'client_form.html'
     success_url = reverse_lazy('client-list')
 
-class ClientListView(LoginRequiredMixin, ListView):
+class ClientListView(LoginRequiredMixin, FilteredListView):
     model = Client
     template_name = 'listeclient.html'
     context_object_name = 'clients'
-    form_class = FilterForm
-    paginate_by = 7
-
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        return context
 
 class ClientDetailView(LoginRequiredMixin, DetailView):
     model = Client
     template_name = 'detaillclient.html'
     context_object_name = 'client'
 
+    def get_queryset(self):
+        # The client and its summary are read with a single query
+        return super().get_queryset().select_related('summary')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        client = get_object_or_404(Client, pk=self.kwargs['pk'])
-        context['num_sales'] = Sale.objects.filter(client=client).count()
-        context['num_repairs'] = Repair.objects.filter(client=client).count()
-        context['rest_to_pay'] = Repair.objects.filter(client=client, delivery_date=None).annotate(to_pay=F('repair_price') - F('prepayment')).aggregate(rest_to_pay=Sum('to_pay'))['rest_to_pay'] or 0
+        try:
+            summary = self.object.summary
+        except ClientSummary.DoesNotExist:
+            # No sale and no repair yet
+            summary = ClientSummary(client=self.object)
+        context['summary'] = summary
+        context['num_sales'] = summary.sale_count
+        context['num_repairs'] = summary.repair_count
+        context['rest_to_pay'] = summary.outstanding_balance
         return context
+
+
+class TopClientsView(LoginRequiredMixin, ListView):
+    """Clients who spent the most, read from their summaries in the order of the index."""
+    model = ClientSummary
+    template_name = 'meilleursclients.html'
+    context_object_name = 'summaries'
+    top_count = 50
+
+    def get_queryset(self):
+        return ClientSummary.objects.filter(total_spent__gt=0).select_related('client').order_by(
+            '-total_spent', 'client')[:self.top_count]
+
+
+class CallerLookupView(LoginRequiredMixin, View):
+    """Client calling from a number given in any format, ?numero=+213 550 00 00 03, found with one indexed query."""
+
+    def get(self, request, *args, **kwargs):
+        digits = phone_digits(request.GET.get('numero', ''))
+        if digits is None:
+            return JsonResponse({'error': 'Numéro de téléphone invalide.'}, status=400)
+        client = Client.objects.filter(phone_digits=digits).values('id', 'first_name', 'last_name').first()
+        if client is None:
+            return JsonResponse({'error': 'Aucun client avec ce numéro.', 'numero': f'+{digits}'}, status=404)
+        client['url'] = reverse('client-detail', kwargs={'pk': client['id']})
+        return JsonResponse({'client': client, 'numero': f'+{digits}'})
+
+
 class ClientUpdateView(LoginRequiredMixin, UpdateView):
     model = Client
     form_class = ClientForm
@@ -99,49 +347,26 @@ class ClientDeleteView(LoginRequiredMixin, DeleteView):
     template_name = 'supprimerclient.html'
     success_url = reverse_lazy('client-list')
 
-class ClientSalesListView(LoginRequiredMixin, RoleRequiredMixin, ListView):
+class ClientSalesListView(LoginRequiredMixin, RoleRequiredMixin, FilteredListView):
     model = Sale
     template_name = 'listeventeclient.html'
     context_object_name = 'sales'
-    paginate_by = 7
     required_roles = ['Admin', 'Employé']
+    only_fields = ('id', 'sale_date', 'total_amount', 'item_count')
+    parent_model = Client
+    parent_field = 'client'
+    parent_context_object_name = 'client'
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        client = get_object_or_404(Client, pk=self.kwargs['pk'])
-        context['client'] = client
-        return context
-
-    def get_queryset(self):
-        client = get_object_or_404(Client, pk=self.kwargs['pk'])
-        queryset = Sale.objects.filter(client=client)
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-class ClientRepairsListView(LoginRequiredMixin, RoleRequiredMixin, ListView):
+class ClientRepairsListView(LoginRequiredMixin, RoleRequiredMixin, FilteredListView):
     model = Repair
     template_name = 'listereparationclient.html'
     context_object_name = 'repairs'
-    paginate_by = 7
     required_roles = ['Admin', 'Réparateur']
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        client = get_object_or_404(Client, pk=self.kwargs['pk'])
-        context['client'] = client
-        return context
-
-    def get_queryset(self):
-        client = get_object_or_404(Client, pk=self.kwargs['pk'])
-        queryset = Repair.objects.filter(client=client)
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
+    related_fields = ('hardware',)
+    only_fields = ('id', 'title', 'state', 'deposit_date', 'repair_price', 'hardware__name')
+    parent_model = Client
+    parent_field = 'client'
+    parent_context_object_name = 'client'
 
 
 class AddSupplierView(LoginRequiredMixin,RoleRequiredMixin, CreateView):
@@ -152,26 +377,12 @@ class AddSupplierView(LoginRequiredMixin,RoleRequiredMixin, CreateView):
     required_roles = ['Admin', 'Employé']
 
 
-class SupplierListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class SupplierListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = Supplier
     template_name = 'listefournisseur.html'
     context_object_name = 'suppliers'
-    paginate_by = 7
-    form_class = FilterForm
     required_roles = ['Admin', 'Employé']
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        return context
-
 class SupplierDetailView(LoginRequiredMixin, RoleRequiredMixin, DetailView):
     model = Supplier
     template_name = 'detaillfournisseur.html'
@@ -198,49 +409,25 @@ class SupplierDeleteView(LoginRequiredMixin,RoleRequiredMixin, DeleteView):
     success_url = reverse_lazy('supplier-list')
     required_roles = ['Admin', 'Employé']
 
-class SupplierPurchaseOrdersListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class SupplierPurchaseOrdersListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = PurchaseOrder
     template_name = 'listecommandefournisseur.html'
     context_object_name = 'purchase_orders'
-    paginate_by = 7
     required_roles = ['Admin', 'Employé']
+    parent_model = Supplier
+    parent_field = 'supplier'
+    parent_context_object_name = 'supplier'
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        supplier = get_object_or_404(Supplier, pk=self.kwargs['pk'])
-        context['supplier'] = supplier
-        return context
-
-    def get_queryset(self):
-        supplier = get_object_or_404(Supplier, pk=self.kwargs['pk'])
-        queryset = PurchaseOrder.objects.filter(supplier=supplier)
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-class SupplierProductsListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class SupplierProductsListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = Product
     template_name = 'listeproduitfournisseur.html'
     context_object_name = 'products'
-    paginate_by = 7
     required_roles = ['Admin', 'Employé']
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        supplier = get_object_or_404(Supplier, pk=self.kwargs['pk'])
-        context['supplier'] = supplier
-        return context
-
-    def get_queryset(self):
-        supplier = get_object_or_404(Supplier, pk=self.kwargs['pk'])
-        queryset = Product.objects.filter(suppliers__in=[supplier])
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
+    related_fields = ('category',)
+    only_fields = ('id', 'name', 'quantity', 'initial_selling_price', 'category__name')
+    parent_model = Supplier
+    parent_field = 'suppliers'
+    parent_context_object_name = 'supplier'
 
 
 class AddProductView(LoginRequiredMixin,RoleRequiredMixin, CreateView):
@@ -251,24 +438,58 @@ class AddProductView(LoginRequiredMixin,RoleRequiredMixin, CreateView):
     required_roles = ['Admin', 'Employé']
 
 
-class ProductListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class ProductListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = Product
     template_name = 'listeproduit.html'  # replace with your template
     context_object_name = 'products'
-    paginate_by = 7
-    form_class = FilterForm
     required_roles = ['Admin', 'Employé']
+    related_fields = ('category',)
+    only_fields = ('id', 'name', 'quantity', 'initial_selling_price', 'category__name')
+    form_class = ProductFilterForm
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
+        form = self.get_filter_form()
+        if not form.is_valid():
+            return queryset
+        data = form.cleaned_data
+        if data['category']:
+            queryset = queryset.filter(category=data['category'])
+        if data['supplier']:
+            # Read from the supplier's rows of Fournir, a product supplied twice is still listed once
+            queryset = queryset.filter(pk__in=Suppliying.objects.filter(supplier=data['supplier']).values('product'))
+        if data['stock'] == 'rupture':
+            queryset = queryset.filter(Q(quantity=0) | Q(quantity__isnull=True))
+        elif data['stock'] == 'faible':
+            threshold = settings.LOW_STOCK_THRESHOLD if data['threshold'] is None else data['threshold']
+            queryset = queryset.filter(Q(quantity__lt=threshold) | Q(quantity__isnull=True))
+        if data['min_price'] is not None:
+            queryset = queryset.filter(initial_selling_price__gte=data['min_price'])
+        if data['max_price'] is not None:
+            queryset = queryset.filter(initial_selling_price__lte=data['max_price'])
+        if data['sort']:
+            queryset = queryset.order_by(data['sort'], 'pk')
         return queryset
 
+    def get_count_filter(self):
+        form = self.get_filter_form()
+        if not form.is_valid():
+            return super().get_count_filter()
+        filters = {name for name, value in form.cleaned_data.items() if value not in (None, '') and name != 'sort'}
+        # Only the products of a category have a stored count
+        if filters == {'category'}:
+            return 'category', form.cleaned_data['category'].pk
+        return super().get_count_filter() if not filters else None
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
+        # Filters of the list without the sort, kept by the column links
+        querystring = self.request.GET.copy()
+        for name in ('page', 'sort'):
+            querystring.pop(name, None)
+        context['filter_querystring'] = querystring.urlencode()
+        form = self.get_filter_form()
+        context['sort'] = form.cleaned_data.get('sort', '') if form.is_valid() else ''
         return context
 
 
@@ -278,90 +499,46 @@ class ProductDetailView(LoginRequiredMixin,RoleRequiredMixin,DetailView):
     context_object_name = 'product'
     required_roles = ['Admin', 'Employé']
 
-class AccountListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class AccountListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = Account
     template_name = 'listecompte.html'
     context_object_name = 'accounts'
-    paginate_by = 7
-    form_class = FilterForm
     required_roles = ['Admin']
+    related_fields = ('employee',)
+    only_fields = ('id', 'username', 'date_joined', 'employee__first_name', 'employee__last_name')
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        return context
 
 
 
-
-class PurchaseOrderListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class PurchaseOrderListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = PurchaseOrder
     template_name = 'listecommande.html'
     context_object_name = 'purchase_orders'
-    paginate_by = 7
-    form_class = FilterForm
     required_roles = ['Admin', 'Employé']
+    related_fields = ('supplier',)
+    only_fields = ('id', 'order_date', 'delivery_date', 'supplier__name')
+    keyset_ordering = ['-order_date', '-pk']
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        return context
-
-
-class SaleListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class SaleListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = Sale
     template_name = 'listevente.html'
     context_object_name = 'sales'
-    paginate_by = 7
-    form_class = FilterForm
     required_roles = ['Admin', 'Employé']
-
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        return context
+    related_fields = ('client',)
+    only_fields = ('id', 'sale_date', 'total_amount', 'item_count', 'client__first_name', 'client__last_name')
+    keyset_ordering = ['-sale_date', '-pk']
 
 
-class RepairListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class RepairListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = Repair
     template_name = 'listereparation.html'
     context_object_name = 'repairs'
-    paginate_by = 7
-    form_class = FilterForm
     required_roles = ['Admin', 'Réparateur']
-
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        return context
+    related_fields = ('client', 'hardware')
+    only_fields = ('id', 'title', 'state', 'deposit_date', 'repair_price', 'client__first_name', 'client__last_name',
+                   'hardware__name')
+    keyset_ordering = ['-deposit_date', '-pk']
 
 
 class HomeView(LoginRequiredMixin, TemplateView):
@@ -371,6 +548,32 @@ class HomeView(LoginRequiredMixin, TemplateView):
 class DashboardView(LoginRequiredMixin, TemplateView):
     template_name = 'dashbord.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # Read from the daily rollups, the cost does not grow with the history of the sales
+        context.update(dashboard_figures())
+        return context
+
+
+class SearchView(LoginRequiredMixin, TemplateView):
+    """Full-text search in the clients, suppliers, products, repairs and hardware the user can see."""
+    template_name = 'recherche.html'
+    page_size = 20
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        try:
+            page = max(int(self.request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        results, has_more = search(query, role=self.request.user.employee.role,
+                                   offset=(page - 1) * self.page_size, limit=self.page_size)
+        for result in results:
+            result.url = reverse(result.kind.url_name, kwargs={'pk': result.pk})
+        context.update({'query': query, 'results': results, 'page': page, 'has_more': has_more})
+        return context
+
 
 class AddAccountView(LoginRequiredMixin,RoleRequiredMixin, CreateView):
     model = Account
@@ -415,26 +618,12 @@ class AddEmployeeView(LoginRequiredMixin, RoleRequiredMixin, CreateView):
 
 
 
-class EmployeeListView(LoginRequiredMixin, RoleRequiredMixin, ListView):
+class EmployeeListView(LoginRequiredMixin, RoleRequiredMixin, FilteredListView):
     model = Employee
     template_name = 'listeemploye.html'
     context_object_name = 'employees'
-    paginate_by = 7
-    form_class = FilterForm
     required_roles = ['Admin']
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        return context
-
 
 
 
@@ -506,28 +695,23 @@ class SaleUpdateView(LoginRequiredMixin,RoleRequiredMixin, FormView):
         kwargs = super().get_form_kwargs()
         self.sale = Sale.objects.get(pk=self.kwargs['pk'])
         kwargs['instance'] = self.sale
-        sale = Sale.objects.get(pk=self.kwargs['pk'])
-        kwargs['queryset'] = SaleItem.objects.filter(sale=sale)
-        kwargs['form_kwargs'] = {'sale': sale}  # Pass the Sale instance to the SaleItemForm
+        kwargs['queryset'] = SaleItem.objects.filter(sale=self.sale).select_related('product')
         return kwargs
 
     def form_valid(self, form):
-
-        instances = form.save(commit=False)
-        for instance in form.deleted_objects:
-            instance.delete()
-        for instance in instances:
-            instance.save()
-        # Clear the submitted_products list
-        SaleItemForm.submitted_products.clear()
+        form.save(commit=False)
+        try:
+            # Save every line and the stock movements in one transaction
+            save_sale_items(new_items=form.new_objects,
+                            changed_items=[instance for instance, changed_fields in form.changed_objects],
+                            deleted_items=form.deleted_objects)
+        except InsufficientStockError:
+            form.non_form_errors().append(
+                "La quantité de produit demandée est supérieure à la quantité en stock.")
+            return self.form_invalid(form)
 
         return super().form_valid(form)
 
-    def form_invalid(self, form):
-        # Clear the submitted_products list
-        SaleItemForm.submitted_products.clear()
-        return super().form_invalid(form)
-
     def post(self, request, *args, **kwargs):
         form = self.get_form()
         if form.is_valid():
@@ -552,11 +736,11 @@ class SaleCancelView(LoginRequiredMixin,RoleRequiredMixin, DeleteView):
     success_url = reverse_lazy('sale-list')
     required_roles = ['Admin', 'Employé']
 
-    def delete(self, request, *args, **kwargs):
-        self.object = self.get_object()
+    def form_valid(self, form):
+        success_url = self.get_success_url()
         self.object.delete_sale(
             update_product_quantity=True)  # Call the delete_sale method with update_product_quantity=True
-        return super().delete(request, *args, **kwargs)
+        return HttpResponseRedirect(success_url)
 
 
 class SaleDetailView(LoginRequiredMixin,RoleRequiredMixin, DetailView):
@@ -567,17 +751,174 @@ class SaleDetailView(LoginRequiredMixin,RoleRequiredMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        sale_items = SaleItem.objects.filter(sale=self.object)
-        context['sale_items_exist'] = sale_items.exists()  # Check if there are any sale items
+        sale_items = SaleItem.objects.filter(sale=self.object).select_related('product')
+        context['sale_items_exist'] = self.object.item_count > 0  # Check if there are any sale items
         # Calculate the total for each item
         item_totals = [item.sale_price * item.quantity for item in sale_items]
-        # Calculate the total for the sale
-        sale_total = sum(item_totals)
         context['sale_items'] = zip(sale_items, item_totals)  # Pass both the items and their totals
-        context['sale_total'] = sale_total
+        # The total for the sale is stored on the sale
+        context['sale_total'] = self.object.total_amount
         return context
 
 
+class SaleScanView(LoginRequiredMixin,RoleRequiredMixin, View):
+    """Add the product of a scanned barcode to a sale, or increment its line, in a single request."""
+    required_roles = ['Admin', 'Employé']
+
+    def post(self, request, *args, **kwargs):
+        sale = get_object_or_404(Sale, pk=kwargs['pk'])
+        code = request.POST.get('code', '').strip()
+        try:
+            quantity = int(request.POST.get('quantity', 1))
+        except ValueError:
+            quantity = 0
+        if quantity < 1:
+            return JsonResponse({'error': 'La quantité doit être supérieure à 0.'}, status=400)
+
+        product = Product.objects.filter(barcode=code).only('pk', 'name', 'quantity', 'initial_selling_price').first()
+        if not code or not product:
+            return JsonResponse({'error': 'Aucun produit ne correspond à ce code-barres.'}, status=404)
+        if quantity > (product.quantity or 0):
+            return JsonResponse({'error': 'La quantité de produit demandée est supérieure à la quantité en stock ('
+                                          + str(product.quantity or 0) + ').'}, status=400)
+
+        try:
+            with transaction.atomic():
+                # Locked until the commit, so that concurrent scans of the same barcode add up
+                sale_item = SaleItem.objects.select_for_update().filter(sale=sale, product=product).first()
+                if sale_item:
+                    sale_item.quantity += quantity
+                    save_sale_items(changed_items=[sale_item])
+                else:
+                    sale_item = SaleItem(sale=sale, product=product, quantity=quantity,
+                                         sale_price=product.initial_selling_price)
+                    save_sale_items(new_items=[sale_item])
+        except InsufficientStockError:
+            return JsonResponse({'error': 'La quantité de produit demandée est supérieure à la quantité en stock.'},
+                                status=400)
+
+        sale.refresh_from_db(fields=['total_amount', 'item_count'])
+        return JsonResponse({
+            'item': {
+                'id': sale_item.pk,
+                'product_id': product.pk,
+                'product_name': product.name,
+                'quantity': sale_item.quantity,
+                'sale_price': sale_item.sale_price,
+                'total': sale_item.quantity * sale_item.sale_price,
+            },
+            'sale_total': sale.total_amount,
+            'item_count': sale.item_count,
+        })
+
+
+class SaleSyncView(LoginRequiredMixin,RoleRequiredMixin, View):
+    """Idempotent ingestion of a batch of complete sales recorded offline by a store terminal.
+
+    The body is {"sales": [{"idempotency_key": "...", "client": 1, "sale_date": "2024-01-31",
+    "lines": [{"product": 1, "quantity": 2, "sale_price": 100}]}]}, sale_date is optional. Sales whose key is already known are not created
+    again, the stock of the whole batch is checked, and the new sales are committed together.
+    """
+    required_roles = ['Admin', 'Employé']
+    max_batch_size = 500
+
+    def post(self, request, *args, **kwargs):
+        try:
+            payload = json.loads(request.body)
+            sales_data = payload['sales']
+            if not isinstance(sales_data, list):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({'error': 'Le corps de la requête doit contenir une liste "sales".'}, status=400)
+        if len(sales_data) > self.max_batch_size:
+            return JsonResponse({'error': f'Un lot ne peut pas dépasser {self.max_batch_size} ventes.'}, status=400)
+
+        # Sales already synchronised by a previous attempt are returned as they are, without validating them
+        # again: their products or client may have been deleted since
+        sent_keys = [sale_data['idempotency_key'].strip() for sale_data in sales_data
+                     if isinstance(sale_data, dict) and isinstance(sale_data.get('idempotency_key'), str)]
+        existing = dict(Sale.objects.filter(idempotency_key__in=sent_keys).values_list('idempotency_key', 'pk'))
+
+        # Validate the shape of every other sale and of its lines
+        errors = {}
+        sales = []
+        for index, sale_data in enumerate(sales_data):
+            if (isinstance(sale_data, dict) and isinstance(sale_data.get('idempotency_key'), str)
+                    and sale_data['idempotency_key'].strip() in existing):
+                continue
+            if not isinstance(sale_data, dict) or not isinstance(sale_data.get('lines'), list):
+                errors[index] = {'lines': ['La vente doit contenir une liste de lignes.']}
+                continue
+            sale_form = SyncSaleForm(sale_data)
+            line_forms = [SyncSaleItemForm(line if isinstance(line, dict) else {}) for line in sale_data['lines']]
+            if not sale_form.is_valid() or not all([form.is_valid() for form in line_forms]):
+                errors[index] = sale_form.errors.get_json_data()
+                errors[index]['lines'] = [form.errors.get_json_data() for form in line_forms]
+                continue
+            lines = [form.cleaned_data for form in line_forms]
+            if not lines:
+                errors[index] = {'lines': ['La vente ne contient aucun article.']}
+            elif len({line['product'] for line in lines}) != len(lines):
+                errors[index] = {'lines': ['Un produit apparaît sur plusieurs lignes de la vente.']}
+            sales.append((index, sale_form.cleaned_data, lines))
+
+        if len(set(sent_keys)) != len(sent_keys):
+            return JsonResponse({'error': "Une clé d'idempotence apparaît plusieurs fois dans le lot."}, status=400)
+
+        # Check the clients, the products and the stock of the whole batch with one query each
+        client_ids = {sale['client'] for index, sale, lines in sales if sale['client'] is not None}
+        known_clients = set(Client.objects.filter(pk__in=client_ids).values_list('pk', flat=True))
+        requested = defaultdict(int)
+        for index, sale, lines in sales:
+            for line in lines:
+                requested[line['product']] += line['quantity']
+        stock = dict(Product.objects.filter(pk__in=requested.keys()).values_list('pk', 'quantity'))
+        for index, sale, lines in sales:
+            if sale['client'] is not None and sale['client'] not in known_clients:
+                errors.setdefault(index, {})['client'] = ["Ce client n'existe pas."]
+            for line in lines:
+                if line['product'] not in stock:
+                    errors.setdefault(index, {}).setdefault('lines', []).append(
+                        f"Le produit {line['product']} n'existe pas.")
+                elif requested[line['product']] > (stock[line['product']] or 0):
+                    errors.setdefault(index, {}).setdefault('lines', []).append(
+                        f"La quantité demandée du produit {line['product']} dans le lot est supérieure à la "
+                        f"quantité en stock ({stock[line['product']] or 0}).")
+        if errors:
+            return JsonResponse({'errors': {str(index): error for index, error in sorted(errors.items())}}, status=400)
+
+        created = []
+        while sales:
+            try:
+                created = create_sales([
+                    (Sale(client_id=sale['client'], idempotency_key=sale['idempotency_key'],
+                          sale_date=sale['sale_date'] or datetime.date.today()),
+                     [SaleItem(product_id=line['product'], quantity=line['quantity'], sale_price=line['sale_price'])
+                      for line in lines])
+                    for index, sale, lines in sales
+                ])
+                break
+            except InsufficientStockError:
+                return JsonResponse({'error': 'Le stock a changé pendant la synchronisation, veuillez réessayer.'},
+                                    status=409)
+            except IntegrityError:
+                # Another attempt with some of the same keys was committed in the meantime: its sales are
+                # returned as existing, and the others are created again
+                committed = dict(Sale.objects.filter(
+                    idempotency_key__in=[sale['idempotency_key'] for index, sale, lines in sales]
+                ).values_list('idempotency_key', 'pk'))
+                if not committed:
+                    raise
+                existing.update(committed)
+                sales = [(index, sale, lines) for index, sale, lines in sales
+                         if sale['idempotency_key'] not in committed]
+
+        return JsonResponse({
+            'created': {sale.idempotency_key: sale.pk for sale in created},
+            'existing': existing,
+        }, status=201 if created else 200)
+
+
 class ProductInitialSellingPriceView(LoginRequiredMixin,RoleRequiredMixin, View):
     required_roles = ['Admin', 'Employé']
     def get(self, request, *args, **kwargs):
@@ -589,6 +930,77 @@ class ProductInitialSellingPriceView(LoginRequiredMixin,RoleRequiredMixin, View)
             raise Http404("Product does not exist")
 
 
+class ProductSellingPricesView(LoginRequiredMixin,RoleRequiredMixin, View):
+    """Initial selling price of many products in one response, ?ids=1,2,3 or the whole price list."""
+    required_roles = ['Admin', 'Employé']
+
+    def get(self, request, *args, **kwargs):
+        products = Product.objects.order_by('pk')
+        ids = request.GET.get('ids')
+        if ids:
+            try:
+                products = products.filter(pk__in=[int(pk) for pk in ids.split(',') if pk])
+            except ValueError:
+                return JsonResponse({'error': 'Identifiants de produits invalides.'}, status=400)
+        prices = {str(pk): price for pk, price in products.values_list('pk', 'initial_selling_price')}
+
+        # Version the price list so that the client can revalidate it without downloading it again
+        etag = quote_etag(hashlib.md5(json.dumps(prices, sort_keys=True).encode()).hexdigest())
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse({'prices': prices})
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class ProductSearchView(LoginRequiredMixin,RoleRequiredMixin, View):
+    """Paged typeahead search of the products by id, name prefix or category name prefix."""
+    required_roles = ['Admin', 'Employé']
+    page_size = 20
+
+    @staticmethod
+    def prefix_filter(field, text):
+        # Range on UPPER(field) so that the search can use the functional index, unlike LIKE 'text%'
+        prefix = Upper(Value(text))
+        return {f'{field}__gte': prefix, f'{field}__lt': Concat(prefix, Value(chr(0x10ffff)))}
+
+    def get(self, request, *args, **kwargs):
+        text = request.GET.get('q', '').strip()
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+            supplier = int(request.GET['fournisseur']) if request.GET.get('fournisseur') else None
+        except ValueError:
+            return JsonResponse({'error': 'Paramètres de recherche invalides.'}, status=400)
+
+        products = Product.objects.alias(name_upper=Upper('name'))
+        if supplier is not None:
+            # fournisseur=0 is an order without supplier, none of the products can be chosen
+            products = products.filter(suppliers__in=[supplier])
+        if text:
+            categories = Category.objects.alias(name_upper=Upper('name')).filter(
+                **self.prefix_filter('name_upper', text))
+            condition = Q(**self.prefix_filter('name_upper', text)) | Q(category__in=categories)
+            if text.isdigit():
+                condition |= Q(pk=int(text))
+            products = products.filter(condition)
+
+        # Fetch one more row than the page size to know if there is a next page without counting
+        start = (page - 1) * self.page_size
+        rows = list(products.order_by('name_upper', 'pk').values(
+            'pk', 'name', 'quantity', 'initial_selling_price')[start:start + self.page_size + 1])
+        results = [
+            {
+                'id': row['pk'],
+                'text': f"{row['pk']} - {row['name']}",
+                'quantity': row['quantity'],
+                'initial_selling_price': row['initial_selling_price'],
+            }
+            for row in rows[:self.page_size]
+        ]
+        return JsonResponse({'results': results, 'page': page, 'has_more': len(rows) > self.page_size})
+
+
 class AddPurchaseOrderView(LoginRequiredMixin,RoleRequiredMixin, CreateView):
     model = PurchaseOrder
     template_name = 'ajoutercommande.html'
@@ -612,7 +1024,8 @@ class PurchaseOrderUpdateView(LoginRequiredMixin,RoleRequiredMixin, FormView):
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         kwargs['instance'] = self.purchase_order
-        kwargs['queryset'] = PurchaseOrderItem.objects.filter(purchase_order=self.purchase_order)
+        kwargs['queryset'] = PurchaseOrderItem.objects.filter(purchase_order=self.purchase_order).select_related(
+            'product')
         kwargs['form_kwargs'] = {'purchase_order': self.purchase_order}  # Pass the PurchaseOrder instance to the form
         return kwargs
 
@@ -622,15 +1035,8 @@ class PurchaseOrderUpdateView(LoginRequiredMixin,RoleRequiredMixin, FormView):
             instance.delete()
         for instance in instances:
             instance.save()
-        # Clear the submitted_products list
-        PurchaseOrderItemForm.submitted_products.clear()
         return super().form_valid(form)
 
-    def form_invalid(self, form):
-        # Clear the submitted_products list
-        PurchaseOrderItemForm.submitted_products.clear()
-        return super().form_invalid(form)
-
     def get_success_url(self):
         return reverse_lazy('purchase-order-detail', kwargs={'pk': self.purchase_order.pk})
 
@@ -705,12 +1111,12 @@ class PurchaseOrderDeliverView(LoginRequiredMixin,RoleRequiredMixin, FormView):
         return kwargs
 
     def form_valid(self, form):
-        instances = form.save()
-        for instance in instances:
-            instance.product.quantity += instance.quantity  # Increase the product quantity
-            instance.product.save()
-        self.purchase_order.delivery_date = timezone.now()
-        self.purchase_order.save()
+        with transaction.atomic():
+            form.save()
+            # Increase the product quantities, all the items of the order are delivered
+            receive_purchase_order_items(self.purchase_order, self.purchase_order.purchaseorderitem_set.all())
+            self.purchase_order.delivery_date = timezone.now()
+            self.purchase_order.save()
         return super().form_valid(form)
 
     def get(self, request, *args, **kwargs):
@@ -823,53 +1229,58 @@ class RepairPayView(LoginRequiredMixin,RoleRequiredMixin, View):
 class SaleInvoiceView(LoginRequiredMixin,RoleRequiredMixin,View):
     required_roles = ['Admin', 'Employé']
     def get(self, request, *args, **kwargs):
-        sale = get_object_or_404(Sale, id=self.kwargs['pk'])
-        sale_items = SaleItem.objects.filter(sale=sale)
+        sale = get_object_or_404(Sale.objects.select_related('client'), id=self.kwargs['pk'])
         if not sale.client:
             messages.error(request, "La vente n'a pas de client. Vous ne pouvez pas imprimer la facture.")
-        if (not sale_items.exists()):
+        if not sale.item_count:
             messages.error(request, "La vente ne contient aucun article. Vous ne pouvez pas imprimer la facture.")
-        if not(sale.client and sale_items.exists()):
+        if not(sale.client and sale.item_count):
             return redirect('sale-detail', pk=sale.pk)
-        # Calculate the total for each item
-        item_totals = [item.sale_price * item.quantity for item in sale_items]
-        # Calculate the total for the sale
-        sale_total = sum(item_totals)
-
-        data = {
-            'sale': sale,
-            # Check if there are any sale items
-            'sale_items_exist': sale_items.exists(),
-            'sale_items': zip(sale_items, item_totals),
-            'sale_total': sale_total,
-            # include any other data you need in the template
-        }
-
-        # Rendered html content as a string
-        html_string = render_to_string('facturevente.html', data)
-
-        # Create a WeasyPrint HTML object and write it to PDF
-        html = HTML(string=html_string)
-        pdf_content = BytesIO()
-        html.write_pdf(target=pdf_content)
-
-        # Rewind the BytesIO object to the start
-        pdf_content.seek(0)
-
-        # Create a Django response object, and specify content_type as pdf
-        response = FileResponse(pdf_content, content_type='application/pdf')
+        data = sale_invoice_data(sale, SaleItem.objects.filter(sale=sale).select_related('product'))
+        return pdf_response(request, 'facturevente.html', data, 'vente', sale.pk,
+                            f'facture-vente-{sale.pk}.pdf')
+
+
+class TicketMixin:
+    """Serve a Receipt for a thermal printer, as a PDF, plain text or ESC/POS commands (?format=)."""
+    ticket_formats = {
+        'pdf': ('application/pdf', 'pdf'),
+        'text': ('text/plain; charset=utf-8', 'txt'),
+        'escpos': ('application/octet-stream', 'bin'),
+    }
+
+    def ticket_response(self, receipt, name):
+        ticket_format = self.request.GET.get('format', 'pdf')
+        if ticket_format not in self.ticket_formats:
+            raise Http404("Format de ticket inconnu.")
+        content_type, extension = self.ticket_formats[ticket_format]
+        if ticket_format == 'pdf':
+            content = receipt.to_pdf()
+        elif ticket_format == 'text':
+            content = receipt.to_text()
+        else:
+            content = receipt.to_escpos()
+        response = HttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'inline; filename="{name}.{extension}"'
+        return response
 
-        # Otherwise, set it to "inline"
-        response['Content-Disposition'] = 'inline'
 
-        return response
+class SaleTicketView(LoginRequiredMixin, RoleRequiredMixin, TicketMixin, View):
+    required_roles = ['Admin', 'Employé']
+    def get(self, request, *args, **kwargs):
+        sale = get_object_or_404(Sale.objects.select_related('client'), id=self.kwargs['pk'])
+        if not sale.item_count:
+            messages.error(request, "La vente ne contient aucun article. Vous ne pouvez pas imprimer le ticket.")
+            return redirect('sale-detail', pk=sale.pk)
+        sale_items = SaleItem.objects.filter(sale=sale).select_related('product').order_by('pk')
+        return self.ticket_response(sale_receipt(sale, sale_items), f'ticket-vente-{sale.pk}')
 
 
 class PurchaseOrderPrintView(LoginRequiredMixin, RoleRequiredMixin, View):
     required_roles = ['Admin', 'Employé']
     def get(self, request, *args, **kwargs):
-        purchase_order = get_object_or_404(PurchaseOrder, id=self.kwargs['pk'])
-        purchase_order_items = PurchaseOrderItem.objects.filter(purchase_order=purchase_order)
+        purchase_order = get_object_or_404(PurchaseOrder.objects.select_related('supplier'), id=self.kwargs['pk'])
+        purchase_order_items = PurchaseOrderItem.objects.filter(purchase_order=purchase_order).select_related('product')
         if not purchase_order.supplier:
             messages.error(request, "La commande n'a pas de fournisseur. Vous ne pouvez pas imprimer la commande.")
         if (not purchase_order_items.exists()):
@@ -878,32 +1289,74 @@ class PurchaseOrderPrintView(LoginRequiredMixin, RoleRequiredMixin, View):
             return redirect('purchase-order-detail', pk=purchase_order.pk)
 
 
-        data = {
-            'purchase_order': purchase_order,
-            'purchase_order_items': purchase_order_items,
-            # Check if there are any purchase order items
-            'purchase_order_items_exist': purchase_order_items.exists(),
-            # include any other data you need in the template
-        }
-
-        # Rendered html content as a string
-        html_string = render_to_string('commande_pdf.html', data)
-
-        # Create a WeasyPrint HTML object and write it to PDF
-        html = HTML(string=html_string)
-        pdf_content = BytesIO()
-        html.write_pdf(target=pdf_content)
-
-        # Rewind the BytesIO object to the start
-        pdf_content.seek(0)
+        data = purchase_order_data(purchase_order, purchase_order_items)
+        return pdf_response(request, 'commande_pdf.html', data, 'commande', purchase_order.pk,
+                            f'commande-{purchase_order.pk}.pdf')
 
-        # Create a Django response object, and specify content_type as pdf
-        response = FileResponse(pdf_content, content_type='application/pdf')
 
-        # Otherwise, set it to "inline"
-        response['Content-Disposition'] = 'inline'
+class DocumentExportView(LoginRequiredMixin, RoleRequiredMixin, FormView):
+    """Export every sale invoice or purchase order of a period, as a ZIP archive or a single PDF."""
+    form_class = DocumentExportForm
+    template_name = 'exportdocuments.html'
+    required_roles = ['Admin']
+    # Number of documents read from the database at a time
+    chunk_size = 100
+
+    def get_sales(self, start_date, end_date):
+        # Same conditions as SaleInvoiceView
+        return Sale.objects.filter(
+            sale_date__range=(start_date, end_date), client__isnull=False, item_count__gt=0,
+        ).select_related('client').prefetch_related(
+            Prefetch('saleitem_set', queryset=SaleItem.objects.select_related('product').order_by('pk')),
+        ).order_by('sale_date', 'pk')
+
+    def get_purchase_orders(self, start_date, end_date):
+        # Same conditions as PurchaseOrderPrintView
+        return PurchaseOrder.objects.filter(
+            Exists(PurchaseOrderItem.objects.filter(purchase_order=OuterRef('pk'))),
+            order_date__range=(start_date, end_date), supplier__isnull=False,
+        ).select_related('supplier').prefetch_related(
+            Prefetch('purchaseorderitem_set', queryset=PurchaseOrderItem.objects.select_related('product').order_by('pk')),
+        ).order_by('order_date', 'pk')
+
+    def iter_documents(self, document, queryset):
+        # (template_name, data, document, pk, filename) of each document, read chunk by chunk
+        for obj in queryset.iterator(chunk_size=self.chunk_size):
+            if document == 'vente':
+                yield ('facturevente.html', sale_invoice_data(obj, list(obj.saleitem_set.all())), 'vente', obj.pk,
+                       f'facture-vente-{obj.pk}.pdf')
+            else:
+                yield ('commande_pdf.html', purchase_order_data(obj, list(obj.purchaseorderitem_set.all())),
+                       'commande', obj.pk, f'commande-{obj.pk}.pdf')
 
-        return response
+    def form_valid(self, form):
+        document = form.cleaned_data['document']
+        start_date = form.cleaned_data['start_date']
+        end_date = form.cleaned_data['end_date']
+        if document == 'vente':
+            queryset = self.get_sales(start_date, end_date)
+        else:
+            queryset = self.get_purchase_orders(start_date, end_date)
+        if not queryset.exists():
+            form.add_error(None, "Aucun document pour cette période.")
+            return self.form_invalid(form)
+        name = f'{"factures-vente" if document == "vente" else "commandes"}-{start_date}-{end_date}'
+
+        if form.cleaned_data['format'] == 'zip':
+            # The documents are rendered while the archive is sent, whatever their number
+            response = StreamingHttpResponse(zip_pdf_files(iter_pdf_files(self.iter_documents(document, queryset))),
+                                             content_type='application/zip')
+            response['Content-Disposition'] = f'attachment; filename="{name}.zip"'
+            return response
+
+        # A single PDF is rendered by one process and held in its memory, so its size is limited
+        if queryset.count() > settings.PDF_EXPORT_MAX_MERGED:
+            form.add_error(None, f"Un seul PDF ne peut pas contenir plus de {settings.PDF_EXPORT_MAX_MERGED} documents. "
+                                 f"Choisissez l'archive ZIP ou une période plus courte.")
+            return self.form_invalid(form)
+        html_strings = [render_to_string(template_name, data)
+                        for template_name, data, *_ in self.iter_documents(document, queryset)]
+        return redirect('pdf-job', job_id=render_merged_pdf(html_strings, f'{name}.pdf'))
 
 
 class RepairInvoiceView(LoginRequiredMixin,RoleRequiredMixin, View):
@@ -927,45 +1380,50 @@ class RepairInvoiceView(LoginRequiredMixin,RoleRequiredMixin, View):
         }
 
 
-        # Rendered html content as a string
-        html_string = render_to_string('facturereparation.html', data)
+        return pdf_response(request, 'facturereparation.html', data, 'reparation', repair.pk,
+                            f'facture-reparation-{repair.pk}.pdf')
 
-        # Create a WeasyPrint HTML object and write it to PDF
-        html = HTML(string=html_string)
-        pdf_content = BytesIO()
-        html.write_pdf(target=pdf_content)
 
-        # Rewind the BytesIO object to the start
-        pdf_content.seek(0)
+class PdfJobView(LoginRequiredMixin, View):
+    """Serve a PDF rendered in the background, or a page waiting for it."""
 
-        # Create a Django response object, and specify content_type as pdf
-        response = FileResponse(pdf_content, content_type='application/pdf')
-
-        # Otherwise, set it to "inline"
-        response['Content-Disposition'] = 'inline'
-
-        return response
+    def get(self, request, *args, **kwargs):
+        job = get_job(self.kwargs['job_id'])
+        if job is None:
+            raise Http404("Document introuvable.")
+        if job.status == PdfJob.DONE:
+            try:
+                return pdf_file_response(request, job.path, job.key, job.filename)
+            except FileNotFoundError:
+                # Evicted or invalidated since the status was read
+                job.status = PdfJob.EXPIRED
+        failed = job.status == PdfJob.FAILED
+        expired = job.status == PdfJob.EXPIRED
+        status = 500 if failed else 410 if expired else 202
+        if request.accepts('text/html'):
+            return render(request, 'documentencours.html', {'job': job, 'failed': failed, 'expired': expired},
+                          status=status)
+        return JsonResponse({'status': job.status}, status=status)
+
+
+class RepairTicketView(LoginRequiredMixin, RoleRequiredMixin, TicketMixin, View):
+    required_roles = ['Admin', 'Réparateur']
+    def get(self, request, *args, **kwargs):
+        repair = get_object_or_404(Repair.objects.select_related('client', 'hardware'), id=self.kwargs['pk'])
+        # Same condition as the A4 repair receipt
+        if repair.delivery_date:
+            messages.error(request, "Le matériel est déja livré . Vous ne pouvez pas imprimer le bon de réparation.")
+            return redirect('repair-detail', pk=repair.pk)
+        return self.ticket_response(repair_receipt(repair), f'ticket-reparation-{repair.pk}')
 
 
-class HardwareToRepairListView(LoginRequiredMixin,RoleRequiredMixin, ListView):
+class HardwareToRepairListView(LoginRequiredMixin,RoleRequiredMixin, FilteredListView):
     model = HardwareToRepair
     template_name = 'listemat.html'  # replace with your actual template
     context_object_name = 'hardwares'
-    paginate_by = 7
-    form_class = FilterForm
     required_roles = ['Admin', 'Réparateur']
-
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('query')
-        if query:
-            queryset = queryset.filter(id=query)
-        return queryset
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['form'] = FilterForm(self.request.GET)
-        return context
+    related_fields = ('category',)
+    only_fields = ('id', 'name', 'state', 'category__name')
 
 
 class AddHardwareToRepairView(LoginRequiredMixin,RoleRequiredMixin, CreateView):
@@ -1016,21 +1474,5 @@ class RepairReceiptView(LoginRequiredMixin,RoleRequiredMixin, View):
             # include any other data you need in the template
         }
 
-        # Rendered html content as a string
-        html_string = render_to_string('bonreparation.html', data)
-
-        # Create a WeasyPrint HTML object and write it to PDF
-        html = HTML(string=html_string)
-        pdf_content = BytesIO()
-        html.write_pdf(target=pdf_content)
-
-        # Rewind the BytesIO object to the start
-        pdf_content.seek(0)
-
-        # Create a Django response object, and specify content_type as pdf
-        response = FileResponse(pdf_content, content_type='application/pdf')
-
-        # Otherwise, set it to "inline"
-        response['Content-Disposition'] = 'inline'
-
-        return response
+        return pdf_response(request, 'bonreparation.html', data, 'reparation', repair.pk,
+                            f'bon-reparation-{repair.pk}.pdf')